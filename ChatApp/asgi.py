@@ -9,15 +9,20 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from channels.security.websocket import AllowedHostsOriginValidator
-
-from chat import routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatApp.settings')
+# set up Django before importing the consumers and their models, outside of runserver nothing else does
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter  # noqa: E402
+from channels.security.websocket import AllowedHostsOriginValidator  # noqa: E402
+
+from chat import routing  # noqa: E402
+from chat.auth import AuthMiddlewareStack  # noqa: E402
+from chat.static import StaticFilesHandler  # noqa: E402
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": StaticFilesHandler(django_asgi_app),
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
             URLRouter(
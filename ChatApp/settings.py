@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 import os
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -38,6 +38,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    # places the operator classes of the accounts indexes
+    'django.contrib.postgres',
 
     # cors
     'corsheaders',
@@ -53,15 +55,139 @@ LOGOUT_REDIRECT_URL = '/login'
 
 # channels stuff
 ASGI_APPLICATION = 'ChatApp.asgi.application'
+REDIS_URL = config('REDIS_URL', default='redis://redis:6379')
+# comma separated redis urls; rooms are hashed to one of them for their group
+# fan-out, history, members, presence and rate limit buckets. The first one
+# also holds the keys that belong to no room. Run `manage.py rebalance_shards`
+# after adding one.
+REDIS_SHARDS = config('REDIS_SHARDS', default=REDIS_URL, cast=Csv())
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.layers.ShardedRedisChannelLayer',
         'CONFIG': {
-            "hosts": [('redis', 6379)],
+            "hosts": REDIS_SHARDS,
         },
     },
 }
 
+# shared connection pools used by the chat consumers for history and rate limiting, one per shard
+CHAT_REDIS = {
+    'SHARDS': REDIS_SHARDS,
+    'MAX_CONNECTIONS': config('CHAT_REDIS_MAX_CONNECTIONS', default=50, cast=int),
+    # seconds to wait for a free connection before giving up
+    'POOL_TIMEOUT': config('CHAT_REDIS_POOL_TIMEOUT', default=5, cast=float),
+}
+
+# threads the consumers run their database queries in, 0 runs them in Django's thread-sensitive default thread,
+# which test cases need to see their own data
+CHAT_DB_EXECUTOR = {
+    'MAX_WORKERS': config('CHAT_DB_EXECUTOR_WORKERS', default=0 if 'test' in sys.argv else 8, cast=int),
+}
+
+# number of messages replayed on connect and returned per history request
+CHAT_HISTORY_PAGE_SIZE = config('CHAT_HISTORY_PAGE_SIZE', default=50, cast=int)
+# most messages replayed to a client reconnecting with `?since=<id>`, one that missed more gets the latest page
+CHAT_HISTORY_RESUME_LIMIT = config('CHAT_HISTORY_RESUME_LIMIT', default=500, cast=int)
+# messages kept per room in redis, older ones are moved to the database by `manage.py archive_history`
+CHAT_HISTORY_HOT_SIZE = config('CHAT_HISTORY_HOT_SIZE', default=1000, cast=int)
+CHAT_HISTORY_ARCHIVE_BATCH_SIZE = config('CHAT_HISTORY_ARCHIVE_BATCH_SIZE', default=500, cast=int)
+
+# results per search page, and how many entries of its rarest word a search walks per room and page at most
+CHAT_SEARCH_PAGE_SIZE = config('CHAT_SEARCH_PAGE_SIZE', default=20, cast=int)
+CHAT_SEARCH_SCAN_LIMIT = config('CHAT_SEARCH_SCAN_LIMIT', default=2000, cast=int)
+# messages indexed per round trip by `manage.py index_search`
+CHAT_SEARCH_INDEX_BATCH_SIZE = config('CHAT_SEARCH_INDEX_BATCH_SIZE', default=500, cast=int)
+
+# who may join a room, cached in process for `LOCAL_TTL` seconds (LRU of `SIZE` rooms) and in redis for `REDIS_TTL`
+CHAT_MEMBERSHIP_CACHE = {
+    'SIZE': config('CHAT_MEMBERSHIP_CACHE_SIZE', default=10000, cast=int),
+    'LOCAL_TTL': config('CHAT_MEMBERSHIP_CACHE_LOCAL_TTL', default=5, cast=float),
+    'REDIS_TTL': config('CHAT_MEMBERSHIP_CACHE_REDIS_TTL', default=3600, cast=int),
+}
+
+# users per page on the index and the contacts endpoint, and how many recently active rooms are listed first
+CHAT_CONTACTS_PAGE_SIZE = config('CHAT_CONTACTS_PAGE_SIZE', default=50, cast=int)
+CHAT_RECENT_CONTACTS = config('CHAT_RECENT_CONTACTS', default=10, cast=int)
+
+# most participants of a group room
+CHAT_GROUP_MAX_MEMBERS = config('CHAT_GROUP_MAX_MEMBERS', default=5000, cast=int)
+
+# seconds a resolved 1:1 room id is cached in redis
+CHAT_ROOM_PAIR_CACHE_TTL = config('CHAT_ROOM_PAIR_CACHE_TTL', default=86400, cast=int)
+
+# presence heartbeats expire after TTL seconds and every process refreshes its connections every
+# HEARTBEAT seconds. presence and typing changes are broadcast at most once per FLUSH_INTERVAL per
+# room, and a connection's typing signals count at most once per TYPING_THROTTLE seconds.
+CHAT_PRESENCE = {
+    'TTL': config('CHAT_PRESENCE_TTL', default=60, cast=int),
+    'HEARTBEAT': config('CHAT_PRESENCE_HEARTBEAT', default=20, cast=float),
+    'FLUSH_INTERVAL': config('CHAT_PRESENCE_FLUSH_INTERVAL', default=1, cast=float),
+    'TYPING_THROTTLE': config('CHAT_TYPING_THROTTLE', default=2, cast=float),
+}
+
+# frames waiting to be written to one websocket once its transport's buffer is full (under `manage.py
+# serve`), and what happens when a client reads too slowly to keep up: `drop_oldest` (drop the oldest
+# presence or typing update), `coalesce` (keep the latest presence and typing update, then drop the
+# oldest) or `disconnect`. Clients that still don't fit are disconnected, they reload history when they
+# reconnect
+CHAT_OUTBOUND = {
+    'MAX_FRAMES': config('CHAT_OUTBOUND_MAX_FRAMES', default=256, cast=int),
+    'POLICY': config('CHAT_OUTBOUND_POLICY', default='disconnect'),
+}
+
+# `manage.py serve`: worker processes (one per core by default), seconds a stopping worker waits for its
+# websockets to close after telling clients to reconnect, and how often workers report their health; the
+# supervisor replaces workers silent for HEARTBEAT_TIMEOUT seconds and serves their health on HEALTH_PORT
+CHAT_SERVE = {
+    'WORKERS': config('CHAT_SERVE_WORKERS', default=os.cpu_count() or 1, cast=int),
+    'DRAIN_TIMEOUT': config('CHAT_SERVE_DRAIN_TIMEOUT', default=30, cast=float),
+    'HEARTBEAT': config('CHAT_SERVE_HEARTBEAT', default=2, cast=float),
+    'HEARTBEAT_TIMEOUT': config('CHAT_SERVE_HEARTBEAT_TIMEOUT', default=30, cast=float),
+    'HEALTH_PORT': config('CHAT_SERVE_HEALTH_PORT', default=None, cast=lambda value: int(value) if value else None),
+}
+
+# read acknowledgements are collected per process and written to redis every FLUSH_INTERVAL seconds
+CHAT_READ_RECEIPTS = {
+    'FLUSH_INTERVAL': config('CHAT_READ_RECEIPTS_FLUSH_INTERVAL', default=1, cast=float),
+}
+
+# on connect and on the home page, the `DIGEST_SIZE` rooms that were active last among those with messages the
+# member has neither read nor seen in a digest are sent as one digest. what a member has seen is kept `TTL` seconds
+CHAT_INBOX = {
+    'TTL': config('CHAT_INBOX_TTL', default=30 * 24 * 3600, cast=int),
+    'DIGEST_SIZE': config('CHAT_INBOX_DIGEST_SIZE', default=20, cast=int),
+}
+
+# uploads of at most `MAX_SIZE` bytes, written to a temporary file chunk by chunk and moved into the default storage.
+# images get a thumbnail of at most `THUMBNAIL_SIZE` pixels per side, made after the upload by a pool of
+# `THUMBNAIL_WORKERS` threads, 0 makes them in the request thread. a message references at most `MAX_PER_MESSAGE`
+CHAT_ATTACHMENTS = {
+    'MAX_SIZE': config('CHAT_ATTACHMENTS_MAX_SIZE', default=25 * 1024 * 1024, cast=int),
+    'MAX_PER_MESSAGE': config('CHAT_ATTACHMENTS_MAX_PER_MESSAGE', default=10, cast=int),
+    'THUMBNAIL_SIZE': config('CHAT_ATTACHMENTS_THUMBNAIL_SIZE', default=320, cast=int),
+    'THUMBNAIL_WORKERS': config('CHAT_ATTACHMENTS_THUMBNAIL_WORKERS', default=0 if 'test' in sys.argv else 2, cast=int),
+}
+
+# token buckets per action and scope: `capacity` tokens, refilled at `rate` tokens per second.
+# `connection` is enforced in process, `user`, `room` and `global` are shared through redis,
+# on the shard of the room, so with several shards `user` and `global` are counted per shard.
+# a `lease` lets a process take that many tokens at once and skip redis while it spends them.
+CHAT_RATE_LIMITS = {
+    'message': {
+        'connection': {'capacity': 5, 'rate': 2},
+        'user': {'capacity': 1, 'rate': 1},
+        'room': {'capacity': 50, 'rate': 20, 'lease': 5},
+        'global': None,
+    },
+}
+
+# in-process counters and histograms of the chat consumers, scraped from /metrics/.
+# the endpoint accepts `Authorization: Bearer <TOKEN>` when a token is set, staff users otherwise.
+CHAT_METRICS = {
+    'ENABLED': config('CHAT_METRICS_ENABLED', default=False, cast=bool),
+    'TOKEN': config('CHAT_METRICS_TOKEN', default=''),
+}
+
 # for rest auth
 SITE_ID = 1
 
@@ -159,6 +285,21 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
+# `manage.py collectstatic` gathers the files here, chat.static.StaticFilesHandler serves them unless DEBUG is on
+STATIC_ROOT = config('STATIC_ROOT', default=os.path.join(BASE_DIR, 'staticfiles'))
+
+# uploaded attachments and their thumbnails, on the local filesystem. they aren't served from MEDIA_URL, the chat
+# views stream them to the members of their room
+MEDIA_ROOT = config('MEDIA_ROOT', default=os.path.join(BASE_DIR, 'media'))
+MEDIA_URL = 'media/'
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
@@ -166,10 +307,15 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 ACCOUNT_EMAIL_VERIFICATION = "none"
 
+# records go through an in-memory queue and are written by a background thread,
+# as JSON lines to a rotating file. `sampling` keeps that fraction of the records of an event.
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
+        'json': {
+            '()': 'chat.log.JsonFormatter',
+        },
         'verbose': {
             'format': '{levelname} {asctime} {module} {message}',
             'style': '{',
@@ -179,30 +325,72 @@ LOGGING = {
             'style': '{',
         },
     },
+    'filters': {
+        'sampling': {
+            '()': 'chat.log.SamplingFilter',
+            'rates': {
+                'message_sent': config('LOG_SAMPLE_MESSAGE_SENT', default=0.01, cast=float),
+            },
+        },
+    },
     'handlers': {
         'file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(BASE_DIR, 'debug.log'),
-            'formatter': 'verbose',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': config('LOG_FILE', default=os.path.join(BASE_DIR, 'debug.log')),
+            'maxBytes': config('LOG_MAX_BYTES', default=10 * 1024 * 1024, cast=int),
+            'backupCount': config('LOG_BACKUP_COUNT', default=5, cast=int),
+            'formatter': 'json',
+        },
+        # sorts after the handlers it writes to, see chat.log.QueueListenerHandler
+        'queue': {
+            '()': 'chat.log.QueueListenerHandler',
+            'handlers': ['cfg://handlers.file'],
+            'filters': ['sampling'],
         },
-
     },
     'loggers': {
         'django': {
-            'handlers': ['file'],
+            'handlers': ['queue'],
             'level': 'WARNING',
             'propagate': True,
         },
-
+        'chat': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        'accounts': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
-##### SILK ####
-INSTALLED_APPS += [
-    "silk",
-]
+##### PROFILING ####
+# cProfile a SAMPLE_RATE fraction of the HTTP requests and websocket handler calls, plus the
+# requests (or websocket handshakes) sending HEADER with the value of TOKEN. one .prof file per
+# profile is written to DIRECTORY, read them with `python -m pstats` or snakeviz.
+CHAT_PROFILING = {
+    'ENABLED': config('PROFILING_ENABLED', default=False, cast=bool),
+    'SAMPLE_RATE': config('PROFILING_SAMPLE_RATE', default=0.001, cast=float),
+    'HEADER': 'X-Profile',
+    'TOKEN': config('PROFILING_TOKEN', default=''),
+    'DIRECTORY': config('PROFILING_DIRECTORY', default=os.path.join(BASE_DIR, 'profiles')),
+}
 MIDDLEWARE += [
-    "silk.middleware.SilkyMiddleware",
+    'chat.profiling.ProfilingMiddleware',
 ]
-SILKY_PYTHON_PROFILER = True
+
+##### SILK ####
+# records every request and its queries in the database, for local debugging only
+SILK_ENABLED = config('SILK_ENABLED', default=False, cast=bool)
+if SILK_ENABLED:
+    INSTALLED_APPS += [
+        "silk",
+    ]
+    MIDDLEWARE += [
+        "silk.middleware.SilkyMiddleware",
+    ]
+    SILKY_PYTHON_PROFILER = True
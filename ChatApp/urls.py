@@ -15,7 +15,6 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
@@ -23,8 +22,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path("", include(("accounts.urls", "accounts"), namespace="accounts")),
     path("", include(("chat.urls", "chat"), namespace="chat")),
-    path("silk/", include("silk.urls", namespace="silk")),
 
 ]
-if settings.DEBUG:
-    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+if settings.SILK_ENABLED:
+    urlpatterns += [path("silk/", include("silk.urls", namespace="silk"))]
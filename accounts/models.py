@@ -1,8 +1,22 @@
 from django.contrib.auth.models import AbstractUser
-# from django.db import models
+from django.contrib.postgres.indexes import OpClass
+from django.db import models
+from django.db.models import F
+from django.db.models.functions import Lower
 
 
 # Create your models here.
 class User(AbstractUser):
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # contact listing order
+            models.Index(Lower('first_name'), Lower('last_name'), F('id'), name='user_name_lower_idx'),
+            # prefix search, LIKE 'prefix%' can only use pattern ops indexes under a non-C collation. These
+            # are PostgreSQL only, migration 0002 doesn't create them on other databases
+            models.Index(OpClass(Lower('first_name'), name='varchar_pattern_ops'), name='user_first_name_lower_idx'),
+            models.Index(OpClass(Lower('last_name'), name='varchar_pattern_ops'), name='user_last_name_lower_idx'),
+            models.Index(OpClass(Lower('email'), name='varchar_pattern_ops'), name='user_email_lower_idx'),
+        ]
+
     def __str__(self):
         return f"{self.first_name} {self.last_name}" if self.first_name and self.last_name else self.username
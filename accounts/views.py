@@ -15,6 +15,8 @@ def is_running_tests():
     return 'test' in sys.argv
 
 
+# stays sync: form validation checks the email is unique with a query, and forms
+# have no async validation
 def register(request):
     if request.method == 'POST':
         form = RegisterForm(request.POST)
@@ -45,6 +47,8 @@ def register(request):
     return render(request, 'auth/register.html', {'form': form})
 
 
+# stays sync: AuthenticationForm authenticates while it validates, with the
+# sync authenticate() and the password hasher it runs
 def login_view(request):
     if request.method == 'POST':
         form = LoginForm(request, data=request.POST)
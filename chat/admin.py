@@ -1,6 +1,21 @@
 from django.contrib import admin
 
-from chat.models import Room
+from chat.models import Attachment, Message, Room
+
 
 # Register your models here.
-admin.site.register(Room)
+@admin.register(Room)
+class RoomAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'is_group', 'is_public', 'created_at']
+    list_filter = ['is_group', 'is_public']
+    # group rooms can have thousands of participants
+    raw_id_fields = ['participants']
+
+
+admin.site.register(Message)
+
+
+@admin.register(Attachment)
+class AttachmentAdmin(admin.ModelAdmin):
+    list_display = ['name', 'content_type', 'size', 'room', 'uploader', 'created_at']
+    raw_id_fields = ['room', 'uploader']
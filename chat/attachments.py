@@ -0,0 +1,149 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+from django.db import close_old_connections, transaction
+from django.http import FileResponse
+from PIL import Image, ImageOps
+
+from chat import metrics
+from chat.models import Attachment
+
+logger = logging.getLogger(__name__)
+
+# image types browsers may display inline, any other upload is served as a download
+INLINE_CONTENT_TYPES = {'image/gif', 'image/jpeg', 'image/png', 'image/webp'}
+
+_thumbnail_executor = None
+
+
+class AttachmentUploadHandler(TemporaryFileUploadHandler):
+    """
+    Writes the uploaded file to a temporary file one chunk at a time, which
+    the filesystem storage then moves into place, so that no upload is ever
+    held whole in memory. Stops reading, and sets ``too_large``, once the
+    file grows past ``CHAT_ATTACHMENTS['MAX_SIZE']``.
+    """
+
+    too_large = False
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.CHAT_ATTACHMENTS['MAX_SIZE']:
+            self.too_large = True
+            raise StopUpload(connection_reset=True)
+        return super().receive_data_chunk(raw_data, start)
+
+
+class AttachmentResponse(FileResponse):
+    # under ASGI every block is read in a thread of its own, larger ones take fewer round trips
+    block_size = 64 * 1024
+
+
+def get_thumbnail_executor():
+    """The threads thumbnails are made in, ``None`` to make them in the calling thread."""
+    global _thumbnail_executor
+    max_workers = settings.CHAT_ATTACHMENTS['THUMBNAIL_WORKERS']
+    if not max_workers:
+        return None
+    if _thumbnail_executor is None:
+        _thumbnail_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat-thumbnail')
+    return _thumbnail_executor
+
+
+def attachment_to_ref(attachment):
+    """What messages carry of an attachment, its bytes are fetched from the attachment views."""
+    return {
+        'id': attachment.id,
+        'name': attachment.name,
+        'content_type': attachment.content_type,
+        'size': attachment.size,
+    }
+
+
+def create_attachment(room_id, uploader, uploaded_file):
+    """Store an upload of ``uploader`` in the room and queue its thumbnail once the row is committed."""
+    attachment = Attachment.objects.create(
+        room_id=room_id,
+        uploader=uploader,
+        file=uploaded_file,
+        name=os.path.basename(uploaded_file.name)[:Attachment._meta.get_field('name').max_length],
+        content_type=uploaded_file.content_type or 'application/octet-stream',
+        size=uploaded_file.size,
+    )
+    if attachment.content_type.startswith('image/'):
+        transaction.on_commit(lambda: schedule_thumbnail(attachment.id))
+    return attachment
+
+
+def schedule_thumbnail(attachment_id):
+    executor = get_thumbnail_executor()
+    if executor is None:
+        make_thumbnail(attachment_id)
+        return
+    executor.submit(run_thumbnail_worker, attachment_id)
+
+
+def run_thumbnail_worker(attachment_id):
+    # the pool threads keep their connections, like the request threads do
+    close_old_connections()
+    try:
+        make_thumbnail(attachment_id)
+    finally:
+        close_old_connections()
+
+
+def make_thumbnail(attachment_id):
+    """
+    Scale the image down to ``CHAT_ATTACHMENTS['THUMBNAIL_SIZE']`` pixels per
+    side and store it next to the upload. JPEG images are decoded at the
+    smallest scale that still covers the thumbnail. Uploads Pillow can't read
+    are left without one.
+    """
+    started = time.perf_counter()
+    result = 'ok'
+    try:
+        attachment = Attachment.objects.get(id=attachment_id)
+        size = settings.CHAT_ATTACHMENTS['THUMBNAIL_SIZE']
+        with attachment.file.open('rb') as file, Image.open(file) as image:
+            width, height = image.size
+            image.draft('RGB', (size, size))
+            thumbnail = ImageOps.exif_transpose(image)
+            thumbnail.thumbnail((size, size))
+            output = BytesIO()
+            if thumbnail.mode in ('RGB', 'L'):
+                thumbnail.save(output, 'JPEG', quality=85)
+                extension = 'jpg'
+            else:
+                # transparency and palettes are kept as PNG
+                thumbnail.convert('RGBA').save(output, 'PNG')
+                extension = 'png'
+        attachment.thumbnail.save(f'{attachment.id}.{extension}', ContentFile(output.getvalue()), save=False)
+        Attachment.objects.filter(id=attachment.id).update(
+            thumbnail=attachment.thumbnail.name, width=width, height=height,
+        )
+    except Exception as e:
+        result = 'error'
+        logger.error("Error during thumbnail generation of attachment %s: %s", attachment_id, e)
+    metrics.thumbnail_latency.observe(time.perf_counter() - started, result)
+
+
+def get_attachment_refs(room_id, uploader_id, attachment_ids):
+    """
+    The references of the attachments of a message, in the given order, or
+    ``None`` unless they are all uploads of ``uploader_id`` to the room.
+    """
+    if not isinstance(attachment_ids, list) or len(attachment_ids) > settings.CHAT_ATTACHMENTS['MAX_PER_MESSAGE']:
+        return None
+    if not all(isinstance(attachment_id, int) for attachment_id in attachment_ids):
+        return None
+    attachment_ids = list(dict.fromkeys(attachment_ids))
+    attachments = Attachment.objects.filter(id__in=attachment_ids, room_id=room_id, uploader_id=uploader_id)
+    attachments = {attachment.id: attachment for attachment in attachments}
+    if len(attachments) != len(attachment_ids):
+        return None
+    return [attachment_to_ref(attachments[attachment_id]) for attachment_id in attachment_ids]
@@ -0,0 +1,20 @@
+from channels.auth import AuthMiddleware, get_user
+from channels.sessions import CookieMiddleware, SessionMiddleware
+
+from chat.executor import database_sync_to_async
+
+
+class ExecutorAuthMiddleware(AuthMiddleware):
+    """
+    ``channels.auth.AuthMiddleware`` loading the session and user of a
+    handshake in the pool of ``chat.executor`` rather than in the default
+    thread shared with every other ``sync_to_async`` call.
+    """
+
+    async def resolve_scope(self, scope):
+        # the undecorated channels.auth.get_user
+        scope['user']._wrapped = await database_sync_to_async(get_user.func)(scope)
+
+
+def AuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(ExecutorAuthMiddleware(inner)))
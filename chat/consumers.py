@@ -1,73 +1,140 @@
-import json
-import sys
-from datetime import datetime, timedelta
+import time
+from urllib.parse import parse_qs
 
-from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 import logging
-import redis.asyncio as redis
-from chat.models import Room
+from chat import metrics, workers
+from chat.attachments import get_attachment_refs
+from chat.executor import database_sync_to_async
+from chat.history import append_message, get_history_page, get_messages_since
+from chat.inbox import pop_digest
+from chat.membership import is_room_member, update_local
+from chat.outbound import TRANSPORT_EXTENSION, OutboundQueue
+from chat.presence import get_presence_tracker
+from chat.profiling import profile_handler
+from chat.protocol import ProtocolError, encode_broadcast, negotiate, new_broadcast_id
+from chat.ratelimit import RateLimiter
+from chat.receipts import get_read_cursor_batcher
+from chat.redis_pool import get_room_redis
+from chat.rooms import room_group_name
 
 User = get_user_model()
 
 logger = logging.getLogger(__name__)
 
+# close code of the connections of a user who left or was removed from the room
+REMOVED_CLOSE_CODE = 4003
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    @profile_handler
     async def connect(self):
-        self.RATE_LIMIT_INTERVAL = timedelta(seconds=1)
-
-        if not self.scope["user"].is_authenticated:
-            await self.close()
+        user = self.scope["user"]
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        self.room_group_name = room_group_name(self.room_id)
+        self.accepted = False
+        if not user.is_authenticated:
+            metrics.connects.inc('unauthenticated')
+            await self.close()
+            return
+        if workers.draining:
+            # this worker is shutting down, the client retries on another one
+            metrics.connects.inc('draining')
+            await self.close(code=workers.RESTART_CLOSE_CODE)
+            return
 
         try:
-            room_exists = await sync_to_async(Room.objects.filter(id=self.room_id).exists)()
-            if not room_exists:
-                logger.info(f"User {self.scope['user'].id} tried to connect to non-existent room {self.room_id}.")
+            if not await is_room_member(self.room_id, user.id):
+                logger.info("User %s tried to connect to room %s without being a participant.", user.id, self.room_id,
+                            extra={'event': 'connect_forbidden', 'user_id': user.id, 'room_id': self.room_id})
+                metrics.connects.inc('forbidden')
                 await self.close()
-            self.redis_client = await redis.from_url('redis://redis:6379', decode_responses=True)
+                return
+            self.redis_client = get_room_redis(self.room_id)
+            self.rate_limiter = RateLimiter('message', user.id, self.room_id)
+            self.protocol = negotiate(self.scope.get('subprotocols', []))
+            self.presence = get_presence_tracker(self.channel_layer)
+            self.read_cursors = get_read_cursor_batcher(self.channel_layer)
+            self.last_typing = None
+            # messages below this id were replayed on connect, their broadcasts are skipped
+            self.delivered_until = 0
 
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
 
-            await self.accept()
-            logger.info(f"User {self.scope['user'].id} connected to room {self.room_id}.")
+            await self.accept(subprotocol=self.protocol.subprotocol)
+            self.accepted = True
+            workers.register(self)
+            self.too_slow = False
+            self.outbound = OutboundQueue(
+                self.send_now, settings.CHAT_OUTBOUND['MAX_FRAMES'], settings.CHAT_OUTBOUND['POLICY'],
+                transport=self.scope.get('extensions', {}).get(TRANSPORT_EXTENSION),
+            )
+            metrics.connects.inc('accepted')
+            metrics.active_connections.inc(self.room_id)
+            logger.info("User %s connected to room %s.", user.id, self.room_id,
+                        extra={'event': 'connect', 'user_id': user.id, 'room_id': self.room_id})
 
             await self.send_last_messages()
+            online = await self.presence.join(self.room_id, user.id, self.channel_name)
+            await self.send_frames(self.protocol.presence_frames(online))
+            await self.send_digest()
         except Exception as e:
-            logger.error(f"Error during connection: {e}")
+            logger.error("Error during connection: %s", e)
+            metrics.connects.inc('error')
             await self.close()
 
     async def disconnect(self, close_code):
+        accepted = getattr(self, 'accepted', False)
+        if accepted:
+            workers.unregister(self)
+            metrics.disconnects.inc()
+            metrics.active_connections.dec(self.room_id)
         try:
+            if accepted:
+                await self.outbound.close()
+                await self.presence.leave(self.room_id, self.channel_name)
             await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
-            logger.info(f"User {self.scope['user'].id} disconnected from room {self.room_id}.")
+            user_id = self.scope['user'].id
+            logger.info("User %s disconnected from room %s.", user_id, self.room_id,
+                        extra={'event': 'disconnect', 'user_id': user_id, 'room_id': self.room_id})
         except Exception as e:
-            logger.error(f"Error during disconnection: {e}")
-
-        if hasattr(self, 'redis_client'):
-            await self.redis_client.close()
+            logger.error("Error during disconnection: %s", e)
 
-    async def receive(self, text_data):
+    @profile_handler
+    async def receive(self, text_data=None, bytes_data=None):
+        received = time.perf_counter()
         try:
-            text_data_json = json.loads(text_data)
-            message = text_data_json['message']
-            user = self.scope['user']
-            if not await self.is_allowed_to_send_message(user.id):
-                logger.info(f"User {user.id} is rate-limited and tried to send a message.")
-                await self.send(text_data=json.dumps({
-                    'error': 'You are sending messages too quickly. Please wait a moment.'
-                }))
+            data = self.protocol.decode(text_data, bytes_data)
+            if data.get('type') == 'history':
+                await self.receive_history_request(data)
+                return
+            if data.get('type') == 'typing':
+                self.receive_typing()
+                return
+            if data.get('type') == 'read':
+                self.receive_read(data)
                 return
 
+            message = data['message']
+            user = self.scope['user']
+            attachments = []
+            if data.get('attachments'):
+                # files are uploaded over HTTP beforehand, messages only reference them
+                attachments = await database_sync_to_async(get_attachment_refs)(
+                    self.room_id, user.id, data['attachments']
+                )
+                if attachments is None:
+                    await self.send_frames(self.protocol.error_frames('Invalid attachments.'))
+                    return
             message_data = {
                 'user_id': user.id,
                 'user_first_name': user.first_name,
@@ -75,79 +142,185 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'content': message,
                 'timestamp': self.get_current_timestamp()
             }
-            if 'test' in sys.argv:
-                redis_key = f'room_{self.room_id}_messages_test'
-            else:
-                redis_key = f'room_{self.room_id}_messages'
-            await self.redis_client.rpush(redis_key, json.dumps(message_data))
+            if attachments:
+                message_data['attachments'] = attachments
+            message_id = await append_message(self.redis_client, self.room_id, message_data, self.rate_limiter)
+            if message_id is None:
+                logger.info("User %s is rate-limited and tried to send a message.", user.id,
+                            extra={'event': 'rate_limited', 'user_id': user.id, 'room_id': self.room_id})
+                metrics.rate_limited.inc('message')
+                await self.send_frames(self.protocol.error_frames(
+                    'You are sending messages too quickly. Please wait a moment.'
+                ))
+                return
+
+            # recipients encode it once per process and protocol, see chat.protocol.encode_broadcast
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
-                    'message': message,
-                    'user_first_name': user.first_name,
-                    'user_last_name': user.last_name,
-                    'user_id': user.id,
+                    'broadcast_id': new_broadcast_id(),
+                    'message': {
+                        'id': message_id,
+                        'user_id': user.id,
+                        'message': message,
+                        'user_first_name': user.first_name,
+                        'user_last_name': user.last_name,
+                        'timestamp': message_data['timestamp'],
+                        'attachments': attachments,
+                    },
                 }
             )
+            metrics.broadcast_latency.observe(time.perf_counter() - received)
+            # senders have read everything up to their own message
+            self.read_cursors.acknowledge(user.id, self.room_id, message_id + 1)
 
-            await self.store_last_message_timestamp(user.id)
-            logger.info(f"User {user.id} sent a message in room {self.room_id}.")
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error: {e}")
+            logger.info("User %s sent a message in room %s.", user.id, self.room_id,
+                        extra={'event': 'message_sent', 'user_id': user.id, 'room_id': self.room_id})
+        except ProtocolError as e:
+            logger.error("Frame decode error: %s", e)
         except Exception as e:
-            logger.error(f"Error during message receipt: {e}")
+            logger.error("Error during message receipt: %s", e)
 
+    @profile_handler
     async def chat_message(self, event):
+        message = event['message']
+        if message['id'] < self.delivered_until:
+            return
+        try:
+            await self.send_frames(self.protocol.profile_frames(message))
+            await self.send_encoded(
+                encode_broadcast(event['broadcast_id'], self.protocol, lambda protocol: protocol.message_frame(message))
+            )
+        except Exception as e:
+            logger.error("Error during sending chat message: %s", e)
+
+    async def chat_presence(self, event):
+        # changes to the list sent on connect, unlike typing updates they can't be dropped
+        await self.forward_event(
+            event, lambda protocol: protocol.presence_change_frame(event['joined'], event['left'])
+        )
+
+    async def chat_typing(self, event):
+        # a newer typing update supersedes the ones still queued
+        await self.forward_event(event, lambda protocol: protocol.typing_frame(event['user_ids']), key='typing')
+
+    async def chat_read(self, event):
+        await self.forward_event(event, lambda protocol: protocol.read_frame(event['positions']))
+
+    async def chat_members_removed(self, event):
+        # other processes would let the removed users back in until their cached answer expires
+        update_local(self.room_id, removed=event['user_ids'])
+        if self.scope['user'].id in event['user_ids']:
+            await self.close(code=REMOVED_CLOSE_CODE)
+
+    async def forward_event(self, event, build_frame, key=None):
         try:
-            message = event['message']
-            user_first_name = event['user_first_name']
-            user_last_name = event['user_last_name']
-
-            await self.send(text_data=json.dumps({
-                'message': message,
-                'user_first_name': user_first_name,
-                'user_last_name': user_last_name,
-                'user_id': event['user_id'],
-            }))
+            data = encode_broadcast(event['broadcast_id'], self.protocol, build_frame)
+            if data is None:
+                return
+            await self.send_encoded(data, key)
         except Exception as e:
-            logger.error(f"Error during sending chat message: {e}")
+            logger.error("Error during sending %s: %s", event['type'], e)
+
+    def receive_typing(self):
+        # the tracker coalesces typing per room, this only keeps a chatty client from calling it on every key
+        now = time.monotonic()
+        if self.last_typing is not None and now - self.last_typing < settings.CHAT_PRESENCE['TYPING_THROTTLE']:
+            return
+        self.last_typing = now
+        self.presence.user_typing(self.room_id, self.scope['user'].id)
+
+    def receive_read(self, request):
+        # acknowledges every message up to and including `id`, written in batches
+        try:
+            position = int(request['id']) + 1
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Invalid read acknowledgement: %s", e)
+            return
+        self.read_cursors.acknowledge(self.scope['user'].id, self.room_id, position)
+
+    async def send_frames(self, frames):
+        for frame in frames:
+            await self.send_encoded(self.protocol.encode(frame))
+
+    async def send_encoded(self, data, key=None):
+        """Queue an encoded frame, see chat.outbound.OutboundQueue."""
+        if self.too_slow:
+            return
+        if not self.outbound.put(data, key):
+            self.too_slow = True
+            user_id = self.scope['user'].id
+            logger.info("User %s was disconnected from room %s for reading too slowly.", user_id, self.room_id,
+                        extra={'event': 'slow_client', 'user_id': user_id, 'room_id': self.room_id})
+            metrics.outbound_disconnects.inc()
+            await self.close(code=4008)
+
+    async def send_now(self, data):
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
 
     def get_current_timestamp(self):
-        from datetime import datetime
-        return datetime.now().isoformat()
+        return timezone.now().isoformat()
+
+    def get_since(self):
+        """Id of the last message a reconnecting client has, from ``?since=<id>``, or ``None``."""
+        values = parse_qs(self.scope.get('query_string', b'').decode('latin1')).get('since')
+        try:
+            since = int(values[-1])
+        except (TypeError, ValueError):
+            return None
+        return since if since >= -1 else None
 
     async def send_last_messages(self):
+        since = self.get_since()
+        if since is None or not await self.send_missed_messages(since):
+            await self.send_history(initial=True)
+
+    async def send_missed_messages(self, since):
+        """Replay the messages after ``since``. Returns ``False`` when too many were missed to replay them."""
         try:
-            messages = await self.redis_client.lrange(f'room_{self.room_id}_messages', 0, -1)
-            for message in messages:
-                message_data = json.loads(message)
-                await self.send(text_data=json.dumps({
-                    'user_id': message_data['user_id'],
-                    'message': message_data['content'],
-                    'user_first_name': message_data['user_first_name'],
-                    'user_last_name': message_data['user_last_name'],
-                }))
+            with metrics.history_replay_latency.time():
+                messages = await get_messages_since(self.redis_client, self.room_id, since)
+                if messages is None:
+                    return False
+                for message in messages:
+                    await self.send_frames(self.protocol.profile_frames(message))
+                    await self.send_frames([self.protocol.message_frame(message)])
+            if messages:
+                self.delivered_until = messages[-1]['id'] + 1
+            metrics.history_replay_messages.observe(len(messages))
         except Exception as e:
-            logger.error(f"Error during sending last messages: {e}")
+            logger.error("Error during sending missed messages: %s", e)
+        return True
 
-    async def is_allowed_to_send_message(self, user_id):
+    async def send_digest(self):
+        """Send the other rooms that got messages the user hasn't read yet, in one frame."""
         try:
-            last_message_timestamp = await self.redis_client.get(f'user_{user_id}_last_message_timestamp')
-            if last_message_timestamp:
-                last_message_time = datetime.fromisoformat(last_message_timestamp)
-                if datetime.now() - last_message_time < self.RATE_LIMIT_INTERVAL:
-                    return False
-            return True
+            entries = await pop_digest(self.scope['user'].id)
+            entries = [entry for entry in entries if entry['room_id'] != self.room_id]
+            if entries:
+                await self.send_frames(self.protocol.digest_frames(entries))
         except Exception as e:
-            logger.error(f"Error during rate limiting check: {e}")
-            return False
+            logger.error("Error during sending inbox digest: %s", e)
 
-    async def store_last_message_timestamp(self, user_id):
+    async def receive_history_request(self, request):
         try:
-            await self.redis_client.set(
-                f'user_{user_id}_last_message_timestamp',
-                datetime.now().isoformat()
-            )
+            before = int(request['before'])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error("Invalid history request: %s", e)
+            return
+        await self.send_history(before=before)
+
+    async def send_history(self, before=None, initial=False):
+        try:
+            with metrics.history_replay_latency.time():
+                messages, cursor = await get_history_page(self.redis_client, self.room_id, before=before)
+                await self.send_frames(self.protocol.history_frames(messages, cursor))
+            if initial and messages:
+                self.delivered_until = messages[-1]['id'] + 1
+            metrics.history_replay_messages.observe(len(messages))
         except Exception as e:
-            logger.error(f"Error during storing last message timestamp: {e}")
+            logger.error("Error during sending history: %s", e)
@@ -0,0 +1,148 @@
+import logging
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.db.models import Q
+from django.db.models.functions import Lower
+from django.urls import reverse
+
+from chat.history import room_activity_key
+from chat.models import Room
+from chat.receipts import get_unread_counts
+from chat.redis_pool import get_sync_redis
+from chat.sharding import group_by_shard
+
+User = get_user_model()
+
+logger = logging.getLogger(__name__)
+
+CURSOR_SALT = 'chat.contacts'
+
+
+def get_contacts_page(user, query='', cursor=None, limit=None):
+    """
+    Return one page of the other users, ordered by name, and the cursor of the
+    next page (``None`` on the last page).
+
+    ``query`` matches the start of the first name, last name or email. Pages
+    are read with keyset pagination on the lowercased names, so every page
+    costs the same index range scan however far the listing goes. Raises
+    ``signing.BadSignature`` for a cursor that wasn't issued here.
+    """
+    limit = limit or settings.CHAT_CONTACTS_PAGE_SIZE
+    users = User.objects.exclude(id=user.id).annotate(
+        first_name_lower=Lower('first_name'),
+        last_name_lower=Lower('last_name'),
+    )
+    if query:
+        query = query.lower()
+        users = users.annotate(email_lower=Lower('email')).filter(
+            Q(first_name_lower__startswith=query)
+            | Q(last_name_lower__startswith=query)
+            | Q(email_lower__startswith=query)
+        )
+    if cursor:
+        first_name, last_name, user_id = signing.loads(cursor, salt=CURSOR_SALT)
+        users = users.filter(
+            Q(first_name_lower__gt=first_name)
+            | Q(first_name_lower=first_name, last_name_lower__gt=last_name)
+            | Q(first_name_lower=first_name, last_name_lower=last_name, id__gt=user_id)
+        )
+
+    contacts = list(
+        users.order_by('first_name_lower', 'last_name_lower', 'id').only('id', 'first_name', 'last_name')[:limit + 1]
+    )
+    next_cursor = None
+    if len(contacts) > limit:
+        contacts = contacts[:limit]
+        last = contacts[-1]
+        next_cursor = signing.dumps([last.first_name_lower, last.last_name_lower, last.id], salt=CURSOR_SALT)
+    return contacts, next_cursor
+
+
+def get_direct_rooms(user):
+    """Contact id -> id of their 1:1 room with ``user``."""
+    rooms = {}
+    direct_rooms = Room.objects.filter(participants=user, pair_key__isnull=False).values_list('id', 'pair_key')
+    for room_id, pair_key in direct_rooms:
+        low, high = (int(user_id) for user_id in pair_key.split(':'))
+        rooms[high if low == user.id else low] = room_id
+    return rooms
+
+
+def get_recent_contacts(user, limit=None, direct_rooms=None):
+    """The users of the most recently active 1:1 rooms of ``user``, most recent first."""
+    limit = limit or settings.CHAT_RECENT_CONTACTS
+    rooms = list((direct_rooms if direct_rooms is not None else get_direct_rooms(user)).items())
+    if not rooms:
+        return []
+    # one round trip per shard holding some of the rooms
+    scores = {}
+    try:
+        for shard, room_ids in group_by_shard([room_id for _, room_id in rooms]).items():
+            scores.update(zip(room_ids, get_sync_redis(shard).zmscore(room_activity_key(), room_ids)))
+    except Exception as e:
+        logger.error("Error during recent rooms lookup: %s", e,
+                     extra={'event': 'recent_rooms_lookup_failed', 'user_id': user.id})
+        return []
+
+    contact_ids = [
+        contact_id for score, contact_id in sorted(
+            ((scores[room_id], contact_id) for contact_id, room_id in rooms if scores[room_id] is not None),
+            reverse=True,
+        )[:limit]
+    ]
+
+    contacts = User.objects.filter(id__in=contact_ids).exclude(id=user.id).only('id', 'first_name', 'last_name')
+    contacts_by_id = {contact.id: contact for contact in contacts}
+    return [contacts_by_id[contact_id] for contact_id in contact_ids if contact_id in contacts_by_id]
+
+
+def get_groups(user):
+    """The group rooms of ``user``, ordered by name, with ``unread`` set to their unread messages."""
+    groups = list(Room.objects.filter(participants=user, is_group=True).order_by('name', 'id').only('id', 'name'))
+    counts = get_unread_counts(user.id, {group.id for group in groups})
+    for group in groups:
+        group.unread = counts.get(group.id, 0)
+    return groups
+
+
+def add_unread_counts(user, contacts, direct_rooms=None):
+    """Set ``unread`` on every contact to the unread messages of their 1:1 room with ``user``."""
+    direct_rooms = direct_rooms if direct_rooms is not None else get_direct_rooms(user)
+    counts = get_unread_counts(user.id, {direct_rooms[c.id] for c in contacts if c.id in direct_rooms})
+    for contact in contacts:
+        contact.unread = counts.get(direct_rooms.get(contact.id), 0)
+
+
+def contact_to_json(contact):
+    return {
+        'id': contact.id,
+        'first_name': contact.first_name,
+        'last_name': contact.last_name,
+        'url': reverse('chat:get_or_create_room', args=[contact.id]),
+    }
+
+
+def add_digest_labels(user, entries, direct_rooms=None):
+    """Set ``label`` and ``url`` on every inbox digest entry: the group name or the other user's name."""
+    direct_rooms = direct_rooms if direct_rooms is not None else get_direct_rooms(user)
+    contact_ids = {room_id: contact_id for contact_id, room_id in direct_rooms.items()}
+    room_ids = [entry['room_id'] for entry in entries]
+    names = dict(Room.objects.filter(id__in=room_ids, is_group=True).values_list('id', 'name'))
+    contacts = User.objects.filter(id__in=[contact_ids[r] for r in room_ids if r in contact_ids])
+    for contact in contacts.only('id', 'username', 'first_name', 'last_name'):
+        names[direct_rooms[contact.id]] = f"{contact.first_name} {contact.last_name}".strip() or contact.username
+    for entry in entries:
+        entry['label'] = names.get(entry['room_id'], '')
+        entry['url'] = reverse('chat:chat_room', args=[entry['room_id']])
+
+
+def group_to_json(room):
+    return {
+        'id': room.id,
+        'name': room.name,
+        'public': room.is_public,
+        'url': reverse('chat:chat_room', args=[room.id]),
+    }
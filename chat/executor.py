@@ -0,0 +1,61 @@
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from chat import metrics
+
+_executor = None
+
+
+def get_executor():
+    """The threads the consumers run their database queries in, ``None`` for Django's thread-sensitive default."""
+    global _executor
+    max_workers = settings.CHAT_DB_EXECUTOR['MAX_WORKERS']
+    if not max_workers:
+        return None
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat-db')
+    return _executor
+
+
+def database_sync_to_async(func):
+    """
+    Like ``channels.db.database_sync_to_async``, but runs ``func`` in a
+    bounded pool of its own, so that websocket handshakes never queue behind
+    the sync views and other ``sync_to_async`` calls of the process. Waiting
+    and running calls, and the time they waited for a thread, are recorded.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = None
+
+        def run():
+            nonlocal started
+            started = time.perf_counter()
+            if executor is None:
+                return func(*args, **kwargs)
+            # the pool threads keep their connections, like the request threads do
+            close_old_connections()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                close_old_connections()
+
+        executor = get_executor()
+        submitted = time.perf_counter()
+        metrics.db_executor_calls.inc()
+        try:
+            if executor is None:
+                return await sync_to_async(run)()
+            return await sync_to_async(run, thread_sensitive=False, executor=executor)()
+        finally:
+            metrics.db_executor_calls.dec()
+            if started is not None:
+                metrics.db_executor_wait.observe(started - submitted)
+
+    return wrapper
@@ -0,0 +1,317 @@
+import json
+import re
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from chat import metrics
+from chat.executor import database_sync_to_async
+from chat.models import Message
+from chat.ratelimit import TAKE_TOKENS_LUA
+from chat.redis_pool import redis_key
+
+User = get_user_model()
+
+# Appends a message to the hot window, flags the room for archiving once the
+# window grows past its cap and for search indexing, and bumps the room in the
+# activity index, after taking a token from the rate limit buckets in KEYS[6..]. Returns the message
+# position in the room followed by the tokens granted per bucket, or -1 when a
+# bucket is empty.
+APPEND_SCRIPT = TAKE_TOKENS_LUA + """
+local granted = take_tokens(6, 4)
+if not granted then
+    return -1
+end
+local length = redis.call('RPUSH', KEYS[1], ARGV[1])
+local offset = tonumber(redis.call('GET', KEYS[2]) or '0')
+if length > tonumber(ARGV[2]) then
+    redis.call('SADD', KEYS[3], ARGV[3])
+end
+redis.call('ZADD', KEYS[4], redis.call('TIME')[1], ARGV[3])
+redis.call('SADD', KEYS[5], ARGV[3])
+local result = {offset + length - 1}
+for _, tokens in ipairs(granted) do
+    result[#result + 1] = tokens
+end
+return result
+"""
+
+# Reads the page ending right before ARGV[1] (or at the newest message) from
+# the hot window. Returns the page start, the archive offset and the messages
+# that are still in Redis; anything below the offset lives in the database.
+READ_SCRIPT = """
+local offset = tonumber(redis.call('GET', KEYS[2]) or '0')
+local total = offset + redis.call('LLEN', KEYS[1])
+local finish = total
+if ARGV[1] ~= '' then
+    finish = math.min(tonumber(ARGV[1]), total)
+end
+local start = math.max(finish - tonumber(ARGV[2]), 0)
+local hot_start = math.max(start, offset)
+local messages = {}
+if finish > hot_start then
+    messages = redis.call('LRANGE', KEYS[1], hot_start - offset, finish - offset - 1)
+end
+return {start, offset, messages}
+"""
+
+# Reads every message from position ARGV[1] on, unless more than ARGV[2] of
+# them are left. Returns the start (-1 when there are too many), the archive
+# offset and the messages that are still in Redis.
+READ_SINCE_SCRIPT = """
+local offset = tonumber(redis.call('GET', KEYS[2]) or '0')
+local total = offset + redis.call('LLEN', KEYS[1])
+local start = math.min(tonumber(ARGV[1]), total)
+if total - start > tonumber(ARGV[2]) then
+    return {-1, offset, {}}
+end
+local hot_start = math.max(start, offset)
+local messages = {}
+if total > hot_start then
+    messages = redis.call('LRANGE', KEYS[1], hot_start - offset, -1)
+end
+return {start, offset, messages}
+"""
+
+# Drops archived messages from the head of the hot window, and from the
+# search posting lists KEYS[4..], unless another archiver already did.
+TRIM_SCRIPT = """
+if tonumber(redis.call('GET', KEYS[2]) or '0') ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], ARGV[2], -1)
+local offset = redis.call('INCRBY', KEYS[2], ARGV[2])
+for i = 4, #KEYS do
+    redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', '(' .. offset)
+end
+if redis.call('LLEN', KEYS[1]) <= tonumber(ARGV[3]) then
+    redis.call('SREM', KEYS[3], ARGV[4])
+end
+return 1
+"""
+
+
+TERM_RE = re.compile(r'\w+')
+# longer words are not indexed, nor searched for
+MAX_TERM_LENGTH = 64
+
+
+def history_key(room_id):
+    return redis_key(f'room_{room_id}_messages')
+
+
+def history_offset_key(room_id):
+    return redis_key(f'room_{room_id}_messages_offset')
+
+
+def archive_rooms_key():
+    # rooms of the shard waiting to be archived
+    return redis_key('history_archive_rooms')
+
+
+def room_activity_key():
+    # room id -> unix time of its last message, for the rooms of the shard
+    return redis_key('room_activity')
+
+
+def index_rooms_key():
+    # rooms of the shard with messages waiting to be indexed for search
+    return redis_key('search_index_rooms')
+
+
+def term_key(room_id, term):
+    # ids of the room's hot messages holding the word, scored by id
+    return redis_key(f'room_{room_id}_term_{term}')
+
+
+def get_terms(text):
+    """The distinct lowercased words of ``text``, in order."""
+    terms = {}
+    for term in TERM_RE.findall(text.lower()):
+        if len(term) <= MAX_TERM_LENGTH:
+            terms[term] = None
+    return list(terms)
+
+
+def message_to_frame(message_id, message_data):
+    return {
+        'id': message_id,
+        'user_id': message_data['user_id'],
+        'message': message_data['content'],
+        'user_first_name': message_data['user_first_name'],
+        'user_last_name': message_data['user_last_name'],
+        'timestamp': message_data.get('timestamp'),
+        'attachments': message_data.get('attachments', []),
+    }
+
+
+async def append_message(redis_client, room_id, message_data, rate_limiter=None):
+    """
+    Store a message in the room's hot window and return its position.
+
+    When a ``rate_limiter`` is given, its shared buckets are checked and
+    updated in the same round trip as the append, except those it can spend
+    leased tokens of in process. Returns ``None`` for rate-limited messages.
+    """
+    keys = [
+        history_key(room_id), history_offset_key(room_id), archive_rooms_key(), room_activity_key(), index_rooms_key(),
+    ]
+    args = [json.dumps(message_data), settings.CHAT_HISTORY_HOT_SIZE, room_id]
+    if rate_limiter is not None:
+        if not rate_limiter.take_connection_token():
+            return None
+        buckets = rate_limiter.take_leased_tokens()
+        keys += rate_limiter.redis_keys(buckets)
+        args += rate_limiter.redis_args(buckets)
+
+    append = redis_client.register_script(APPEND_SCRIPT)
+    with metrics.redis_latency.time('append'):
+        result = await append(keys=keys, args=args)
+    if result == -1:
+        rate_limiter.refund_leased_tokens()
+        return None
+    seq, *granted = result
+    if granted:
+        rate_limiter.store_leases(granted, buckets)
+    return seq
+
+
+async def get_history_page(redis_client, room_id, before=None, limit=None):
+    """
+    Return one page of room history, oldest first, and the cursor to pass as
+    ``before`` to fetch the previous page (``None`` once the start is reached).
+
+    Message ids are positions in the room's history, so they stay stable while
+    new messages are appended and old ones are archived to the database.
+    """
+    limit = limit or settings.CHAT_HISTORY_PAGE_SIZE
+    read = redis_client.register_script(READ_SCRIPT)
+    with metrics.redis_latency.time('read_history'):
+        start, offset, raw_messages = await read(
+            keys=[history_key(room_id), history_offset_key(room_id)],
+            args=['' if before is None else before, limit],
+        )
+
+    messages = []
+    if start < offset:
+        archive_end = offset if before is None else min(before, offset)
+        messages = await database_sync_to_async(get_archived_messages)(room_id, start, archive_end)
+    hot_start = max(start, offset)
+    messages += [message_to_frame(hot_start + i, json.loads(raw)) for i, raw in enumerate(raw_messages)]
+
+    cursor = start if start > 0 else None
+    return messages, cursor
+
+
+async def get_messages_since(redis_client, room_id, since, limit=None):
+    """
+    Return the messages after id ``since``, oldest first, for a client that
+    reconnects having seen everything up to ``since``. Returns ``None`` when
+    it missed more than ``limit`` of them, it is then better off with the
+    latest page of history.
+    """
+    limit = limit or settings.CHAT_HISTORY_RESUME_LIMIT
+    read_since = redis_client.register_script(READ_SINCE_SCRIPT)
+    with metrics.redis_latency.time('read_since'):
+        start, offset, raw_messages = await read_since(
+            keys=[history_key(room_id), history_offset_key(room_id)],
+            args=[since + 1, limit],
+        )
+    if start == -1:
+        return None
+
+    messages = []
+    if start < offset:
+        messages = await database_sync_to_async(get_archived_messages)(room_id, start, offset)
+    hot_start = max(start, offset)
+    messages += [message_to_frame(hot_start + i, json.loads(raw)) for i, raw in enumerate(raw_messages)]
+    return messages
+
+
+def archived_message_to_frame(message):
+    return message_to_frame(message.seq, {
+        'user_id': message.sender_id,
+        'user_first_name': message.sender.first_name,
+        'user_last_name': message.sender.last_name,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'attachments': message.attachments,
+    })
+
+
+def get_archived_messages(room_id, start, end):
+    archived = Message.objects.filter(room_id=room_id, seq__gte=start, seq__lt=end).select_related('sender')
+    return [archived_message_to_frame(message) for message in archived]
+
+
+def store_archived_messages(room_id, offset, raw_messages):
+    """
+    Insert the messages of the room from position ``offset`` on, skipping
+    those already stored. Messages of senders deleted since they were sent
+    are dropped, the archived ones went with them.
+    """
+    entries = [(seq, json.loads(raw)) for seq, raw in enumerate(raw_messages, start=offset)]
+    sender_ids = {message_data['user_id'] for _, message_data in entries}
+    senders = set(User.objects.filter(id__in=sender_ids).values_list('id', flat=True))
+    messages = []
+    for seq, message_data in entries:
+        if message_data['user_id'] not in senders:
+            continue
+        timestamp = datetime.fromisoformat(message_data['timestamp'])
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        messages.append(Message(
+            room_id=room_id,
+            sender_id=message_data['user_id'],
+            seq=seq,
+            content=message_data['content'],
+            timestamp=timestamp,
+            attachments=message_data.get('attachments', []),
+        ))
+    Message.objects.bulk_create(messages, ignore_conflicts=True)
+
+
+async def archive_room(redis_client, room_id, batch_size=None):
+    """
+    Move up to ``batch_size`` messages that overflowed the room's hot window
+    into the database. Messages are only trimmed from Redis once they are
+    stored, so readers never see a gap. Returns the number of archived messages.
+    """
+    batch_size = batch_size or settings.CHAT_HISTORY_ARCHIVE_BATCH_SIZE
+    hot_size = settings.CHAT_HISTORY_HOT_SIZE
+    key = history_key(room_id)
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.get(history_offset_key(room_id))
+        pipe.llen(key)
+        pipe.lrange(key, 0, batch_size - 1)
+        offset, length, raw_messages = await pipe.execute()
+    offset = int(offset or 0)
+    overflow = min(length - hot_size, batch_size)
+    if overflow <= 0:
+        await redis_client.srem(archive_rooms_key(), room_id)
+        return 0
+
+    await database_sync_to_async(store_archived_messages)(room_id, offset, raw_messages[:overflow])
+    # archived messages are searched in the database, their words leave the posting lists
+    terms = dict.fromkeys(term for raw in raw_messages[:overflow] for term in get_terms(json.loads(raw)['content']))
+    trim = redis_client.register_script(TRIM_SCRIPT)
+    trimmed = await trim(
+        keys=[key, history_offset_key(room_id), archive_rooms_key()] + [term_key(room_id, term) for term in terms],
+        args=[offset, overflow, hot_size, room_id],
+    )
+    return overflow if trimmed else 0
+
+
+async def archive_pending_rooms(redis_client, batch_size=None):
+    """Archive the overflow of every flagged room. Returns the number of archived messages."""
+    archived = 0
+    for room_id in await redis_client.smembers(archive_rooms_key()):
+        while True:
+            count = await archive_room(redis_client, int(room_id), batch_size)
+            archived += count
+            if not count:
+                break
+    return archived
@@ -0,0 +1,137 @@
+import json
+import logging
+
+from django.conf import settings
+
+from chat.executor import database_sync_to_async
+from chat.history import history_key, history_offset_key, message_to_frame, room_activity_key
+from chat.models import Room
+from chat.receipts import read_cursors_key
+from chat.redis_pool import get_redis, get_sync_redis, redis_key
+from chat.sharding import group_by_shard
+
+logger = logging.getLogger(__name__)
+
+# Rooms of ARGV with messages the user has neither read nor seen in a
+# digest. KEYS[1] is the user's cursor hash, KEYS[2] their digest marks and
+# KEYS[3] the activity index, followed by the history and archive offset of
+# every room. Returns room id, unread count, last message ('' once archived),
+# its id, the room's message count and its last activity per room.
+DIGEST_SCRIPT = """
+local cursors = redis.call('HMGET', KEYS[1], unpack(ARGV))
+local marks = redis.call('HMGET', KEYS[2], unpack(ARGV))
+local digest = {}
+for i = 1, #ARGV do
+    local offset = tonumber(redis.call('GET', KEYS[i * 2 + 3]) or '0')
+    local total = offset + redis.call('LLEN', KEYS[i * 2 + 2])
+    local cursor = tonumber(cursors[i] or '0')
+    if total > math.max(cursor, tonumber(marks[i] or '0')) then
+        local last = ''
+        if total > offset then
+            last = redis.call('LINDEX', KEYS[i * 2 + 2], -1)
+        end
+        local activity = redis.call('ZSCORE', KEYS[3], ARGV[i]) or '0'
+        digest[#digest + 1] = {ARGV[i], total - cursor, last, total - 1, total, activity}
+    end
+end
+return digest
+"""
+
+
+def digest_marks_key(user_id):
+    # room id -> number of messages of the room when it was last in the
+    # user's digest, on every shard for the rooms it holds
+    return redis_key(f'user_{user_id}_digest')
+
+
+def get_room_ids(user_id):
+    return list(Room.objects.filter(participants=user_id).values_list('id', flat=True))
+
+
+def digest_calls(user_id, room_ids):
+    """The shard, keys and args of the digest script call of each shard holding some of the rooms."""
+    for shard, shard_room_ids in group_by_shard(room_ids).items():
+        keys = [read_cursors_key(user_id), digest_marks_key(user_id), room_activity_key()]
+        for room_id in shard_room_ids:
+            keys += [history_key(room_id), history_offset_key(room_id)]
+        yield shard, keys, shard_room_ids
+
+
+def latest_rooms(user_id, rows, limit):
+    """
+    The ``limit`` rooms of the digest script rows that were active last,
+    latest first, with their last message decoded. Rooms whose last message
+    is the user's own are left out: senders have read everything up to their
+    own message, whether or not their cursor was written yet.
+    """
+    rooms = []
+    for room_id, unread, last, last_id, total, activity in rows:
+        message_data = json.loads(last) if last else None
+        if message_data is None or message_data['user_id'] != user_id:
+            rooms.append((float(activity), int(room_id), unread, message_data, last_id, total))
+    rooms.sort(key=lambda room: room[0], reverse=True)
+    return [room[1:] for room in rooms[:limit]]
+
+
+def mark_calls(rooms):
+    """The shard and room id -> message count of each shard holding some of the digest rooms."""
+    totals = {room_id: total for room_id, _, _, _, total in rooms}
+    for shard, room_ids in group_by_shard(list(totals)).items():
+        yield shard, {room_id: totals[room_id] for room_id in room_ids}
+
+
+def digest_entries(rooms):
+    """
+    One entry per room with unread messages, in the order of ``rooms``: the
+    room id, its unread count and its last message, or ``None`` once archived.
+    """
+    entries = []
+    for room_id, unread, message_data, last_id, _ in rooms:
+        if unread:
+            message = message_to_frame(last_id, message_data) if message_data else None
+            entries.append({'room_id': room_id, 'unread': unread, 'message': message})
+    return entries
+
+
+async def pop_digest(user_id, limit=None):
+    """
+    Return the digest of the ``limit`` rooms of ``user_id`` that were active
+    last among those that got messages the user has neither read nor seen in
+    a previous digest, and mark them as seen. Costs one query for the user's
+    rooms and one script call and one pipeline per shard holding some of
+    them; sending a message does nothing for the digest.
+    """
+    limit = limit or settings.CHAT_INBOX['DIGEST_SIZE']
+    room_ids = await database_sync_to_async(get_room_ids)(user_id)
+    rows = []
+    for shard, keys, shard_room_ids in digest_calls(user_id, room_ids):
+        digest = get_redis(shard).register_script(DIGEST_SCRIPT)
+        rows += await digest(keys=keys, args=shard_room_ids)
+    rooms = latest_rooms(user_id, rows, limit)
+    for shard, totals in mark_calls(rooms):
+        async with get_redis(shard).pipeline(transaction=False) as pipe:
+            pipe.hset(digest_marks_key(user_id), mapping=totals)
+            pipe.expire(digest_marks_key(user_id), settings.CHAT_INBOX['TTL'])
+            await pipe.execute()
+    return digest_entries(rooms)
+
+
+def pop_sync_digest(user_id, limit=None):
+    """:func:`pop_digest` for sync views. Returns an empty digest when redis fails."""
+    limit = limit or settings.CHAT_INBOX['DIGEST_SIZE']
+    room_ids = get_room_ids(user_id)
+    try:
+        rows = []
+        for shard, keys, shard_room_ids in digest_calls(user_id, room_ids):
+            digest = get_sync_redis(shard).register_script(DIGEST_SCRIPT)
+            rows += digest(keys=keys, args=shard_room_ids)
+        rooms = latest_rooms(user_id, rows, limit)
+        for shard, totals in mark_calls(rooms):
+            with get_sync_redis(shard).pipeline(transaction=False) as pipe:
+                pipe.hset(digest_marks_key(user_id), mapping=totals)
+                pipe.expire(digest_marks_key(user_id), settings.CHAT_INBOX['TTL'])
+                pipe.execute()
+    except Exception as e:
+        logger.error("Error during inbox digest: %s", e, extra={'event': 'inbox_digest_failed', 'user_id': user_id})
+        return []
+    return digest_entries(rooms)
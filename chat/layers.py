@@ -0,0 +1,33 @@
+from channels_redis.core import RedisChannelLayer
+
+from chat.rooms import group_room_id
+from chat.sharding import room_shard_key, shard_index
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that places every room's group on the shard holding
+    the rest of the room's keys, so that a room's fan-out and its history live
+    on the same redis.
+
+    ``hosts`` must be the ``CHAT_REDIS['SHARDS']`` urls, in any order. Groups
+    and process channels are placed by rendezvous hashing on those urls
+    instead of by position in the list, so adding a shard only moves the rooms
+    the new shard wins.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard_names = [str(host.get('address', host)) for host in self.hosts]
+
+    def consistent_hash(self, value):
+        if isinstance(value, bytes):
+            value = value.decode('utf8')
+        room_id = group_room_id(value)
+        if room_id is not None:
+            value = room_shard_key(room_id)
+        elif '!' in value:
+            # send() hashes the full name of a process channel and receive()
+            # only its non-local part, they must land on the same shard
+            value = self.non_local_name(value)
+        return shard_index(value, self.shard_names)
@@ -0,0 +1,135 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# attributes every LogRecord has, anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+_exception_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the fields passed through ``extra`` next to the message."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and not name.startswith('_'):
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records of high volume events, given as
+    ``{event: rate}``. The event is the ``event`` field passed through
+    ``extra``; records of other events, and warnings and errors, always pass.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    Puts records on an in-memory queue and writes them through ``handlers``
+    from a background thread, so that logging from the event loop never waits
+    on the disk.
+
+    With ``logging.config.dictConfig``, pass the downstream handlers as
+    ``cfg://handlers.<name>``. dictConfig configures handlers in alphabetical
+    order and replaces their configuration by the handler, so they must sort
+    before this one.
+    """
+
+    def __init__(self, handlers, respect_handler_level=True):
+        super().__init__(queue.SimpleQueue())
+        # dictConfig resolves cfg:// references on item access, not on iteration
+        handlers = [handlers[i] for i in range(len(handlers))]
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=respect_handler_level)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def forward(self, target_queue):
+        """Hand the records to ``target_queue`` from now on, instead of writing them, see :func:`forward_records`."""
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+        self.listener = QueueListener(self.queue, ForwardingHandler(target_queue))
+        self.listener.start()
+
+    def stop(self):
+        """Write out the queued records and stop the listener thread."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def prepare(self, record):
+        # merge the arguments here, they may not be safe to read from another
+        # thread later, but leave the traceback out of the message
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class ForwardingHandler(QueueHandler):
+    """Puts the records a :class:`QueueListenerHandler` already prepared on a multiprocessing queue."""
+
+    def prepare(self, record):
+        return record
+
+
+def queue_listener_handlers():
+    """The :class:`QueueListenerHandler` instances of the configured loggers."""
+    loggers = [logging.getLogger()] + [
+        logger for logger in logging.Logger.manager.loggerDict.values() if isinstance(logger, logging.Logger)
+    ]
+    return list(dict.fromkeys(
+        handler for logger in loggers for handler in logger.handlers if isinstance(handler, QueueListenerHandler)
+    ))
+
+
+def forward_records(target_queue):
+    """
+    Send the records of this process to ``target_queue``, for the process
+    that started it to write them with :func:`collect_records`. Worker
+    processes of ``manage.py serve`` do so, so that only the supervisor
+    writes, and rotates, the log files.
+    """
+    for handler in queue_listener_handlers():
+        handler.forward(target_queue)
+
+
+def collect_records(source_queue):
+    """Write the records of ``source_queue`` through the handlers of this process. Returns the started listener."""
+    handlers = dict.fromkeys(
+        handler for listener_handler in queue_listener_handlers() for handler in listener_handler.listener.handlers
+    )
+    listener = QueueListener(source_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
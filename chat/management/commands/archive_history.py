@@ -0,0 +1,35 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.history import archive_pending_rooms
+from chat.redis_pool import close_redis, get_redis
+
+
+class Command(BaseCommand):
+    help = "Move room history that overflowed the redis hot window into the Message table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Archive pending rooms once and exit.")
+        parser.add_argument('--interval', type=float, default=5, help="Seconds to wait between archiving runs.")
+        parser.add_argument('--batch-size', type=int, default=None, help="Messages inserted per bulk_create.")
+
+    def handle(self, *args, **options):
+        asyncio.run(self.archive(options['once'], options['interval'], options['batch_size']))
+
+    async def archive(self, once, interval, batch_size):
+        # every shard flags the rooms it holds
+        redis_clients = [get_redis(shard) for shard in range(len(settings.CHAT_REDIS['SHARDS']))]
+        try:
+            while True:
+                archived = 0
+                for redis_client in redis_clients:
+                    archived += await archive_pending_rooms(redis_client, batch_size)
+                if archived:
+                    self.stdout.write(f"Archived {archived} messages.")
+                if once:
+                    break
+                await asyncio.sleep(interval)
+        finally:
+            await close_redis()
@@ -0,0 +1,316 @@
+import asyncio
+import gc
+import json
+import resource
+import statistics
+import time
+import uuid
+
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from chat.consumers import ChatConsumer
+from chat.history import (archive_rooms_key, get_terms, history_key, history_offset_key, index_rooms_key,
+                          room_activity_key, term_key)
+from chat.inbox import digest_marks_key
+from chat.membership import members_key, members_version_key
+from chat.models import Room
+from chat.presence import presence_key, room_presence_key
+from chat.protocol import SUBPROTOCOLS
+from chat.ratelimit import bucket_key
+from chat.receipts import read_cursors_key
+from chat.redis_pool import ShardPipelines, close_redis, use_redis
+from chat.search import indexed_position_key
+from chat.sharding import group_by_shard
+
+User = get_user_model()
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def current_rss():
+    """Resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # peak instead of current size where procfs isn't available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Client:
+    """One simulated websocket connection, reading its frames in the background."""
+
+    def __init__(self, user, room_id, protocol):
+        self.user = user
+        self.room_id = room_id
+        self.binary = protocol.endswith('msgpack')
+        subprotocols = [protocol] if protocol in SUBPROTOCOLS else None
+        self.communicator = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), f'/ws/chat/{room_id}/', subprotocols=subprotocols
+        )
+        self.communicator.scope['user'] = user
+        self.communicator.scope['url_route'] = {'kwargs': {'room_id': room_id}}
+        self.connected = False
+        self.reader = None
+
+    async def connect(self, timeout):
+        start = time.perf_counter()
+        self.connected, _ = await self.communicator.connect(timeout=timeout)
+        return time.perf_counter() - start
+
+    def decode(self, event):
+        if self.binary:
+            return msgpack.unpackb(event['bytes'])
+        return json.loads(event['text'])
+
+    def message_text(self, frame):
+        """Text of a chat message frame, None for every other frame."""
+        if isinstance(frame, dict):
+            return frame.get('message') if 'id' in frame else None
+        return frame[3] if frame[0] == 'm' else None
+
+    def is_error(self, frame):
+        return (isinstance(frame, dict) and 'error' in frame) or (isinstance(frame, list) and frame[0] == 'e')
+
+    def start_reading(self, stats):
+        self.reader = asyncio.create_task(self.read(stats))
+
+    async def read(self, stats):
+        while True:
+            frame = self.decode(await self.communicator.output_queue.get())
+            text = self.message_text(frame)
+            if text is not None and text.startswith(stats.run_id):
+                sent_at = float(text.split(':', 2)[1])
+                stats.latencies.append(time.perf_counter() - sent_at)
+                stats.received += 1
+                if stats.received >= stats.expected:
+                    stats.done.set()
+            elif self.is_error(frame):
+                stats.errors += 1
+
+    async def send(self, text):
+        if self.binary:
+            await self.communicator.send_to(bytes_data=msgpack.packb({'message': text}))
+        else:
+            await self.communicator.send_to(text_data=json.dumps({'message': text}))
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.connected:
+            await self.communicator.disconnect()
+
+
+class Stats:
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.latencies = []
+        self.received = 0
+        self.expected = 0
+        self.errors = 0
+        self.done = asyncio.Event()
+
+
+class Command(BaseCommand):
+    help = (
+        "Open simulated authenticated ChatConsumer connections across many rooms, replay a message workload "
+        "and report connect latency, delivery latency, throughput and memory per connection."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=1000, help="Number of websocket connections.")
+        parser.add_argument('--rooms', type=int, default=100, help="Rooms the connections are spread over.")
+        parser.add_argument('--senders', type=int, default=1, help="Connections sending messages in every room.")
+        parser.add_argument('--messages', type=int, default=10, help="Messages sent by every sender.")
+        parser.add_argument('--interval', type=float, default=0.0,
+                            help="Seconds between two messages of a sender, 0 to send as fast as possible.")
+        parser.add_argument('--message-size', type=int, default=64, help="Approximate message length.")
+        parser.add_argument('--protocol', choices=('v1',) + SUBPROTOCOLS, default='v1',
+                            help="Wire protocol the clients negotiate.")
+        parser.add_argument('--backend', choices=('memory', 'redis'), default='memory',
+                            help="memory: in-memory channel layer and fakeredis, "
+                                 "redis: the configured channel layer and redis server.")
+        parser.add_argument('--rate-limits', action='store_true',
+                            help="Keep CHAT_RATE_LIMITS, which are disabled by default.")
+        parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for deliveries.")
+
+    def handle(self, *args, **options):
+        if options['connections'] < 1 or options['rooms'] < 1:
+            raise CommandError("--connections and --rooms must be positive.")
+        options['rooms'] = min(options['rooms'], options['connections'])
+        run_id = uuid.uuid4().hex[:8]
+
+        users, rooms = self.create_fixtures(run_id, options['connections'], options['rooms'])
+        try:
+            limits = {} if options['rate_limits'] else {'CHAT_RATE_LIMITS': {}}
+            with override_settings(**limits):
+                # thread sensitive ORM calls of the consumers run in this thread, with its connection
+                report = async_to_sync(self.run)(run_id, users, rooms, options)
+        finally:
+            User.objects.filter(username__startswith=f'bench_{run_id}_').delete()
+            Room.objects.filter(id__in=[room.id for room in rooms]).delete()
+        self.print_report(report)
+
+    def create_fixtures(self, run_id, connections, room_count):
+        users = User.objects.bulk_create([
+            User(username=f'bench_{run_id}_{i}', first_name='Bench', last_name=str(i), password='!')
+            for i in range(connections)
+        ])
+        if users[0].pk is None:
+            # backends that don't return ids from bulk_create
+            users = list(User.objects.filter(username__startswith=f'bench_{run_id}_').order_by('id'))
+        rooms = [Room.objects.create() for _ in range(room_count)]
+        Room.participants.through.objects.bulk_create([
+            Room.participants.through(room_id=rooms[i % room_count].id, user_id=user.id)
+            for i, user in enumerate(users)
+        ])
+        return users, rooms
+
+    async def run(self, run_id, users, rooms, options):
+        fake_redis = None
+        if options['backend'] == 'memory':
+            try:
+                import fakeredis
+            except ImportError:
+                raise CommandError("The memory backend needs fakeredis with Lua support: pip install 'fakeredis[lua]'")
+            fake_redis = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+            use_redis(fake_redis)
+            previous_layer = channel_layers.backends.get(DEFAULT_CHANNEL_LAYER)
+            channel_layers.set(DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer())
+
+        stats = Stats(run_id)
+        clients = [Client(user, rooms[i % len(rooms)].id, options['protocol']) for i, user in enumerate(users)]
+        try:
+            report = await self.measure(clients, stats, options)
+        finally:
+            await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+            if fake_redis is None:
+                await self.clean_redis(clients)
+            else:
+                if previous_layer is None:
+                    channel_layers.backends.pop(DEFAULT_CHANNEL_LAYER, None)
+                else:
+                    channel_layers.set(DEFAULT_CHANNEL_LAYER, previous_layer)
+            await close_redis()
+        return report
+
+    async def measure(self, clients, stats, options):
+        gc.collect()
+        rss_before = current_rss()
+        connect_start = time.perf_counter()
+        connect_times = await asyncio.gather(*(client.connect(options['timeout']) for client in clients))
+        connect_elapsed = time.perf_counter() - connect_start
+        connected = [client for client in clients if client.connected]
+        gc.collect()
+        memory_per_connection = (current_rss() - rss_before) / max(len(connected), 1)
+
+        for client in connected:
+            # the history page sent on connect
+            await client.communicator.receive_output(options['timeout'])
+            client.start_reading(stats)
+
+        room_members = {}
+        for client in connected:
+            room_members.setdefault(client.room_id, []).append(client)
+        senders = [client for members in room_members.values() for client in members[:options['senders']]]
+        stats.expected = sum(
+            len(room_members[sender.room_id]) for sender in senders
+        ) * options['messages']
+
+        padding = 'x' * max(options['message_size'] - 32, 0)
+
+        async def send_messages(sender):
+            for _ in range(options['messages']):
+                await sender.send(f'{stats.run_id}:{time.perf_counter()}:{padding}')
+                if options['interval']:
+                    await asyncio.sleep(options['interval'])
+                else:
+                    await asyncio.sleep(0)
+
+        send_start = time.perf_counter()
+        await asyncio.gather(*(send_messages(sender) for sender in senders))
+        if stats.expected:
+            try:
+                await asyncio.wait_for(stats.done.wait(), options['timeout'])
+            except asyncio.TimeoutError:
+                pass
+        elapsed = time.perf_counter() - send_start
+
+        return {
+            'connections': len(clients),
+            'connected': len(connected),
+            'rooms': len(room_members),
+            'connect_elapsed': connect_elapsed,
+            'connect_times': sorted(connect_times),
+            'memory_per_connection': memory_per_connection,
+            'sent': len(senders) * options['messages'],
+            'expected': stats.expected,
+            'received': stats.received,
+            'errors': stats.errors,
+            'elapsed': elapsed,
+            'latencies': sorted(stats.latencies),
+        }
+
+    async def clean_redis(self, clients):
+        """Delete every key the run wrote to the configured redis, the run's users and rooms are all new."""
+        room_ids = {client.room_id for client in clients}
+        shard_rooms = group_by_shard(room_ids)
+        pipes = ShardPipelines()
+        for shard, shard_room_ids in shard_rooms.items():
+            for room_id in shard_room_ids:
+                pipes[shard].lrange(history_key(room_id), 0, -1)
+        results = await pipes.execute()
+
+        pipes = ShardPipelines()
+        for shard, shard_room_ids in shard_rooms.items():
+            for room_id, messages in zip(shard_room_ids, results[shard]):
+                # the search postings only hold the messages still in the hot window
+                terms = {term for message in messages for term in get_terms(json.loads(message)['content'])}
+                pipes[shard].delete(
+                    history_key(room_id), history_offset_key(room_id), members_key(room_id),
+                    members_version_key(room_id), room_presence_key(room_id), indexed_position_key(room_id),
+                    bucket_key('message', 'room', room_id), *[term_key(room_id, term) for term in terms],
+                )
+                pipes[shard].srem(archive_rooms_key(), room_id)
+                pipes[shard].srem(index_rooms_key(), room_id)
+                pipes[shard].zrem(room_activity_key(), room_id)
+        for client in clients:
+            # users only write to the shard of their room
+            user_id = client.user.id
+            pipes.room(client.room_id).delete(
+                read_cursors_key(user_id), digest_marks_key(user_id), bucket_key('message', 'user', user_id),
+            )
+        pipes[0].zrem(presence_key(), *[client.user.id for client in clients])
+        await pipes.execute()
+
+    def print_report(self, report):
+        ms = 1000
+        connect_times = report['connect_times']
+        latencies = report['latencies']
+        elapsed = report['elapsed'] or 1e-9
+        lines = [
+            f"Connections:       {report['connected']}/{report['connections']} in {report['rooms']} rooms",
+            f"Connect time:      {report['connect_elapsed']:.2f}s "
+            f"(p50 {percentile(connect_times, 50) * ms:.1f}ms, p99 {percentile(connect_times, 99) * ms:.1f}ms)",
+            f"Memory:            {report['memory_per_connection'] / 1024:.1f} KiB per connection",
+            f"Messages sent:     {report['sent']} ({report['sent'] / elapsed:.0f}/s)",
+            f"Deliveries:        {report['received']}/{report['expected']} ({report['received'] / elapsed:.0f}/s)",
+            f"Delivery latency:  p50 {percentile(latencies, 50) * ms:.1f}ms, "
+            f"p99 {percentile(latencies, 99) * ms:.1f}ms, max {(latencies[-1] if latencies else 0) * ms:.1f}ms",
+            f"Error frames:      {report['errors']}",
+        ]
+        self.stdout.write('\n'.join(lines))
+        if report['received'] < report['expected'] or report['connected'] < report['connections']:
+            self.stderr.write("Some connections or deliveries did not complete before the timeout.")
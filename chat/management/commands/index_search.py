@@ -0,0 +1,35 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.redis_pool import close_redis, get_redis
+from chat.search import index_pending_rooms
+
+
+class Command(BaseCommand):
+    help = "Add the new messages of every room to the search index."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Index pending rooms once and exit.")
+        parser.add_argument('--interval', type=float, default=1, help="Seconds to wait between indexing runs.")
+        parser.add_argument('--batch-size', type=int, default=None, help="Messages indexed per round trip.")
+
+    def handle(self, *args, **options):
+        asyncio.run(self.index(options['once'], options['interval'], options['batch_size']))
+
+    async def index(self, once, interval, batch_size):
+        # every shard flags the rooms it holds
+        redis_clients = [get_redis(shard) for shard in range(len(settings.CHAT_REDIS['SHARDS']))]
+        try:
+            while True:
+                indexed = 0
+                for redis_client in redis_clients:
+                    indexed += await index_pending_rooms(redis_client, batch_size)
+                if indexed:
+                    self.stdout.write(f"Indexed {indexed} messages.")
+                if once:
+                    break
+                await asyncio.sleep(interval)
+        finally:
+            await close_redis()
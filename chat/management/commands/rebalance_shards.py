@@ -0,0 +1,139 @@
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from redis import Redis
+
+from chat.history import archive_rooms_key, history_key, history_offset_key, index_rooms_key, room_activity_key
+from chat.redis_pool import redis_key
+from chat.sharding import room_shard
+
+# room keys, by their name without the redis_key suffix
+HISTORY_KEY = re.compile(r'room_(\d+)_messages(_offset)?')
+CACHE_KEY = re.compile(r'room_(\d+)_(members|presence|indexed|term_.+)|ratelimit_\w+_room_(\d+)')
+READ_CURSORS_KEY = re.compile(r'user_(\d+)_read')
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the redis keys of every room to the shard it hashes to in REDIS_SHARDS. "
+        "Run it with the chat workers stopped, after adding a shard."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report what would move without changing anything.")
+
+    def handle(self, *args, **options):
+        # raw clients, DUMP payloads are binary
+        self.clients = [Redis.from_url(url) for url in settings.CHAT_REDIS['SHARDS']]
+        self.dry_run = options['dry_run']
+        totals = Counter()
+        for shard in range(len(self.clients)):
+            counts = self.rebalance_shard(shard)
+            totals.update(counts)
+            self.stdout.write(
+                f"Shard {shard}: moved the history of {counts['rooms']} rooms, {counts['cursors']} read cursors "
+                f"and {counts['indexed']} index entries, dropped {counts['dropped']} cached keys."
+            )
+        if totals['conflicts']:
+            self.stderr.write(f"{totals['conflicts']} rooms were left in place, see above.")
+
+    def rebalance_shard(self, shard):
+        client = self.clients[shard]
+        counts = Counter()
+        suffix = redis_key('')
+        history_rooms = set()
+        for key in client.scan_iter(count=1000):
+            name = key.decode()
+            if suffix:
+                if not name.endswith(suffix):
+                    continue
+                name = name[:-len(suffix)]
+            if match := HISTORY_KEY.fullmatch(name):
+                room_id = int(match.group(1))
+                if room_shard(room_id) != shard:
+                    history_rooms.add(room_id)
+            elif match := CACHE_KEY.fullmatch(name):
+                # members, presence, rate limit buckets and the search index are rebuilt on the new shard
+                room_id = int(match.group(1) or match.group(3))
+                if room_shard(room_id) != shard:
+                    if not self.dry_run:
+                        client.delete(key)
+                    counts['dropped'] += 1
+            elif READ_CURSORS_KEY.fullmatch(name):
+                counts['cursors'] += self.move_read_cursors(shard, key)
+
+        for room_id in sorted(history_rooms):
+            if self.move_history(shard, room_id):
+                counts['rooms'] += 1
+            else:
+                counts['conflicts'] += 1
+        counts['indexed'] += self.move_index_entries(shard)
+        return counts
+
+    def move_history(self, shard, room_id):
+        """Move the hot window and archive offset of a room together. Returns ``False`` on a conflict."""
+        source = self.clients[shard]
+        target_shard = room_shard(room_id)
+        target = self.clients[target_shard]
+        keys = [history_key(room_id), history_offset_key(room_id)]
+        if target.exists(*keys):
+            self.stderr.write(
+                f"Room {room_id} already has history on shard {target_shard}, left on shard {shard}."
+            )
+            return False
+        if self.dry_run:
+            return True
+        for key in keys:
+            payload = source.dump(key)
+            if payload is None:
+                continue
+            target.restore(key, max(source.pttl(key), 0), payload)
+        source.delete(*keys)
+        # its search index was dropped, the indexer rebuilds it from the start
+        target.sadd(index_rooms_key(), room_id)
+        return True
+
+    def move_read_cursors(self, shard, key):
+        """Move the cursors of the rooms other shards hold, keeping the highest. Returns how many moved."""
+        source = self.clients[shard]
+        moved = {}
+        for room_id, position in source.hgetall(key).items():
+            target_shard = room_shard(int(room_id))
+            if target_shard != shard:
+                moved.setdefault(target_shard, {})[room_id] = int(position)
+        if self.dry_run or not moved:
+            return sum(len(cursors) for cursors in moved.values())
+        for target_shard, cursors in moved.items():
+            target = self.clients[target_shard]
+            current = target.hmget(key, list(cursors))
+            target.hset(key, mapping={
+                room_id: max(position, int(existing or 0))
+                for (room_id, position), existing in zip(cursors.items(), current)
+            })
+            source.hdel(key, *cursors)
+        return sum(len(cursors) for cursors in moved.values())
+
+    def move_index_entries(self, shard):
+        """Move the archive flags and activity scores of the rooms other shards hold."""
+        source = self.clients[shard]
+        moved = 0
+        for room_id in source.smembers(archive_rooms_key()):
+            target_shard = room_shard(int(room_id))
+            if target_shard != shard:
+                if not self.dry_run:
+                    self.clients[target_shard].sadd(archive_rooms_key(), room_id)
+                    source.srem(archive_rooms_key(), room_id)
+                moved += 1
+        for room_id in source.smembers(index_rooms_key()):
+            if room_shard(int(room_id)) != shard and not self.dry_run:
+                source.srem(index_rooms_key(), room_id)
+        for room_id, score in source.zscan_iter(room_activity_key()):
+            target_shard = room_shard(int(room_id))
+            if target_shard != shard:
+                if not self.dry_run:
+                    self.clients[target_shard].zadd(room_activity_key(), {room_id: score}, gt=True)
+                    source.zrem(room_activity_key(), room_id)
+                moved += 1
+        return moved
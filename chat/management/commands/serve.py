@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.serving import Supervisor
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve ChatApp.asgi.application with Daphne from several worker processes sharing one socket. "
+        "SIGTERM drains the websockets and exits, SIGHUP restarts the workers one at a time."
+    )
+
+    def add_arguments(self, parser):
+        config = settings.CHAT_SERVE
+        parser.add_argument('--host', default='0.0.0.0', help="Interface to listen on.")
+        parser.add_argument('--port', type=int, default=8000, help="Port to listen on.")
+        parser.add_argument('--workers', type=int, default=config['WORKERS'], help="Number of worker processes.")
+        parser.add_argument('--drain-timeout', type=float, default=config['DRAIN_TIMEOUT'],
+                            help="Seconds a stopping worker waits for its websockets to close.")
+        parser.add_argument('--health-port', type=int, default=config['HEALTH_PORT'],
+                            help="Port serving the health of every worker as JSON, disabled by default.")
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be positive.")
+        config = settings.CHAT_SERVE
+        supervisor = Supervisor(
+            options['workers'],
+            options['host'],
+            options['port'],
+            drain_timeout=options['drain_timeout'],
+            heartbeat=config['HEARTBEAT'],
+            heartbeat_timeout=config['HEARTBEAT_TIMEOUT'],
+            health_port=options['health_port'],
+        )
+        self.stdout.write(f"Starting {options['workers']} workers on {options['host']}:{options['port']}.")
+        supervisor.run()
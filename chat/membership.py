@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from chat import metrics
+from chat.executor import database_sync_to_async
+from chat.models import Room
+from chat.redis_pool import get_room_redis, get_sync_room_redis, redis_key
+
+logger = logging.getLogger(__name__)
+
+# member of every cached set, so a loaded room without participants can be
+# told apart from a cache miss
+LOADED = '0'
+
+# room id -> (expiry, {user id: is member}), least recently used first
+_rooms = OrderedDict()
+# the event loop reads and reorders _rooms while the membership signals of
+# request threads update it
+_rooms_lock = threading.Lock()
+
+# Bumps the version of a room's members, then adds ARGV[4..ARGV[3] + 3] to its
+# loaded member set and removes the rest of ARGV from it. A set that isn't
+# loaded is left alone, it is read in full from the database on its next lookup.
+UPDATE_MEMBERS_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local added = tonumber(ARGV[3])
+for i = 4, #ARGV do
+    if i <= added + 3 then
+        redis.call('SADD', KEYS[1], ARGV[i])
+    else
+        redis.call('SREM', KEYS[1], ARGV[i])
+    end
+end
+return 1
+"""
+
+# Fills the member set with ARGV[3..] unless the version of the room's members
+# moved on from ARGV[1] since they were read from the database, in which case
+# they may be stale and the next lookup reads them again.
+FILL_MEMBERS_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+for i = 3, #ARGV, 1000 do
+    redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def members_key(room_id):
+    return redis_key(f'room_{room_id}_members')
+
+
+def members_version_key(room_id):
+    return redis_key(f'room_{room_id}_members_version')
+
+
+def _get_local(room_id, user_id):
+    with _rooms_lock:
+        entry = _rooms.get(room_id)
+        if entry is None:
+            return None
+        expires, members = entry
+        if expires < time.monotonic():
+            del _rooms[room_id]
+            return None
+        _rooms.move_to_end(room_id)
+        return members.get(user_id)
+
+
+def _set_local(room_id, user_id, is_member):
+    config = settings.CHAT_MEMBERSHIP_CACHE
+    with _rooms_lock:
+        entry = _rooms.get(room_id)
+        if entry is None:
+            entry = _rooms[room_id] = (time.monotonic() + config['LOCAL_TTL'], {})
+        entry[1][user_id] = is_member
+        _rooms.move_to_end(room_id)
+        while len(_rooms) > config['SIZE']:
+            _rooms.popitem(last=False)
+
+
+def load_room_members(room_id):
+    """The ids of the members of a room, or ``None`` when the room doesn't exist."""
+    member_ids = set(Room.participants.through.objects.filter(room_id=room_id).values_list('user_id', flat=True))
+    if not member_ids and not Room.objects.filter(id=room_id).exists():
+        return None
+    return member_ids
+
+
+async def cache_room_members(redis_client, room_id):
+    """
+    Load the members of a room from the database into its redis set. Returns
+    their ids, or ``None`` when the room doesn't exist, which caches nothing:
+    any id a client makes up would otherwise get a set. The set is left
+    unloaded when its members change while they are read.
+    """
+    version = await redis_client.get(members_version_key(room_id))
+    member_ids = await database_sync_to_async(load_room_members)(room_id)
+    if member_ids is None:
+        return None
+    await redis_client.register_script(FILL_MEMBERS_SCRIPT)(
+        keys=[members_key(room_id), members_version_key(room_id)],
+        args=[version or '', settings.CHAT_MEMBERSHIP_CACHE['REDIS_TTL'], LOADED, *member_ids],
+    )
+    return member_ids
+
+
+async def is_room_member(room_id, user_id):
+    """
+    Whether the room exists and the user is one of its participants.
+
+    Answers come from a short-lived in-process LRU, then from the room's member
+    set in redis, and only hit the database when neither knows the room. Rooms
+    that don't exist are never cached.
+    """
+    is_member = _get_local(room_id, user_id)
+    if is_member is not None:
+        return is_member
+
+    redis_client = get_room_redis(room_id)
+    with metrics.redis_latency.time('membership'):
+        loaded, is_member = await redis_client.smismember(members_key(room_id), [LOADED, user_id])
+    if not loaded:
+        member_ids = await cache_room_members(redis_client, room_id)
+        if member_ids is None:
+            return False
+        is_member = user_id in member_ids
+
+    is_member = bool(is_member)
+    _set_local(room_id, user_id, is_member)
+    return is_member
+
+
+def update_local(room_id, added=(), removed=()):
+    """Apply membership changes to the local answers about a room, if it has any."""
+    with _rooms_lock:
+        entry = _rooms.get(room_id)
+        if entry is None:
+            return
+        for user_id in added:
+            entry[1][user_id] = True
+        for user_id in removed:
+            entry[1][user_id] = False
+
+
+def update_room_members(room_id, added=(), removed=()):
+    """
+    Apply membership changes to the cached members of a room in place, so
+    that a join or leave doesn't make a large room reload every member. Other
+    processes keep their local answers until ``LOCAL_TTL`` runs out.
+    """
+    added, removed = list(added), list(removed)
+    update_local(room_id, added, removed)
+    try:
+        redis_client = get_sync_room_redis(room_id)
+        redis_client.register_script(UPDATE_MEMBERS_SCRIPT)(
+            keys=[members_key(room_id), members_version_key(room_id)],
+            args=[LOADED, settings.CHAT_MEMBERSHIP_CACHE['REDIS_TTL'], len(added), *added, *removed],
+        )
+    except Exception as e:
+        logger.error("Error during membership cache update: %s", e,
+                     extra={'event': 'membership_update_failed', 'room_id': room_id})
+
+
+def invalidate_room(room_id):
+    """
+    Drop the cached members of a room and bump their version, so that a load
+    already under way doesn't put them back. Other processes keep their local
+    answers until ``LOCAL_TTL`` runs out.
+    """
+    with _rooms_lock:
+        _rooms.pop(room_id, None)
+    try:
+        with get_sync_room_redis(room_id).pipeline(transaction=True) as pipe:
+            pipe.delete(members_key(room_id))
+            pipe.incr(members_version_key(room_id))
+            pipe.expire(members_version_key(room_id), settings.CHAT_MEMBERSHIP_CACHE['REDIS_TTL'])
+            pipe.execute()
+    except Exception as e:
+        logger.error("Error during membership cache invalidation: %s", e,
+                     extra={'event': 'membership_invalidation_failed', 'room_id': room_id})
@@ -0,0 +1,208 @@
+import copy
+import time
+
+from django.conf import settings
+
+# metrics are only recorded when enabled, otherwise every update returns
+# right away and the timers don't read the clock
+ENABLED = settings.CHAT_METRICS['ENABLED']
+
+# latency buckets in seconds, from a local redis call to a slow broadcast
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+SIZE_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base of the in-process metrics, rendered in the Prometheus text format.
+    Series are keyed by their label values, passed positionally in the order
+    of ``labelnames``. Metrics are per process and updated from the event loop.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        _registry.append(self)
+
+    def remove(self, *labels):
+        self.series.pop(labels, None)
+
+    def clear(self):
+        self.series.clear()
+
+    def samples(self, series, extra=()):
+        for labels, value in series.items():
+            yield self.name, _format_labels(self.labelnames, labels, extra), value
+
+    def render(self, snapshots=None):
+        """The series of this process, or those of every worker in ``snapshots``, see :func:`render_workers`."""
+        if snapshots is None:
+            sources = [(self.series, ())]
+        else:
+            sources = [(snapshot.get(self.name, {}), (('worker', worker),)) for worker, snapshot in snapshots.items()]
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for series, extra in sources:
+            lines += [f'{name}{labels} {_format_value(value)}' for name, labels, value in self.samples(series, extra)]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not ENABLED:
+            return
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        if not ENABLED:
+            return
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        if not ENABLED:
+            return
+        value = self.series.get(labels, 0) - amount
+        if value:
+            self.series[labels] = value
+        else:
+            # labels such as room ids come and go, don't keep their series around at zero
+            self.series.pop(labels, None)
+
+    def set(self, *labels, value):
+        if not ENABLED:
+            return
+        self.series[labels] = value
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *labels):
+        if not ENABLED:
+            return
+        series = self.series.get(labels)
+        if series is None:
+            # [count per bucket..., sum]
+            series = self.series[labels] = [0] * len(self.buckets) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-1] += value
+
+    def time(self, *labels):
+        """Context manager observing the time spent in its block."""
+        if not ENABLED:
+            return _null_timer
+        return _Timer(self, labels)
+
+    def samples(self, series, extra=()):
+        for labels, counts in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = (('le', _format_value(bound)),)
+                yield f'{self.name}_bucket', _format_labels(self.labelnames, labels, extra + le), cumulative
+            yield f'{self.name}_sum', _format_labels(self.labelnames, labels, extra), counts[-1]
+            yield f'{self.name}_count', _format_labels(self.labelnames, labels, extra), cumulative
+
+
+def render():
+    """Every metric of the process in the Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+def snapshot():
+    """The series of every metric of the process, for another process to render with :func:`render_workers`."""
+    return {metric.name: {labels: copy.copy(value) for labels, value in metric.series.items()} for metric in _registry}
+
+
+def render_workers(snapshots):
+    """
+    Every metric of the worker processes of ``manage.py serve``, given as
+    ``{worker: snapshot}``, in one exposition with a ``worker`` label.
+    """
+    return '\n'.join(metric.render(snapshots) for metric in _registry) + '\n'
+
+
+active_connections = Gauge('chat_active_connections', "Open websocket connections per room.", ['room'])
+connects = Counter('chat_connects_total', "Websocket connection attempts by outcome.", ['result'])
+disconnects = Counter('chat_disconnects_total', "Closed websocket connections that had been accepted.")
+broadcast_latency = Histogram(
+    'chat_broadcast_latency_seconds', "Time from receiving a message to handing it to the channel layer."
+)
+redis_latency = Histogram('chat_redis_latency_seconds', "Latency of redis calls per operation.", ['operation'])
+rate_limited = Counter('chat_rate_limited_total', "Actions rejected by the rate limiter.", ['action'])
+history_replay_messages = Histogram(
+    'chat_history_replay_messages', "Messages sent per history page.", buckets=SIZE_BUCKETS
+)
+history_replay_latency = Histogram('chat_history_replay_seconds', "Time to load and send a history page.")
+redis_pool_connections = Gauge('chat_redis_pool_connections', "Connections of the redis pools by state.", ['state'])
+redis_pool_wait = Gauge('chat_redis_pool_wait_seconds', "Total time spent waiting for a pooled redis connection.")
+outbound_queued_frames = Gauge('chat_outbound_queued_frames', "Frames waiting to be written to slow websockets.")
+outbound_overflows = Counter(
+    'chat_outbound_overflows_total', "Frames queued for a client whose outbound queue was full, by policy.", ['policy']
+)
+outbound_dropped_frames = Counter(
+    'chat_outbound_dropped_frames_total', "Frames dropped from full outbound queues, by reason.", ['reason']
+)
+outbound_disconnects = Counter('chat_outbound_disconnects_total', "Clients disconnected for reading too slowly.")
+db_executor_calls = Gauge('chat_db_executor_calls', "Database calls of the consumers waiting for or holding a thread.")
+db_executor_wait = Histogram('chat_db_executor_wait_seconds', "Time database calls waited for a thread.")
+thumbnail_latency = Histogram('chat_thumbnail_seconds', "Time to make the thumbnail of an image upload, by outcome.",
+                              ['result'])
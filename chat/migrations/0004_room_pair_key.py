@@ -0,0 +1,35 @@
+# Generated by Django 5.0.6 on 2026-10-18 20:12
+
+from django.db import migrations, models
+
+
+def set_pair_keys(apps, schema_editor):
+    Room = apps.get_model('chat', 'Room')
+    taken = set()
+    for room in Room.objects.prefetch_related('participants').order_by('id'):
+        participant_ids = sorted(user.id for user in room.participants.all())
+        if len(participant_ids) not in (1, 2):
+            continue
+        pair_key = f"{participant_ids[0]}:{participant_ids[-1]}"
+        # the oldest room of a pair wins, duplicates created by concurrent clicks keep no key
+        if pair_key in taken:
+            continue
+        taken.add(pair_key)
+        room.pair_key = pair_key
+        room.save(update_fields=['pair_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='pair_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(set_pair_keys, migrations.RunPython.noop),
+    ]
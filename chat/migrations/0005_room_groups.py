@@ -0,0 +1,28 @@
+# Generated by Django 5.0.6 on 2026-10-18 21:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_room_pair_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='is_group',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='is_public',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
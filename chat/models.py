@@ -1,16 +1,106 @@
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db import models, transaction
 
 User = get_user_model()
 
 
+class RoomManager(models.Manager):
+    def create_group(self, name, creator, member_ids=(), is_public=False):
+        """Create a group room of ``creator`` and the users of ``member_ids``, adding them in one query."""
+        with transaction.atomic():
+            room = self.create(name=name, is_group=True, is_public=is_public)
+            room.participants.add(creator.id, *member_ids)
+        return room
+
+    def join_group(self, room_id, user, max_members):
+        """
+        Add ``user`` to the public group ``room_id`` and return it, or ``None``
+        when it already has ``max_members``. The room is locked while its
+        participants are counted, so concurrent joins can't overfill it.
+        """
+        with transaction.atomic():
+            room = self.select_for_update().get(id=room_id, is_group=True, is_public=True)
+            if room.participants.count() >= max_members:
+                return None
+            room.participants.add(user)
+        return room
+
+    def get_or_create_direct(self, user, other_user):
+        """Return the 1:1 room of two users, creating it with its participants in one transaction."""
+        with transaction.atomic():
+            room, created = self.get_or_create(pair_key=Room.make_pair_key(user.id, other_user.id))
+            if created:
+                room.participants.add(user, other_user)
+        return room
+
+
 # Create your models here.
 class Room(models.Model):
     participants = models.ManyToManyField(User)
     created_at = models.DateTimeField(auto_now_add=True)
+    # "<lower user id>:<higher user id>" for 1:1 rooms
+    pair_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # group rooms have a name, and anyone may join the public ones
+    is_group = models.BooleanField(default=False)
+    name = models.CharField(max_length=100, blank=True)
+    is_public = models.BooleanField(default=False)
+
+    objects = RoomManager()
+
+    @staticmethod
+    def make_pair_key(user_id, other_user_id):
+        low, high = sorted((user_id, other_user_id))
+        return f"{low}:{high}"
 
     def __str__(self):
+        if self.is_group:
+            # groups can have thousands of participants
+            return f"Room: {self.name}"
         participant_names = ' - '.join(
             [f"{user.first_name} {user.last_name}" if user.first_name and user.last_name else user.username for user in
              self.participants.all()])
         return f"Room: ({participant_names})"
+
+
+class Message(models.Model):
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
+    sender = models.ForeignKey(User, on_delete=models.CASCADE)
+    seq = models.PositiveBigIntegerField()
+    content = models.TextField()
+    timestamp = models.DateTimeField()
+    # references of the message's attachments, as stored in its redis history entry
+    attachments = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        ordering = ['seq']
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='unique_message_seq_per_room'),
+        ]
+        indexes = [
+            # full-text search of the archived messages, PostgreSQL only, see chat.search.search_archive
+            GinIndex(SearchVector('content', config='simple'), name='message_content_search_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.sender}: {self.content[:50]}"
+
+
+class Attachment(models.Model):
+    """A file uploaded to a room. Messages reference it by id, its bytes stay in storage."""
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='attachments')
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE)
+    file = models.FileField(upload_to='attachments/%Y/%m/%d/')
+    # name of the file on the uploader's machine
+    name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    # set by the thumbnail workers for the uploads Pillow can read, with the original dimensions
+    thumbnail = models.FileField(upload_to='thumbnails/%Y/%m/%d/', blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.uploader}: {self.name}"
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+from collections import deque
+
+from chat import metrics
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# scope extension under which ``manage.py serve`` hands consumers the TransportProducer of their websocket
+TRANSPORT_EXTENSION = 'chat.transport'
+
+
+class TransportProducer:
+    """
+    Twisted push producer registered on the transport of one websocket.
+    Twisted pauses it once more than the transport's ``bufferSize`` bytes
+    wait to be written to the socket, and resumes it once they are written,
+    so :meth:`wait_writable` returns once the client has caught up.
+
+    Daphne's ASGI ``send`` only appends to that buffer, it never waits.
+    """
+
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    @classmethod
+    def register(cls, transport):
+        producer = cls()
+        # the HTTP channel the websocket was upgraded from is still registered, it's done with the transport
+        if transport.producer is not None:
+            transport.unregisterProducer()
+        transport.registerProducer(producer, True)
+        return producer
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    def stopProducing(self):
+        # the connection is gone, the consumer stops on its disconnect
+        self.writable.set()
+
+    async def wait_writable(self):
+        await self.writable.wait()
+
+
+class OutboundQueue:
+    """
+    Bounded queue of the encoded frames waiting to be written to one websocket.
+
+    Frames are written in order by a writer task, so a client that reads
+    slowly only holds up its own queue, never the handlers that fill it. With
+    a ``transport`` (a :class:`TransportProducer`), the writer waits for the
+    transport to be writable before every frame, so that a stalled client
+    fills this queue instead of the transport's buffer. When ``max_frames``
+    are waiting, the ``policy`` decides what gives:
+
+    - ``drop_oldest``: the oldest waiting frame with a ``key`` is dropped
+    - ``coalesce``: only the latest waiting frame of every ``key`` is kept
+      (typing updates supersede the previous ones); the oldest
+      frame with a ``key`` is dropped when that doesn't make room
+    - ``disconnect``: nothing is dropped
+
+    Frames without a key may carry state the session counts on, as the
+    profiles of the compact protocol, so they are never dropped: when no
+    frame with a key is waiting, ``put`` returns ``False`` and the caller
+    closes the connection; the client reloads history on reconnect.
+    """
+
+    def __init__(self, send, max_frames, policy, transport=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbound policy {policy!r}, expected one of {', '.join(POLICIES)}.")
+        self.send = send
+        self.max_frames = max_frames
+        self.policy = policy
+        self.transport = transport
+        # (key, data) waiting to be written
+        self.frames = deque()
+        self.closed = False
+        self.ready = asyncio.Event()
+        self.writer = asyncio.create_task(self.write())
+
+    def put(self, data, key=None):
+        """Queue a frame. Returns ``False`` when the client is too slow and must be disconnected."""
+        if self.closed:
+            return True
+        if len(self.frames) >= self.max_frames:
+            metrics.outbound_overflows.inc(self.policy)
+            if self.policy == DISCONNECT:
+                return False
+            if self.policy == COALESCE:
+                self.coalesce()
+            if len(self.frames) >= self.max_frames and not self.drop_oldest_keyed():
+                return False
+        self.frames.append((key, data))
+        metrics.outbound_queued_frames.inc()
+        self.ready.set()
+        return True
+
+    def coalesce(self):
+        latest = set()
+        kept = deque()
+        for key, data in reversed(self.frames):
+            if key is not None and key in latest:
+                metrics.outbound_dropped_frames.inc('coalesced')
+                metrics.outbound_queued_frames.dec()
+                continue
+            latest.add(key)
+            kept.appendleft((key, data))
+        self.frames = kept
+
+    def drop_oldest_keyed(self):
+        for index, (key, _) in enumerate(self.frames):
+            if key is not None:
+                del self.frames[index]
+                metrics.outbound_dropped_frames.inc('dropped')
+                metrics.outbound_queued_frames.dec()
+                return True
+        return False
+
+    async def write(self):
+        try:
+            while True:
+                await self.ready.wait()
+                while self.frames:
+                    if self.transport is not None:
+                        await self.transport.wait_writable()
+                    _, data = self.frames.popleft()
+                    metrics.outbound_queued_frames.dec()
+                    await self.send(data)
+                self.ready.clear()
+        except Exception as e:
+            logger.error("Error during sending queued frames: %s", e)
+
+    async def close(self):
+        """Stop writing and drop the waiting frames."""
+        self.closed = True
+        self.writer.cancel()
+        try:
+            await self.writer
+        except asyncio.CancelledError:
+            pass
+        metrics.outbound_queued_frames.dec(amount=len(self.frames))
+        self.frames.clear()
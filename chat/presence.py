@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+import weakref
+
+from django.conf import settings
+
+from chat.protocol import new_broadcast_id
+from chat.redis_pool import ShardPipelines, get_room_redis, get_sync_redis, redis_key
+from chat.rooms import room_group_name
+from chat.sharding import group_by_shard, room_shard
+
+logger = logging.getLogger(__name__)
+
+# one tracker per event loop, like the redis clients
+_trackers = weakref.WeakKeyDictionary()
+
+
+def room_presence_key(room_id):
+    # "<user id>:<channel name>" of every connection to the room -> unix time its heartbeat expires
+    return redis_key(f'room_{room_id}_presence')
+
+
+def presence_key():
+    # user id -> unix time the heartbeat of their latest connection expires, on the first shard
+    return redis_key('presence')
+
+
+class PresenceTracker:
+    """
+    Presence and typing state of the websocket connections of one event loop.
+
+    Connections are written to redis as they join and leave, and their
+    heartbeats are refreshed all together, in one pipeline per shard, every
+    ``HEARTBEAT`` seconds; a connection whose process died drops out once its
+    heartbeat expires after ``TTL`` seconds. Presence changes and typing users
+    are collected per room and broadcast at most once per ``FLUSH_INTERVAL``,
+    however many connections caused them.
+
+    Connections get the room's online users once, from :meth:`join`; the
+    broadcasts only carry the users who came online or went offline since the
+    previous flush of this process, so their size doesn't grow with the room.
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        # room id -> {channel name: user id}
+        self.rooms = {}
+        self.changed_rooms = set()
+        # room id -> user ids online at the last flush, for the rooms with connections here
+        self.online = {}
+        # room id -> user ids that typed since the last flush
+        self.typing = {}
+        self.task = None
+        self.last_heartbeat = time.monotonic()
+
+    async def join(self, room_id, user_id, channel_name):
+        """Add a connection to the room, and return the ids of the room's online users."""
+        self.rooms.setdefault(room_id, {})[channel_name] = user_id
+        ttl = settings.CHAT_PRESENCE['TTL']
+        now = time.time()
+        expires = now + ttl
+        member = f'{user_id}:{channel_name}'
+        pipes = ShardPipelines()
+        pipes.room(room_id).zadd(room_presence_key(room_id), {member: expires})
+        pipes.room(room_id).expire(room_presence_key(room_id), ttl)
+        pipes.room(room_id).zrangebyscore(room_presence_key(room_id), now, '+inf')
+        pipes[0].zadd(presence_key(), {user_id: expires}, gt=True)
+        results = await pipes.execute()
+        members = results[room_shard(room_id)][2]
+        if room_id not in self.online:
+            # the next flush announces this user, unless another connection already made them online
+            self.online[room_id] = online_user_ids(m for m in members if m != member)
+        self.room_changed(room_id)
+        return sorted(online_user_ids(members))
+
+    async def leave(self, room_id, channel_name):
+        connections = self.rooms.get(room_id, {})
+        user_id = connections.pop(channel_name, None)
+        if user_id is None:
+            return
+        if not connections:
+            del self.rooms[room_id]
+        # the user stays online elsewhere until the heartbeat of this connection expires
+        await get_room_redis(room_id).zrem(room_presence_key(room_id), f'{user_id}:{channel_name}')
+        self.room_changed(room_id)
+
+    def user_typing(self, room_id, user_id):
+        self.typing.setdefault(room_id, set()).add(user_id)
+        self.schedule()
+
+    def room_changed(self, room_id):
+        self.changed_rooms.add(room_id)
+        self.schedule()
+
+    def schedule(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        config = settings.CHAT_PRESENCE
+        while self.rooms or self.changed_rooms or self.typing:
+            await asyncio.sleep(config['FLUSH_INTERVAL'])
+            try:
+                if time.monotonic() - self.last_heartbeat >= config['HEARTBEAT']:
+                    await self.heartbeat()
+                await self.flush()
+            except Exception as e:
+                logger.error("Error during presence update: %s", e)
+
+    async def heartbeat(self):
+        self.last_heartbeat = time.monotonic()
+        ttl = settings.CHAT_PRESENCE['TTL']
+        now = time.time()
+        expires = now + ttl
+        user_ids = set()
+        pipes = ShardPipelines()
+        for room_id, connections in self.rooms.items():
+            key = room_presence_key(room_id)
+            pipe = pipes.room(room_id)
+            pipe.zadd(key, {f'{user_id}:{channel_name}': expires for channel_name, user_id in connections.items()})
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.expire(key, ttl)
+            user_ids.update(connections.values())
+        if user_ids:
+            pipes[0].zadd(presence_key(), dict.fromkeys(user_ids, expires), gt=True)
+        pipes[0].zremrangebyscore(presence_key(), '-inf', now)
+        await pipes.execute()
+
+    async def flush(self):
+        changed_rooms, self.changed_rooms = list(self.changed_rooms), set()
+        typing, self.typing = self.typing, {}
+        if changed_rooms:
+            now = time.time()
+            shard_rooms = group_by_shard(changed_rooms)
+            pipes = ShardPipelines()
+            for shard, room_ids in shard_rooms.items():
+                for room_id in room_ids:
+                    pipes[shard].zrangebyscore(room_presence_key(room_id), now, '+inf')
+            results = await pipes.execute()
+            for shard, room_ids in shard_rooms.items():
+                for room_id, members in zip(room_ids, results[shard]):
+                    online = online_user_ids(members)
+                    previous = self.online.pop(room_id, set())
+                    if room_id in self.rooms:
+                        self.online[room_id] = online
+                    # other processes may have announced some of these already, applying them twice is harmless
+                    joined, left = sorted(online - previous), sorted(previous - online)
+                    if not joined and not left:
+                        continue
+                    await self.channel_layer.group_send(room_group_name(room_id), {
+                        'type': 'chat_presence',
+                        'broadcast_id': new_broadcast_id(),
+                        'joined': joined,
+                        'left': left,
+                    })
+        for room_id, user_ids in typing.items():
+            await self.channel_layer.group_send(room_group_name(room_id), {
+                'type': 'chat_typing',
+                'broadcast_id': new_broadcast_id(),
+                'user_ids': sorted(user_ids),
+            })
+
+
+def online_user_ids(members):
+    return {int(member.split(':', 1)[0]) for member in members}
+
+
+def get_presence_tracker(channel_layer):
+    loop = asyncio.get_running_loop()
+    tracker = _trackers.get(loop)
+    if tracker is None:
+        tracker = _trackers[loop] = PresenceTracker(channel_layer)
+    return tracker
+
+
+def get_online_user_ids(user_ids):
+    """The users among ``user_ids`` with a live connection, in one redis round trip."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    try:
+        scores = get_sync_redis().zmscore(presence_key(), user_ids)
+    except Exception as e:
+        logger.error("Error during presence lookup: %s", e, extra={'event': 'presence_lookup_failed'})
+        return set()
+    now = time.time()
+    return {user_id for user_id, expires in zip(user_ids, scores) if expires is not None and expires > now}
@@ -0,0 +1,139 @@
+import asyncio
+import cProfile
+import functools
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+# nothing is profiled unless enabled, otherwise the middleware removes itself
+# and the consumer handlers only check this flag
+ENABLED = settings.CHAT_PROFILING['ENABLED']
+
+# cProfile hooks the whole thread, so only one profile runs at a time in a process
+_lock = threading.Lock()
+_counter = itertools.count()
+
+
+def wants_profile(header_value):
+    """Whether a request is sampled, or asked for a profile with the configured header and token."""
+    config = settings.CHAT_PROFILING
+    if config['TOKEN'] and header_value == config['TOKEN']:
+        return True
+    return random.random() < config['SAMPLE_RATE']
+
+
+def start_profile():
+    """Start and return a profiler, or ``None`` when another profile is already running."""
+    if not _lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except Exception:
+        _lock.release()
+        raise
+    return profiler
+
+
+def stop_profile(profiler):
+    profiler.disable()
+    _lock.release()
+
+
+def dump_profile(profiler, kind, name):
+    """Write the stats of a stopped profiler to ``CHAT_PROFILING['DIRECTORY']`` and return the file path."""
+    directory = settings.CHAT_PROFILING['DIRECTORY']
+    os.makedirs(directory, exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_') or 'root'
+    filename = f"{time.strftime('%Y%m%dT%H%M%S')}-{kind}-{slug}-{os.getpid()}-{next(_counter)}.prof"
+    path = os.path.join(directory, filename)
+    profiler.dump_stats(path)
+    return path
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a sample of the HTTP requests with cProfile, plus the requests
+    carrying the profiling header, and writes one ``.prof`` file per request.
+
+    Like Django's own middleware it runs in whichever mode the rest of the
+    chain is in, so that async views aren't adapted to sync for it. Async
+    profiles cover the event loop thread while the request awaits.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.header = settings.CHAT_PROFILING['HEADER']
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not wants_profile(request.headers.get(self.header)):
+            return self.get_response(request)
+        profiler = start_profile()
+        if profiler is None:
+            return self.get_response(request)
+        try:
+            return self.get_response(request)
+        finally:
+            stop_profile(profiler)
+            dump_profile(profiler, 'http', f'{request.method} {request.path}')
+
+    async def __acall__(self, request):
+        if not wants_profile(request.headers.get(self.header)):
+            return await self.get_response(request)
+        profiler = start_profile()
+        if profiler is None:
+            return await self.get_response(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            stop_profile(profiler)
+            await asyncio.to_thread(dump_profile, profiler, 'http', f'{request.method} {request.path}')
+
+
+def profile_handler(handler):
+    """
+    Profile a sample of the calls of an async consumer handler, or every call
+    on connections whose handshake carried the profiling header.
+
+    The profile covers the event loop thread for the duration of the call, so
+    it includes the other tasks that run while the handler awaits.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(self, *args, **kwargs):
+        if not ENABLED:
+            return await handler(self, *args, **kwargs)
+        if not hasattr(self, 'profile_requested'):
+            header = settings.CHAT_PROFILING['HEADER'].lower().encode()
+            value = dict(self.scope.get('headers', [])).get(header, b'').decode('latin1')
+            token = settings.CHAT_PROFILING['TOKEN']
+            self.profile_requested = bool(token) and value == token
+        if not (self.profile_requested or wants_profile(None)):
+            return await handler(self, *args, **kwargs)
+        profiler = start_profile()
+        if profiler is None:
+            return await handler(self, *args, **kwargs)
+        try:
+            return await handler(self, *args, **kwargs)
+        finally:
+            stop_profile(profiler)
+            await asyncio.to_thread(dump_profile, profiler, 'ws', f'{type(self).__name__} {handler.__name__}')
+
+    return wrapper
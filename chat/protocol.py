@@ -0,0 +1,203 @@
+import json
+import uuid
+from collections import OrderedDict
+
+import msgpack
+
+# websocket subprotocols the client can ask for to get the compact protocol
+SUBPROTOCOLS = ('chat.v2.msgpack', 'chat.v2.json')
+
+# (broadcast id, protocol name) -> encoded frame of the latest broadcasts, oldest first
+_encoded = OrderedDict()
+ENCODED_BROADCASTS = 1024
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class LegacyProtocol:
+    """
+    Version 1, used when the client doesn't ask for a subprotocol: one JSON
+    object per frame, with the sender's names repeated in every message.
+    """
+
+    name = 'v1'
+    subprotocol = None
+    binary = False
+
+    def encode(self, frame):
+        return json.dumps(frame)
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+        except (TypeError, ValueError) as e:
+            raise ProtocolError(f"Invalid JSON frame: {e}") from e
+        if not isinstance(data, dict):
+            raise ProtocolError("Frames must be objects.")
+        return data
+
+    def message_frame(self, message):
+        return message
+
+    def profile_frames(self, message):
+        return []
+
+    def presence_frames(self, user_ids):
+        # version 1 clients render every frame with an id as a message, they
+        # don't get presence and typing updates
+        return []
+
+    def presence_change_frame(self, joined, left):
+        return None
+
+    def typing_frame(self, user_ids):
+        return None
+
+    def read_frame(self, positions):
+        return None
+
+    def history_frames(self, messages, cursor):
+        return [{'type': 'history', 'messages': messages, 'cursor': cursor}]
+
+    def digest_frames(self, entries):
+        return [{'type': 'digest', 'rooms': entries}]
+
+    def error_frames(self, error):
+        return [{'error': error}]
+
+
+class CompactProtocol(LegacyProtocol):
+    """
+    Version 2, encoded as JSON text or msgpack binary frames. Every frame is an
+    array tagged by its first item:
+
+    - ``['p', user_id, first_name, last_name]``: sender profile, sent once per
+      session before the first message that references it
+    - ``['m', id, user_id, message, timestamp]``: chat message, followed by
+      ``[[attachment_id, name, content_type, size], ...]`` when it has
+      attachments, as every message row below
+    - ``['h', cursor, [[id, user_id, message, timestamp], ...], [profile, ...]]``:
+      page of history with the profiles it introduces
+    - ``['o', [user_id, ...]]``: users online in the room, sent on connect
+    - ``['u', [user_id, ...], [user_id, ...]]``: users who came online and
+      went offline since, applied to the list of the ``'o'`` frame
+    - ``['t', [user_id, ...]]``: users who started typing since the last update
+    - ``['r', [[user_id, position], ...]]``: read receipts, every message
+      with an id below ``position`` was read by the user
+    - ``['d', [[room_id, unread, [id, user_id, message, timestamp]], ...], [profile, ...]]``:
+      rooms that got messages while the user was away, with their last
+      message (``null`` once archived) and the profiles it introduces
+    - ``['e', error]``: error
+
+    Client frames are objects, as in version 1.
+    """
+
+    def __init__(self, subprotocol):
+        self.name = subprotocol
+        self.subprotocol = subprotocol
+        self.binary = subprotocol.endswith('msgpack')
+        self.known_users = set()
+
+    def encode(self, frame):
+        if self.binary:
+            return msgpack.packb(frame)
+        return json.dumps(frame, separators=(',', ':'))
+
+    def decode(self, text_data=None, bytes_data=None):
+        if not self.binary:
+            return super().decode(text_data, bytes_data)
+        if bytes_data is None:
+            raise ProtocolError("Expected a binary frame.")
+        try:
+            data = msgpack.unpackb(bytes_data)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise ProtocolError(f"Invalid msgpack frame: {e}") from e
+        if not isinstance(data, dict):
+            raise ProtocolError("Frames must be maps.")
+        return data
+
+    def new_profiles(self, messages):
+        profiles = []
+        for message in messages:
+            if message['user_id'] not in self.known_users:
+                self.known_users.add(message['user_id'])
+                profiles.append([message['user_id'], message['user_first_name'], message['user_last_name']])
+        return profiles
+
+    def message_row(self, message):
+        row = [message['id'], message['user_id'], message['message'], message['timestamp']]
+        if message.get('attachments'):
+            row.append([
+                [attachment['id'], attachment['name'], attachment['content_type'], attachment['size']]
+                for attachment in message['attachments']
+            ])
+        return row
+
+    def message_frame(self, message):
+        return ['m', *self.message_row(message)]
+
+    def profile_frames(self, message):
+        return [['p', *profile] for profile in self.new_profiles([message])]
+
+    def presence_frames(self, user_ids):
+        return [['o', user_ids]]
+
+    def presence_change_frame(self, joined, left):
+        return ['u', joined, left]
+
+    def typing_frame(self, user_ids):
+        return ['t', user_ids]
+
+    def read_frame(self, positions):
+        return ['r', positions]
+
+    def history_frames(self, messages, cursor):
+        rows = [self.message_row(message) for message in messages]
+        return [['h', cursor, rows, self.new_profiles(messages)]]
+
+    def digest_frames(self, entries):
+        messages = [entry['message'] for entry in entries if entry['message']]
+        rows = [
+            [entry['room_id'], entry['unread'], entry['message'] and self.message_row(entry['message'])]
+            for entry in entries
+        ]
+        return [['d', rows, self.new_profiles(messages)]]
+
+    def error_frames(self, error):
+        return [['e', error]]
+
+
+def new_broadcast_id():
+    """Id of a group broadcast, under which its recipients share the encoded frames."""
+    return uuid.uuid4().hex
+
+
+def encode_broadcast(broadcast_id, protocol, build_frame):
+    """
+    Encode the frame ``build_frame`` makes of a group broadcast for
+    ``protocol``, or ``None`` when the protocol has no such frame.
+
+    Broadcasts travel the channel layer unencoded and are encoded here by
+    their recipients, so only the wire formats in use are encoded, once per
+    process: the other recipients speaking the same protocol get the same
+    bytes. Per-session frames, as profiles, must not go through here.
+    """
+    key = (broadcast_id, protocol.name)
+    if key in _encoded:
+        return _encoded[key]
+    frame = build_frame(protocol)
+    data = _encoded[key] = None if frame is None else protocol.encode(frame)
+    # recipients encode a broadcast as they receive it, the oldest ones are done with
+    while len(_encoded) > ENCODED_BROADCASTS:
+        _encoded.popitem(last=False)
+    return data
+
+
+def negotiate(subprotocols):
+    """Pick the protocol of the first subprotocol offered by the client that the server speaks."""
+    for subprotocol in subprotocols:
+        if subprotocol in SUBPROTOCOLS:
+            return CompactProtocol(subprotocol)
+    return LegacyProtocol()
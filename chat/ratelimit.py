@@ -0,0 +1,176 @@
+import time
+
+from django.conf import settings
+
+from chat import metrics
+from chat.redis_pool import redis_key
+
+# Lua helper shared by the scripts that rate limit. Token buckets are hashes
+# in KEYS[first_key..], with three ARGV per bucket starting at first_arg:
+# capacity, refill rate per second and the number of tokens wanted. It takes
+# up to the wanted tokens (at least one) from every bucket, or none at all, and
+# returns the tokens granted per bucket, or nil when a bucket is empty.
+TAKE_TOKENS_LUA = """
+local function take_tokens(first_key, first_arg)
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+    local buckets = {}
+    for i = first_key, #KEYS do
+        local arg = first_arg + (i - first_key) * 3
+        local capacity = tonumber(ARGV[arg])
+        local rate = tonumber(ARGV[arg + 1]) / 1000
+        local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+        local tokens = capacity
+        if state[1] then
+            tokens = math.min(capacity, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+        end
+        if tokens < 1 then
+            return nil
+        end
+        local wanted = math.min(tonumber(ARGV[arg + 2]), math.floor(tokens))
+        buckets[#buckets + 1] = {KEYS[i], capacity, rate, tokens - wanted, wanted}
+    end
+    local granted = {}
+    for _, bucket in ipairs(buckets) do
+        redis.call('HSET', bucket[1], 'tokens', tostring(bucket[4]), 'ts', now)
+        redis.call('PEXPIRE', bucket[1], math.ceil((bucket[2] - bucket[4]) / bucket[3]) + 1)
+        granted[#granted + 1] = bucket[5]
+    end
+    return granted
+end
+"""
+
+TAKE_SCRIPT = TAKE_TOKENS_LUA + """
+local granted = take_tokens(1, 1)
+if not granted then
+    return -1
+end
+return granted
+"""
+
+# tokens leased from redis buckets and not spent yet, shared by every
+# connection of the process: bucket key -> [tokens, lease expiry]
+_leases = {}
+
+
+def bucket_key(action, scope, identity):
+    return redis_key(f'ratelimit_{action}_{scope}_{identity}')
+
+
+class TokenBucket:
+    """In-process token bucket, for limits that only concern one connection."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """
+    Token bucket quotas for one action of one connection, configured per scope
+    in ``CHAT_RATE_LIMITS[action]``.
+
+    The ``connection`` scope is checked in process. The ``user``, ``room`` and
+    ``global`` scopes are shared through redis and checked atomically, either
+    on their own with :meth:`hit` or as part of another script through
+    :meth:`redis_keys` and :meth:`redis_args`. A scope with a ``lease`` takes
+    that many tokens at once while its bucket is well under quota; the spare
+    tokens are spent in process, and redis only checks the scopes that hold
+    no lease. Once every scope holds one the redis check is skipped entirely.
+    """
+
+    SHARED_SCOPES = ('user', 'room', 'global')
+
+    def __init__(self, action, user_id, room_id):
+        policies = settings.CHAT_RATE_LIMITS.get(action, {})
+        identities = {'user': user_id, 'room': room_id, 'global': 'all'}
+
+        connection_policy = policies.get('connection')
+        self.connection_bucket = (
+            TokenBucket(connection_policy['capacity'], connection_policy['rate']) if connection_policy else None
+        )
+        # keys of the buckets whose leased tokens the last action spent
+        self.spent_leases = []
+        self.buckets = [
+            (bucket_key(action, scope, identities[scope]), policies[scope])
+            for scope in self.SHARED_SCOPES
+            if policies.get(scope)
+        ]
+
+    def take_connection_token(self):
+        return self.connection_bucket is None or self.connection_bucket.take()
+
+    def take_leased_tokens(self):
+        """
+        Spend one leased token from every shared bucket that holds a live
+        lease. Returns the buckets holding none, whose tokens have to be taken
+        in redis.
+        """
+        now = time.monotonic()
+        self.spent_leases = []
+        unleased = []
+        for key, policy in self.buckets:
+            lease = _leases.get(key)
+            if lease and lease[0] > 0 and lease[1] > now:
+                lease[0] -= 1
+                self.spent_leases.append(key)
+            else:
+                unleased.append((key, policy))
+        return unleased
+
+    def refund_leased_tokens(self):
+        """Give back the leased tokens spent on an action that redis then rejected."""
+        for key in self.spent_leases:
+            lease = _leases.get(key)
+            if lease:
+                lease[0] += 1
+        self.spent_leases = []
+
+    def redis_keys(self, buckets=None):
+        return [key for key, _ in (self.buckets if buckets is None else buckets)]
+
+    def redis_args(self, buckets=None):
+        args = []
+        for _, policy in (self.buckets if buckets is None else buckets):
+            # only buckets with a lease take more than the token spent right away
+            args += [policy['capacity'], policy['rate'], policy.get('lease') or 1]
+        return args
+
+    def store_leases(self, granted, buckets=None):
+        """Add the tokens granted by redis beyond the one spent right away to the leases of their buckets."""
+        now = time.monotonic()
+        for (key, policy), tokens in zip(self.buckets if buckets is None else buckets, granted):
+            if tokens > 1:
+                lease = _leases.get(key)
+                spare = tokens - 1
+                if lease and lease[1] > now:
+                    spare += lease[0]
+                # a lease is only good for as long as the bucket takes to earn it back
+                _leases[key] = [spare, now + spare / policy['rate']]
+
+    async def hit(self, redis_client):
+        """Take one token from every scope. Returns whether the action is allowed."""
+        if not self.take_connection_token():
+            return False
+        buckets = self.take_leased_tokens()
+        if not buckets:
+            return True
+        take = redis_client.register_script(TAKE_SCRIPT)
+        with metrics.redis_latency.time('ratelimit'):
+            granted = await take(keys=self.redis_keys(buckets), args=self.redis_args(buckets))
+        if granted == -1:
+            self.refund_leased_tokens()
+            return False
+        self.store_leases(granted, buckets)
+        return True
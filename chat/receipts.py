@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import weakref
+
+from django.conf import settings
+
+from chat.history import history_key, history_offset_key
+from chat.protocol import new_broadcast_id
+from chat.redis_pool import get_redis, get_sync_redis, redis_key
+from chat.rooms import room_group_name
+from chat.sharding import group_by_shard, room_shard
+
+logger = logging.getLogger(__name__)
+
+# Raises read cursors, never lowers them and never past the end of the room.
+# KEYS come in triples per cursor: the user's cursor hash, the room history
+# and its archive offset; ARGV in pairs: room id and position. Returns the
+# resulting cursors.
+ACK_SCRIPT = """
+local cursors = {}
+for i = 1, #KEYS, 3 do
+    local arg = (i - 1) / 3 * 2 + 1
+    local total = tonumber(redis.call('GET', KEYS[i + 2]) or '0') + redis.call('LLEN', KEYS[i + 1])
+    local position = math.min(tonumber(ARGV[arg + 1]), total)
+    local current = tonumber(redis.call('HGET', KEYS[i], ARGV[arg]) or '0')
+    if position > current then
+        redis.call('HSET', KEYS[i], ARGV[arg], position)
+        current = position
+    end
+    cursors[#cursors + 1] = current
+end
+return cursors
+"""
+
+# Unread messages of one user in every room of ARGV. KEYS[1] is the user's
+# cursor hash, followed by the history and archive offset of every room.
+UNREAD_SCRIPT = """
+local cursors = redis.call('HMGET', KEYS[1], unpack(ARGV))
+local counts = {}
+for i = 1, #ARGV do
+    local total = tonumber(redis.call('GET', KEYS[i * 2 + 1]) or '0') + redis.call('LLEN', KEYS[i * 2])
+    counts[i] = math.max(total - tonumber(cursors[i] or '0'), 0)
+end
+return counts
+"""
+
+# one batcher per event loop, like the redis clients
+_batchers = weakref.WeakKeyDictionary()
+
+
+def read_cursors_key(user_id):
+    # room id -> number of messages of the room the user has read, on every
+    # shard for the rooms it holds
+    return redis_key(f'user_{user_id}_read')
+
+
+class ReadCursorBatcher:
+    """
+    Collects the read acknowledgements of the connections of one event loop
+    and writes them every ``FLUSH_INTERVAL`` seconds in a single script call
+    per shard, keeping the highest position per user and room. The cursors
+    written are then broadcast to their rooms as read receipts, one event per
+    room.
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        # (user id, room id) -> position
+        self.pending = {}
+        self.task = None
+
+    def acknowledge(self, user_id, room_id, position):
+        key = (user_id, room_id)
+        if position > self.pending.get(key, 0):
+            self.pending[key] = position
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while self.pending:
+            await asyncio.sleep(settings.CHAT_READ_RECEIPTS['FLUSH_INTERVAL'])
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Error during read cursor update: %s", e)
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        shards = {}
+        for (user_id, room_id), position in pending.items():
+            shards.setdefault(room_shard(room_id), {})[user_id, room_id] = position
+        receipts = {}
+        for shard, shard_pending in shards.items():
+            keys = []
+            args = []
+            for (user_id, room_id), position in shard_pending.items():
+                keys += [read_cursors_key(user_id), history_key(room_id), history_offset_key(room_id)]
+                args += [room_id, position]
+            acknowledge = get_redis(shard).register_script(ACK_SCRIPT)
+            cursors = await acknowledge(keys=keys, args=args)
+            for (user_id, room_id), position in zip(shard_pending, cursors):
+                receipts.setdefault(room_id, []).append([user_id, position])
+        for room_id, positions in receipts.items():
+            await self.channel_layer.group_send(room_group_name(room_id), {
+                'type': 'chat_read',
+                'broadcast_id': new_broadcast_id(),
+                'positions': positions,
+            })
+
+
+def get_read_cursor_batcher(channel_layer):
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None:
+        batcher = _batchers[loop] = ReadCursorBatcher(channel_layer)
+    return batcher
+
+
+def get_unread_counts(user_id, room_ids):
+    """Unread messages of a user per room id, in one round trip per shard holding some of the rooms."""
+    counts = {}
+    try:
+        for shard, shard_room_ids in group_by_shard(room_ids).items():
+            keys = [read_cursors_key(user_id)]
+            for room_id in shard_room_ids:
+                keys += [history_key(room_id), history_offset_key(room_id)]
+            unread = get_sync_redis(shard).register_script(UNREAD_SCRIPT)
+            counts.update(zip(shard_room_ids, unread(keys=keys, args=shard_room_ids)))
+    except Exception as e:
+        logger.error("Error during unread counts lookup: %s", e,
+                     extra={'event': 'unread_counts_failed', 'user_id': user_id})
+        return {}
+    return counts
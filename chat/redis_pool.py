@@ -0,0 +1,162 @@
+import asyncio
+import sys
+import time
+import weakref
+
+import redis.asyncio as redis
+from django.conf import settings
+from redis import Redis as SyncRedis
+
+from chat import metrics
+from chat.sharding import room_shard
+
+# asyncio connections can't be shared across event loops, so there is one
+# client per loop and shard url. In production that is one per worker process
+# and shard.
+_clients = weakref.WeakKeyDictionary()
+_sync_clients = {}
+
+
+def redis_key(name):
+    if 'test' in sys.argv:
+        return f'{name}_test'
+    return name
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """Blocking connection pool that counts acquisitions and the time spent waiting for them."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquired = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    async def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        connection = await super().get_connection(command_name, *keys, **options)
+        waited = time.perf_counter() - start
+        self.acquired += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return connection
+
+    def stats(self):
+        return {
+            'max_connections': self.max_connections,
+            'connections': len(self._available_connections) + len(self._in_use_connections),
+            'in_use': len(self._in_use_connections),
+            'acquired': self.acquired,
+            'wait_time': self.wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+
+def get_redis(shard=0):
+    """
+    Return the shared redis client of the running event loop for a shard,
+    creating its pool on first use. Shard 0 also holds the keys that belong to
+    no room.
+    """
+    url = settings.CHAT_REDIS['SHARDS'][shard]
+    clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(url)
+    if client is None:
+        config = settings.CHAT_REDIS
+        pool = InstrumentedConnectionPool.from_url(
+            url,
+            max_connections=config['MAX_CONNECTIONS'],
+            timeout=config['POOL_TIMEOUT'],
+            decode_responses=True,
+        )
+        client = redis.Redis(connection_pool=pool)
+        clients[url] = client
+    return client
+
+
+def get_room_redis(room_id):
+    """Return the client of the shard that holds a room's keys."""
+    return get_redis(room_shard(room_id))
+
+
+def use_redis(client):
+    """Make ``client`` every shard's client on the running event loop, e.g. an in-memory stand-in for benchmarks."""
+    _clients[asyncio.get_running_loop()] = dict.fromkeys(settings.CHAT_REDIS['SHARDS'], client)
+
+
+def get_sync_redis(shard=0):
+    """Return the process-wide blocking client of a shard, for code outside the event loop (signals, views)."""
+    url = settings.CHAT_REDIS['SHARDS'][shard]
+    client = _sync_clients.get(url)
+    if client is None:
+        client = _sync_clients[url] = SyncRedis.from_url(
+            url,
+            max_connections=settings.CHAT_REDIS['MAX_CONNECTIONS'],
+            decode_responses=True,
+        )
+    return client
+
+
+def get_sync_room_redis(room_id):
+    return get_sync_redis(room_shard(room_id))
+
+
+class ShardPipelines(dict):
+    """
+    Shard index -> non-transactional pipeline of that shard's client, created
+    on first use, to send commands spanning shards in one round trip per shard.
+    """
+
+    def __missing__(self, shard):
+        pipe = self[shard] = get_redis(shard).pipeline(transaction=False)
+        return pipe
+
+    def room(self, room_id):
+        return self[room_shard(room_id)]
+
+    async def execute(self):
+        """Run every pipeline concurrently. Returns shard index -> results."""
+        results = await asyncio.gather(*(pipe.execute() for pipe in self.values()))
+        return dict(zip(self, results))
+
+
+async def close_redis():
+    clients = _clients.pop(asyncio.get_running_loop(), {})
+    for client in {id(client): client for client in clients.values()}.values():
+        await client.connection_pool.disconnect()
+
+
+def redis_pool_stats():
+    """Pool counters summed over every event loop and shard of the process."""
+    totals = {
+        'pools': 0,
+        'max_connections': 0,
+        'connections': 0,
+        'in_use': 0,
+        'acquired': 0,
+        'wait_time': 0.0,
+        'max_wait_time': 0.0,
+    }
+    pools = {}
+    for clients in list(_clients.values()):
+        for client in clients.values():
+            pools[id(client.connection_pool)] = client.connection_pool
+    for pool in pools.values():
+        if not isinstance(pool, InstrumentedConnectionPool):
+            # a stand-in client from use_redis
+            continue
+        stats = pool.stats()
+        totals['pools'] += 1
+        for name in ('max_connections', 'connections', 'in_use', 'acquired', 'wait_time'):
+            totals[name] += stats[name]
+        totals['max_wait_time'] = max(totals['max_wait_time'], stats['max_wait_time'])
+    return totals
+
+
+def record_pool_metrics():
+    """Copy the pool counters to the pool gauges, before the metrics of the process are read."""
+    stats = redis_pool_stats()
+    metrics.redis_pool_connections.set('in_use', value=stats['in_use'])
+    metrics.redis_pool_connections.set('idle', value=stats['connections'] - stats['in_use'])
+    metrics.redis_pool_connections.set('max', value=stats['max_connections'])
+    metrics.redis_pool_wait.set(value=stats['wait_time'])
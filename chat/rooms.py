@@ -0,0 +1,65 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from chat.models import Room
+from chat.redis_pool import get_sync_redis, redis_key
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(room_id):
+    return f'chat_{room_id}'
+
+
+def group_room_id(group):
+    """The room id of a group named by :func:`room_group_name`, or ``None`` for any other group."""
+    prefix, _, room_id = group.partition('_')
+    if prefix != 'chat' or not room_id.isdigit():
+        return None
+    return int(room_id)
+
+
+def pair_cache_key(pair_key):
+    return redis_key(f'room_pair_{pair_key}')
+
+
+def get_direct_room_id(user, other_user):
+    """Id of the 1:1 room of two users, resolved from redis after the first lookup."""
+    cache_key = pair_cache_key(Room.make_pair_key(user.id, other_user.id))
+    try:
+        room_id = get_sync_redis().get(cache_key)
+        if room_id is not None:
+            return int(room_id)
+    except Exception as e:
+        logger.error("Error during room pair cache lookup: %s", e, extra={'event': 'pair_cache_lookup_failed'})
+
+    room = Room.objects.get_or_create_direct(user, other_user)
+    try:
+        get_sync_redis().set(cache_key, room.id, ex=settings.CHAT_ROOM_PAIR_CACHE_TTL)
+    except Exception as e:
+        logger.error("Error during room pair cache update: %s", e,
+                     extra={'event': 'pair_cache_update_failed', 'room_id': room.id})
+    return room.id
+
+
+def forget_direct_room(pair_key):
+    try:
+        get_sync_redis().delete(pair_cache_key(pair_key))
+    except Exception as e:
+        logger.error("Error during room pair cache invalidation: %s", e,
+                     extra={'event': 'pair_cache_invalidation_failed'})
+
+
+def disconnect_removed_members(room_id, user_ids):
+    """Close the connections of users removed from a room, in every process serving the room."""
+    try:
+        async_to_sync(get_channel_layer().group_send)(room_group_name(room_id), {
+            'type': 'chat_members_removed',
+            'user_ids': list(user_ids),
+        })
+    except Exception as e:
+        logger.error("Error during removed members disconnection: %s", e,
+                     extra={'event': 'members_disconnect_failed', 'room_id': room_id})
@@ -0,0 +1,264 @@
+import json
+import logging
+import re
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.core import signing
+from django.db import connection
+
+from chat import metrics
+from chat.history import (archived_message_to_frame, get_history_page, get_terms, history_key, history_offset_key,
+                          index_rooms_key, message_to_frame, term_key)
+from chat.models import Message, Room
+from chat.redis_pool import get_sync_redis, redis_key
+from chat.sharding import group_by_shard
+
+logger = logging.getLogger(__name__)
+
+CURSOR_SALT = 'chat.search'
+
+# words of a query past this many are ignored
+MAX_QUERY_TERMS = 8
+
+# what the full-text index of the archived messages covers on PostgreSQL, see Message.Meta.indexes
+CONTENT_VECTOR = SearchVector('content', config='simple')
+
+# Adds the messages of one batch that are still in the hot window to the
+# posting lists of the room, unless another indexer already did, then moves
+# the indexed position to ARGV[3]. KEYS[5..] are posting lists and ARGV[4..]
+# the message ids to add to them. The room leaves the pending set once every
+# message it holds is indexed.
+INDEX_SCRIPT = """
+if tonumber(redis.call('GET', KEYS[3]) or '0') ~= tonumber(ARGV[2]) then
+    return 0
+end
+local offset = tonumber(redis.call('GET', KEYS[2]) or '0')
+for i = 5, #KEYS do
+    local id = ARGV[i - 1]
+    if tonumber(id) >= offset then
+        redis.call('ZADD', KEYS[i], id, id)
+    end
+end
+redis.call('SET', KEYS[3], ARGV[3])
+local total = offset + redis.call('LLEN', KEYS[1])
+if total <= tonumber(ARGV[3]) then
+    redis.call('SREM', KEYS[4], ARGV[1])
+end
+return 1
+"""
+
+# Walks the shortest posting list of KEYS[3..] from the id before ARGV[1] (or
+# from the newest) down to the archive offset, keeping the ids every other
+# list holds, until ARGV[2] + 1 match or ARGV[3] ids were examined. Returns
+# the cursor of the next page (-1 once the hot window is done), the matching
+# ids, their messages and the archive offset.
+SEARCH_SCRIPT = """
+local offset = tonumber(redis.call('GET', KEYS[2]) or '0')
+local driver = 3
+local smallest = nil
+for i = 3, #KEYS do
+    local size = redis.call('ZCARD', KEYS[i])
+    if smallest == nil or size < smallest then
+        driver, smallest = i, size
+    end
+end
+local limit = tonumber(ARGV[2])
+local budget = tonumber(ARGV[3])
+local max = '+inf'
+if ARGV[1] ~= '' then
+    max = '(' .. ARGV[1]
+end
+local matches = {}
+local last = nil
+local exhausted = false
+while budget > 0 and #matches <= limit and not exhausted do
+    local ids = redis.call('ZREVRANGEBYSCORE', KEYS[driver], max, offset, 'LIMIT', 0, math.min(budget, 100))
+    exhausted = #ids < math.min(budget, 100)
+    for _, id in ipairs(ids) do
+        budget = budget - 1
+        last = id
+        local found = true
+        for i = 3, #KEYS do
+            if i ~= driver and not redis.call('ZSCORE', KEYS[i], id) then
+                found = false
+                break
+            end
+        end
+        if found then
+            matches[#matches + 1] = id
+            if #matches > limit then
+                break
+            end
+        end
+    end
+    if last then
+        max = '(' .. last
+    end
+end
+local cursor = -1
+if #matches > limit then
+    matches[#matches] = nil
+    cursor = matches[#matches]
+elseif not exhausted and last then
+    cursor = last
+end
+local messages = {}
+for i, id in ipairs(matches) do
+    messages[i] = redis.call('LINDEX', KEYS[1], tonumber(id) - offset)
+end
+return {cursor, matches, messages, offset}
+"""
+
+
+def indexed_position_key(room_id):
+    # id of the first message of the room that isn't indexed yet
+    return redis_key(f'room_{room_id}_indexed')
+
+
+async def index_room(redis_client, room_id, batch_size=None):
+    """
+    Index up to ``batch_size`` messages of the room's hot window, oldest
+    first. Returns the number indexed. Archived messages are searched in the
+    database, the indexer skips those it didn't get to in time.
+    """
+    batch_size = batch_size or settings.CHAT_SEARCH_INDEX_BATCH_SIZE
+    position, offset = await redis_client.mget(indexed_position_key(room_id), history_offset_key(room_id))
+    position = int(position or 0)
+    start = max(position, int(offset or 0))
+    messages, _ = await get_history_page(redis_client, room_id, before=start + batch_size, limit=batch_size)
+    messages = [message for message in messages if message['id'] >= start]
+
+    keys = [history_key(room_id), history_offset_key(room_id), indexed_position_key(room_id), index_rooms_key()]
+    args = [room_id, position, messages[-1]['id'] + 1 if messages else start]
+    for message in messages:
+        for term in get_terms(message['message']):
+            keys.append(term_key(room_id, term))
+            args.append(message['id'])
+
+    index = redis_client.register_script(INDEX_SCRIPT)
+    with metrics.redis_latency.time('search_index'):
+        indexed = await index(keys=keys, args=args)
+    return len(messages) if indexed else 0
+
+
+async def index_pending_rooms(redis_client, batch_size=None):
+    """Index the new messages of every flagged room. Returns the number of indexed messages."""
+    indexed = 0
+    for room_id in await redis_client.smembers(index_rooms_key()):
+        while True:
+            count = await index_room(redis_client, int(room_id), batch_size)
+            indexed += count
+            if not count:
+                break
+    return indexed
+
+
+def search_archive(room_id, terms, before, limit):
+    """
+    The archived messages of the room with an id below ``before`` holding
+    every word of ``terms``, newest first, at most ``limit`` of them. On
+    PostgreSQL this uses the full-text index of the messages.
+    """
+    messages = Message.objects.filter(room_id=room_id, seq__lt=before).select_related('sender')
+    if connection.vendor == 'postgresql':
+        messages = messages.annotate(search=CONTENT_VECTOR).filter(search=SearchQuery(' '.join(terms), config='simple'))
+    else:
+        for term in terms:
+            messages = messages.filter(content__iregex=rf'\b{re.escape(term)}\b')
+    return list(messages.order_by('-seq')[:limit])
+
+
+def search_messages(user, query, room_id=None, cursor=None, limit=None):
+    """
+    Return one page of the messages of ``user``'s rooms holding every word of
+    ``query``, newest first, and the cursor of the next page (``None`` on the
+    last page). ``room_id`` restricts the search to one of these rooms.
+
+    Each room's hot window is searched on its shard by walking the posting
+    list of its rarest word, at most ``CHAT_SEARCH_SCAN_LIMIT`` entries per
+    room and page, so a page costs the same however busy the room is. A page
+    can come back short while the cursor still points further. Once the hot
+    window is done, the room's archived messages are searched in the
+    database. Raises ``signing.BadSignature`` for a cursor that wasn't
+    issued to ``user``.
+    """
+    limit = limit or settings.CHAT_SEARCH_PAGE_SIZE
+    terms = get_terms(query)[:MAX_QUERY_TERMS]
+    if not terms:
+        return [], None
+
+    rooms = Room.objects.filter(participants=user)
+    if room_id is not None:
+        rooms = rooms.filter(id=room_id)
+    # room id -> id the room is searched before, None for its newest message
+    positions = dict.fromkeys(rooms.values_list('id', flat=True))
+    if cursor:
+        user_id, cursor_positions = signing.loads(cursor, salt=CURSOR_SALT)
+        if user_id != user.id:
+            raise signing.BadSignature("Cursor of another user.")
+        positions = {
+            int(room): position for room, position in cursor_positions.items() if int(room) in positions
+        }
+    if not positions:
+        return [], None
+
+    # one round trip per shard holding some of the rooms
+    results = {}
+    try:
+        with metrics.redis_latency.time('search'):
+            for shard, room_ids in group_by_shard(list(positions)).items():
+                redis_client = get_sync_redis(shard)
+                search = redis_client.register_script(SEARCH_SCRIPT)
+                with redis_client.pipeline(transaction=False) as pipe:
+                    for room in room_ids:
+                        search(
+                            keys=[history_key(room), history_offset_key(room)]
+                            + [term_key(room, term) for term in terms],
+                            args=['' if positions[room] is None else positions[room], limit,
+                                  settings.CHAT_SEARCH_SCAN_LIMIT],
+                            client=pipe,
+                        )
+                    results.update(zip(room_ids, pipe.execute()))
+    except Exception as e:
+        logger.error("Error during message search: %s", e, extra={'event': 'search_failed', 'user_id': user.id})
+        return [], None
+
+    # room id -> (cursor of its search, -1 once it is done, its matches newest first)
+    found = {}
+    for room, (room_cursor, ids, raw_messages, offset) in results.items():
+        room_cursor = int(room_cursor)
+        matches = [
+            dict(message_to_frame(int(message_id), json.loads(raw)), room_id=room)
+            for message_id, raw in zip(ids, raw_messages)
+        ]
+        if room_cursor == -1:
+            # the hot window is done, the search goes on in the archive
+            before = int(offset) if positions[room] is None else min(positions[room], int(offset))
+            wanted = limit - len(matches)
+            archived = search_archive(room, terms, before, wanted + 1)
+            if len(archived) > wanted:
+                archived = archived[:wanted]
+                room_cursor = archived[-1].seq if archived else matches[-1]['id']
+            matches += [dict(archived_message_to_frame(message), room_id=room) for message in archived]
+        found[room] = (room_cursor, matches)
+
+    messages = [message for _, matches in found.values() for message in matches]
+    messages.sort(key=lambda message: (message['timestamp'] or '', message['room_id'], message['id']), reverse=True)
+    page = messages[:limit]
+
+    # a room continues after its last message on the page, or after the
+    # cursor of its search once every match it returned made the page
+    taken = {}
+    for message in page:
+        taken[message['room_id']] = taken.get(message['room_id'], 0) + 1
+    next_positions = {}
+    for room, (room_cursor, matches) in found.items():
+        if taken.get(room, 0) < len(matches):
+            last = min((m['id'] for m in page if m['room_id'] == room), default=positions[room])
+            next_positions[room] = last
+        elif room_cursor != -1:
+            next_positions[room] = room_cursor
+
+    next_cursor = signing.dumps([user.id, next_positions], salt=CURSOR_SALT) if next_positions else None
+    return page, next_cursor
@@ -0,0 +1,316 @@
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# installs the asyncio reactor, before anything imports twisted's default one
+from daphne.server import Server
+from django.conf import settings
+from twisted.internet import reactor
+
+from chat import log, metrics, workers
+from chat.outbound import TRANSPORT_EXTENSION, TransportProducer
+
+logger = logging.getLogger(__name__)
+
+# seconds a stopping worker gets on top of the drain timeout before it is killed
+KILL_GRACE = 5
+
+
+class DrainingServer(Server):
+    """
+    Daphne server of one worker process. On SIGTERM or SIGINT it stops
+    accepting connections, closes the open websockets with
+    ``workers.RESTART_CLOSE_CODE`` and stops once they are gone or after
+    ``drain_timeout`` seconds.
+
+    Websocket consumers get the :class:`chat.outbound.TransportProducer` of
+    their connection, to stop writing while its transport's buffer is full.
+    """
+
+    def __init__(self, application, endpoints, drain_timeout, heartbeat, **kwargs):
+        super().__init__(application, endpoints=endpoints, signal_handlers=False, **kwargs)
+        self.drain_timeout = drain_timeout
+        self.heartbeat = heartbeat
+        self.ports = []
+        self.tasks = []
+        self.drain_task = None
+
+    def run(self):
+        reactor.callWhenRunning(self.started)
+        super().run()
+
+    def create_application(self, protocol, scope):
+        if scope['type'] == 'websocket':
+            # the consumers' sends only fill the transport's buffer, they wait on it through this
+            scope.setdefault('extensions', {})[TRANSPORT_EXTENSION] = TransportProducer.register(protocol.transport)
+        return super().create_application(protocol, scope)
+
+    def listen_success(self, port):
+        self.ports.append(port)
+        super().listen_success(port)
+
+    def started(self):
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.begin_drain)
+        self.tasks.append(loop.create_task(workers.heartbeat(self.heartbeat)))
+
+    def begin_drain(self):
+        if self.drain_task is None:
+            self.drain_task = asyncio.ensure_future(self.drain())
+
+    async def drain(self):
+        # the listening socket stays open in the other workers, they take the new connections
+        for port in self.ports:
+            port.stopListening()
+        try:
+            await workers.drain(self.drain_timeout)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.stop()
+
+
+def run_worker(slot, sock, shared_state, log_queue, metrics_queue, options):
+    """Entry point of a worker process: serves ``ChatApp.asgi.application`` on the inherited socket."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatApp.settings')
+    # SIGINT reaches the whole process group, the server handles it once the reactor runs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from ChatApp.asgi import application
+
+    # the supervisor writes the records of every worker, they would race to rotate the same files
+    log.forward_records(log_queue)
+    workers.attach(slot, shared_state, metrics_queue)
+    server = DrainingServer(
+        application,
+        endpoints=[f'fd:fileno={sock.fileno()}'],
+        drain_timeout=options['drain_timeout'],
+        heartbeat=options['heartbeat'],
+        server_name='chat',
+    )
+    try:
+        server.run()
+    finally:
+        # multiprocessing flushes and closes log_queue before the atexit hooks
+        # would stop the listeners, so hand it the last records now
+        for handler in log.queue_listener_handlers():
+            handler.stop()
+
+
+class Supervisor:
+    """
+    Runs ``count`` worker processes that share one listening socket, and
+    replaces those that exit or stop reporting their health.
+
+    - SIGTERM and SIGINT drain every worker, then exit.
+    - SIGHUP restarts the workers one at a time: a replacement is started and
+      once it reports healthy the old worker is drained.
+
+    Workers send their log records to the supervisor, which writes them. With
+    a ``health_port``, the health of every worker is served as JSON from that
+    port, with status 503 while any of them is unhealthy, and the metrics of
+    every worker from ``/metrics``, as each worker only has its own.
+    """
+
+    def __init__(self, count, host, port, drain_timeout, heartbeat, heartbeat_timeout, health_port=None):
+        self.count = count
+        self.host = host
+        self.port = port
+        self.drain_timeout = drain_timeout
+        self.heartbeat = heartbeat
+        self.heartbeat_timeout = heartbeat_timeout
+        self.health_port = health_port
+        self.context = multiprocessing.get_context('spawn')
+        # slot -> (process, shared state, start time)
+        self.workers = {}
+        # drained processes that have not exited yet -> time they must be gone by
+        self.retiring = {}
+        self.stop_requested = False
+        self.reload_requested = False
+        self.sock = None
+        self.health_server = None
+        self.log_queue = None
+        self.log_listener = None
+        # worker slot -> latest metrics snapshot of its current process
+        self.metrics_queue = None
+        self.metrics = {}
+
+    def run(self):
+        self.sock = socket.create_server((self.host, self.port), backlog=2048)
+        self.port = self.sock.getsockname()[1]
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        self.log_queue = self.context.Queue()
+        self.log_listener = log.collect_records(self.log_queue)
+        self.metrics_queue = self.context.Queue()
+        if self.health_port is not None:
+            self.start_health_server()
+        for slot in range(self.count):
+            self.workers[slot] = self.spawn(slot)
+        logger.info("Serving on %s:%s with %s workers.", self.host, self.port, self.count,
+                    extra={'event': 'serve', 'workers': self.count})
+        try:
+            while not self.stop_requested:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                self.check()
+                self.collect_metrics()
+                time.sleep(0.2)
+        finally:
+            self.shutdown()
+
+    def request_stop(self, signum, frame):
+        self.stop_requested = True
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def spawn(self, slot):
+        state = self.context.Array('d', 3, lock=False)
+        options = {'drain_timeout': self.drain_timeout, 'heartbeat': self.heartbeat}
+        process = self.context.Process(
+            target=run_worker, args=(slot, self.sock, state, self.log_queue, self.metrics_queue, options),
+            name=f'chat-worker-{slot}',
+        )
+        process.start()
+        return process, state, time.time()
+
+    def is_stale(self, state, started):
+        return time.time() - max(state[0], started) > self.heartbeat_timeout
+
+    def check(self):
+        for slot, (process, state, started) in list(self.workers.items()):
+            if not process.is_alive():
+                logger.error("Worker %s (pid %s) exited with code %s, restarting it.", slot, process.pid,
+                             process.exitcode, extra={'event': 'worker_exit', 'worker': slot})
+                self.workers[slot] = self.spawn(slot)
+            elif self.is_stale(state, started):
+                logger.error("Worker %s (pid %s) stopped reporting its health, restarting it.", slot, process.pid,
+                             extra={'event': 'worker_stale', 'worker': slot})
+                process.kill()
+                process.join()
+                self.workers[slot] = self.spawn(slot)
+        for process, deadline in list(self.retiring.items()):
+            if not process.is_alive():
+                process.join()
+                del self.retiring[process]
+            elif time.time() > deadline:
+                process.kill()
+
+    def collect_metrics(self):
+        while True:
+            try:
+                slot, pid, snapshot = self.metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            worker = self.workers.get(slot)
+            # a retiring process of the slot may still report
+            if worker is not None and worker[0].pid == pid:
+                self.metrics[slot] = snapshot
+
+    def reload(self):
+        """Replace every worker, one at a time, draining the old ones."""
+        for slot in list(self.workers):
+            replacement = self.spawn(slot)
+            _, state, started = replacement
+            while not self.stop_requested and state[0] < started and not self.is_stale(state, started):
+                self.collect_metrics()
+                time.sleep(0.1)
+            if self.stop_requested:
+                self.retire(replacement[0])
+                return
+            if state[0] < started:
+                logger.error("Replacement of worker %s did not become healthy, keeping the old one.", slot,
+                             extra={'event': 'worker_reload_failed', 'worker': slot})
+                replacement[0].kill()
+                replacement[0].join()
+                return
+            old = self.workers[slot][0]
+            self.workers[slot] = replacement
+            self.retire(old)
+        logger.info("Restarted %s workers.", len(self.workers), extra={'event': 'reload'})
+
+    def retire(self, process):
+        process.terminate()
+        self.retiring[process] = time.time() + self.drain_timeout + KILL_GRACE
+
+    def shutdown(self):
+        for process, _, _ in self.workers.values():
+            self.retire(process)
+        self.workers = {}
+        while self.retiring:
+            self.check()
+            # keep the pipe empty, a worker that can't flush its metrics can't exit
+            self.collect_metrics()
+            time.sleep(0.1)
+        if self.health_server is not None:
+            self.health_server.shutdown()
+        self.sock.close()
+        logger.info("Stopped serving.", extra={'event': 'serve_stop'})
+        # the workers are gone, write out what they logged last
+        self.log_listener.stop()
+
+    def health(self):
+        now = time.time()
+        entries = []
+        for slot, (process, state, started) in sorted(self.workers.items()):
+            healthy = process.is_alive() and state[0] >= started and not self.is_stale(state, started)
+            entries.append({
+                'worker': slot,
+                'pid': process.pid,
+                'status': 'draining' if state[2] else ('ok' if healthy else 'unhealthy'),
+                'connections': int(state[1]),
+                'heartbeat_age': round(now - state[0], 3) if state[0] else None,
+            })
+        ok = len(entries) == self.count and all(entry['status'] == 'ok' for entry in entries)
+        return {'status': 'ok' if ok else 'unhealthy', 'workers': entries}
+
+    def start_health_server(self):
+        supervisor = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') == '/metrics':
+                    self.send_metrics()
+                    return
+                health = supervisor.health()
+                self.send_body(200 if health['status'] == 'ok' else 503, 'application/json', json.dumps(health))
+
+            def send_metrics(self):
+                if not metrics.ENABLED:
+                    self.send_body(404, 'text/plain', '')
+                    return
+                token = settings.CHAT_METRICS['TOKEN']
+                if token and not hmac.compare_digest(
+                    self.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode(),
+                ):
+                    self.send_body(403, 'text/plain', '')
+                    return
+                body = metrics.render_workers(dict(supervisor.metrics))
+                self.send_body(200, 'text/plain; version=0.0.4; charset=utf-8', body)
+
+            def send_body(self, status, content_type, body):
+                body = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.health_server = ThreadingHTTPServer((self.host, self.health_port), HealthHandler)
+        self.health_port = self.health_server.server_address[1]
+        threading.Thread(target=self.health_server.serve_forever, name='health', daemon=True).start()
@@ -0,0 +1,39 @@
+import hashlib
+
+from django.conf import settings
+
+
+def shard_weight(shard, key):
+    digest = hashlib.blake2b(f'{shard}|{key}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def shard_index(key, shards):
+    """
+    Index of the shard ``key`` belongs to, by rendezvous hashing on the shard
+    names: every shard scores the key and the highest score wins. Adding a
+    shard only moves the keys it now wins, about ``1 / len(shards)`` of them,
+    and removing one only moves the keys it held.
+    """
+    if len(shards) == 1:
+        return 0
+    return max(range(len(shards)), key=lambda index: shard_weight(shards[index], key))
+
+
+def room_shard_key(room_id):
+    # what rooms are hashed on, by the redis clients and the channel layer alike
+    return f'room:{room_id}'
+
+
+def room_shard(room_id, shards=None):
+    """Index of the redis shard that holds the history, members, presence and buckets of a room."""
+    shards = shards or settings.CHAT_REDIS['SHARDS']
+    return shard_index(room_shard_key(room_id), shards)
+
+
+def group_by_shard(room_ids, shards=None):
+    """Shard index -> the ``room_ids`` that shard holds, in their original order."""
+    groups = {}
+    for room_id in room_ids:
+        groups.setdefault(room_shard(room_id, shards), []).append(room_id)
+    return groups
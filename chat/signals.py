@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+
+from chat.membership import invalidate_room, update_room_members
+from chat.models import Room
+from chat.rooms import disconnect_removed_members, forget_direct_room
+
+
+def invalidate_rooms_on_commit(room_ids):
+    transaction.on_commit(lambda: [invalidate_room(room_id) for room_id in room_ids])
+
+
+def update_rooms_on_commit(changes, removed):
+    """``changes`` maps room ids to the users added to or, when ``removed``, removed from them."""
+    def update():
+        for room_id, user_ids in changes.items():
+            if removed:
+                update_room_members(room_id, removed=user_ids)
+                disconnect_removed_members(room_id, user_ids)
+            else:
+                update_room_members(room_id, added=user_ids)
+
+    transaction.on_commit(update)
+
+
+@receiver(m2m_changed, sender=Room.participants.through)
+def room_participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if action == 'pre_clear':
+        # the user's rooms are only known before they are cleared
+        room_ids = list(instance.room_set.values_list('id', flat=True)) if reverse else [instance.pk]
+        invalidate_rooms_on_commit(room_ids)
+        return
+    if not pk_set:
+        return
+    if reverse:
+        changes = {room_id: [instance.pk] for room_id in pk_set}
+    else:
+        changes = {instance.pk: list(pk_set)}
+    update_rooms_on_commit(changes, removed=action == 'post_remove')
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    invalidate_rooms_on_commit([instance.pk])
+    if instance.pair_key:
+        transaction.on_commit(lambda: forget_direct_room(instance.pair_key))
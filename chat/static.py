@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.views import static
+
+
+class StaticFilesHandler(ASGIStaticFilesHandler):
+    """
+    Serves ``STATIC_URL`` ahead of the Django application, so that the
+    stylesheets and images load under any ASGI server, ``manage.py serve``
+    included. Under ``DEBUG`` the files are found in the static directories
+    of the apps and of the project; otherwise they are read from
+    ``STATIC_ROOT``, where ``manage.py collectstatic`` gathered them.
+    """
+
+    def serve(self, request):
+        if settings.DEBUG:
+            return super().serve(request)
+        return static.serve(request, self.file_path(request.path), document_root=settings.STATIC_ROOT)
@@ -1,19 +1,76 @@
 import json
 import asyncio
-from channels.testing import WebsocketCommunicator
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from io import BytesIO, StringIO
+
+from unittest import mock
+
+import msgpack
+from PIL import Image
+from twisted.internet import abstract
+from twisted.internet.testing import MemoryReactor
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import HttpCommunicator, WebsocketCommunicator
 from django.contrib.auth.models import AnonymousUser
 import redis.asyncio as redis
-from django.test import TestCase
+from redis import Redis as SyncRedis
+from django.core.asgi import get_asgi_application
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.conf import settings
+from django.core import signing
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth import get_user_model
-from asgiref.sync import sync_to_async
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
 from django.urls import reverse
 
+from . import consumers, executor, metrics, profiling, ratelimit, routing, workers
+from .auth import AuthMiddlewareStack
 from .consumers import ChatConsumer
-from .models import Room
+from .contacts import add_digest_labels, get_direct_rooms
+from . import membership
+from .log import JsonFormatter, QueueListenerHandler, SamplingFilter
+from .history import (append_message, archive_pending_rooms, archive_rooms_key, get_history_page, history_key,
+                      history_offset_key, index_rooms_key, room_activity_key)
+from .models import Attachment, Message, Room
+from .outbound import TRANSPORT_EXTENSION, OutboundQueue, TransportProducer
+from .protocol import CompactProtocol, LegacyProtocol
+from .presence import get_online_user_ids, presence_key, room_presence_key
+from .receipts import get_read_cursor_batcher, get_unread_counts, read_cursors_key
+from .inbox import digest_marks_key, pop_digest
+from .ratelimit import RateLimiter
+from .search import index_pending_rooms, indexed_position_key, term_key
+from .redis_pool import close_redis, get_redis, get_room_redis, get_sync_redis
+from .rooms import pair_cache_key, room_group_name
+from .layers import ShardedRedisChannelLayer
+from .sharding import room_shard, shard_index
+from .static import StaticFilesHandler
 
 User = get_user_model()
 
 
+def reset_room_caches():
+    # test rooms and users are rolled back between tests and their ids reused
+    membership._rooms.clear()
+    redis_client = get_sync_redis()
+    for pattern in (membership.members_key('*'), membership.members_version_key('*'), pair_cache_key('*'),
+                    room_presence_key('*'), presence_key(), read_cursors_key('*'), digest_marks_key('*')):
+        for key in redis_client.scan_iter(pattern):
+            redis_client.delete(key)
+
+
 class ChatConsumerTest(TestCase):
 
     @classmethod
@@ -26,6 +83,11 @@ class ChatConsumerTest(TestCase):
         cls.room = Room.objects.create()
         cls.room.participants.set([cls.user1, cls.user2])
 
+    def setUp(self):
+        # every async test runs in its own event loop, the redis channel layer must not outlive it
+        channel_layers.backends = {}
+        reset_room_caches()
+
     async def create_room_with_participants(self, participants):
         room = await sync_to_async(Room.objects.create)()
         await sync_to_async(room.participants.set)(participants)
@@ -42,6 +104,20 @@ class ChatConsumerTest(TestCase):
         communicator.scope['url_route'] = {'kwargs': {'room_id': self.room.id}}
         return communicator
 
+    async def get_compact_communicator(self, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/",
+                                             subprotocols=['chat.v2.msgpack'])
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_id': self.room.id}}
+        return communicator
+
+    async def receive_compact(self, communicator, skip=('o', 'u', 't')):
+        # presence and typing updates arrive whenever the tracker flushes
+        while True:
+            frame = msgpack.unpackb(await communicator.receive_from())
+            if frame[0] not in skip:
+                return frame
+
     async def get_unauthenticated_communicator(self):
         communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/")
         communicator.scope['user'] = AnonymousUser()
@@ -66,10 +142,31 @@ class ChatConsumerTest(TestCase):
         connected, _ = await communicator.connect()
         self.assertFalse(connected)
 
+    async def test_connect_to_room_without_being_participant(self):
+        outsider = await sync_to_async(User.objects.create_user)(username='outsider', password='password')
+        communicator = await self.get_authenticated_communicator(outsider)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    def test_membership_cache_is_invalidated_when_participants_change(self):
+        outsider = User.objects.create_user(username='outsider', password='password')
+        self.assertTrue(async_to_sync(membership.is_room_member)(self.room.id, self.user1.id))
+        self.assertFalse(async_to_sync(membership.is_room_member)(self.room.id, outsider.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.participants.add(outsider)
+        self.assertTrue(async_to_sync(membership.is_room_member)(self.room.id, outsider.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.participants.remove(self.user1)
+        self.assertFalse(async_to_sync(membership.is_room_member)(self.room.id, self.user1.id))
+
     async def test_send_and_receive_message(self):
         communicator = await self.get_authenticated_communicator(self.user1)
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
+        history = await communicator.receive_json_from()
+        self.assertEqual(history['type'], 'history')
         await asyncio.sleep(1)
         message = "Hello world"
         await communicator.send_json_to({
@@ -115,6 +212,8 @@ class ChatConsumerTest(TestCase):
         communicator = await self.get_authenticated_communicator(self.user1)
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
+        history = await communicator.receive_json_from()
+        self.assertEqual(history['type'], 'history')
         await asyncio.sleep(1)
 
         message1 = "Message 1"
@@ -143,6 +242,1570 @@ class ChatConsumerTest(TestCase):
 
         await communicator.disconnect()
 
+    @override_settings(CHAT_RATE_LIMITS={})
+    async def test_compact_msgpack_protocol(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/",
+                                             subprotocols=['chat.v3', 'chat.v2.msgpack'])
+        communicator.scope['user'] = self.user1
+        communicator.scope['url_route'] = {'kwargs': {'room_id': self.room.id}}
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, 'chat.v2.msgpack')
+
+        history = msgpack.unpackb(await communicator.receive_from())
+        self.assertEqual(history[0], 'h')
+
+        for message in ("First", "Second"):
+            await communicator.send_to(bytes_data=msgpack.packb({'message': message}))
+
+        # the sender profile only goes out once per session
+        frames = [await self.receive_compact(communicator) for _ in range(2)]
+        if history[3] == []:
+            profile = frames.pop(0)
+            self.assertEqual(profile, ['p', self.user1.id, self.user1.first_name, self.user1.last_name])
+            frames.append(await self.receive_compact(communicator))
+        self.assertEqual([frame[0] for frame in frames], ['m', 'm'])
+        self.assertEqual([frame[3] for frame in frames], ["First", "Second"])
+        self.assertEqual(frames[1][0:3], ['m', frames[0][1] + 1, self.user1.id])
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    @override_settings(CHAT_RATE_LIMITS={})
+    async def test_broadcast_is_encoded_once_per_protocol(self):
+        sender = await self.get_authenticated_communicator(self.user1)
+        recipients = [await self.get_compact_communicator(self.user2) for _ in range(2)]
+        for communicator in (sender, *recipients):
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_from()
+
+        encoded = []
+
+        def record(encode):
+            def wrapper(protocol, frame):
+                is_message = 'message' in frame if isinstance(frame, dict) else frame[0] == 'm'
+                if is_message:
+                    encoded.append(protocol.name)
+                return encode(protocol, frame)
+            return wrapper
+
+        with mock.patch.object(LegacyProtocol, 'encode', record(LegacyProtocol.encode)), \
+                mock.patch.object(CompactProtocol, 'encode', record(CompactProtocol.encode)):
+            await sender.send_json_to({'message': "Fan-out"})
+            response = await sender.receive_json_from()
+            frames = []
+            for recipient in recipients:
+                frames.append(await self.receive_compact(recipient, skip=('o', 'u', 't', 'p')))
+        # the recipients speaking the same protocol share its frame, chat.v2.json isn't used and never encoded
+        self.assertEqual(sorted(encoded), ['chat.v2.msgpack', 'v1'])
+        self.assertEqual(response['message'], "Fan-out")
+        self.assertNotIn('broadcast_id', response)
+        self.assertEqual(frames, [['m', response['id'], self.user1.id, "Fan-out", response['timestamp']]] * 2)
+
+        await sender.disconnect()
+        for recipient in recipients:
+            await recipient.disconnect()
+
+    @override_settings(CHAT_RATE_LIMITS={})
+    async def test_consumer_metrics(self):
+        for metric in metrics._registry:
+            metric.clear()
+        with mock.patch.object(metrics, 'ENABLED', True):
+            communicator = await self.get_authenticated_communicator(self.user1)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+            self.assertEqual(metrics.active_connections.series, {(self.room.id,): 1})
+
+            await communicator.send_json_to({'message': "Measured"})
+            await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        self.assertEqual(metrics.connects.series, {('accepted',): 1})
+        self.assertEqual(metrics.disconnects.series, {(): 1})
+        self.assertEqual(metrics.active_connections.series, {})
+        self.assertGreater(metrics.broadcast_latency.series[()][-1], 0)
+        self.assertIn(('append',), metrics.redis_latency.series)
+        exposition = metrics.render()
+        self.assertIn('chat_connects_total{result="accepted"} 1', exposition)
+        self.assertIn('chat_broadcast_latency_seconds_count 1', exposition)
+        self.assertIn('chat_history_replay_messages_bucket{le="+Inf"} 1', exposition)
+
+    @override_settings(CHAT_PRESENCE={'TTL': 60, 'HEARTBEAT': 20, 'FLUSH_INTERVAL': 0.05, 'TYPING_THROTTLE': 2})
+    async def test_presence_and_typing(self):
+        first = await self.get_compact_communicator(self.user1)
+        await first.connect()
+        await first.receive_from()
+        # the online users once, then only who came and went
+        self.assertEqual(await self.receive_compact(first, skip=()), ['o', [self.user1.id]])
+        self.assertEqual(await self.receive_compact(first, skip=()), ['u', [self.user1.id], []])
+
+        second = await self.get_compact_communicator(self.user2)
+        await second.connect()
+        await second.receive_from()
+        self.assertEqual(await self.receive_compact(second, skip=()), ['o', [self.user1.id, self.user2.id]])
+        joined = ['u', [self.user2.id], []]
+        self.assertEqual(await self.receive_compact(first, skip=()), joined)
+        self.assertEqual(await self.receive_compact(second, skip=()), joined)
+
+        # typing is throttled per connection and coalesced per room
+        for _ in range(3):
+            await first.send_to(bytes_data=msgpack.packb({'type': 'typing'}))
+        await second.send_to(bytes_data=msgpack.packb({'type': 'typing'}))
+        self.assertEqual(await self.receive_compact(second, skip=()), ['t', [self.user1.id, self.user2.id]])
+        self.assertTrue(await second.receive_nothing(0.2))
+        self.assertEqual(await sync_to_async(get_online_user_ids)([self.user1.id, self.user2.id, 0]),
+                         {self.user1.id, self.user2.id})
+
+        await second.disconnect()
+        self.assertEqual(await self.receive_compact(first, skip=('t',)), ['u', [], [self.user2.id]])
+        await first.disconnect()
+
+    @override_settings(CHAT_RATE_LIMITS={}, CHAT_READ_RECEIPTS={'FLUSH_INTERVAL': 0.05})
+    async def test_read_receipts(self):
+        redis_client = get_redis()
+        await redis_client.delete(history_key(self.room.id), history_offset_key(self.room.id))
+        sender = await self.get_compact_communicator(self.user1)
+        reader = await self.get_compact_communicator(self.user2)
+        for communicator in (sender, reader):
+            await communicator.connect()
+            await communicator.receive_from()
+
+        for message in ("One", "Two"):
+            await sender.send_to(bytes_data=msgpack.packb({'message': message}))
+        frames = [await self.receive_compact(reader, skip=('o', 'u', 't', 'p', 'r')) for _ in range(2)]
+        self.assertEqual([frame[1] for frame in frames], [0, 1])
+        self.assertEqual(await sync_to_async(get_unread_counts)(self.user2.id, [self.room.id]), {self.room.id: 2})
+
+        # acknowledgements past the end of the room are clamped
+        await reader.send_to(bytes_data=msgpack.packb({'type': 'read', 'id': 0}))
+        await reader.send_to(bytes_data=msgpack.packb({'type': 'read', 'id': 99}))
+        receipts = {}
+        while receipts.get(self.user2.id) != 2:
+            frame = await self.receive_compact(sender, skip=('o', 'u', 't', 'p', 'm'))
+            self.assertEqual(frame[0], 'r')
+            receipts.update(frame[1])
+        self.assertEqual(receipts[self.user1.id], 2)
+        self.assertEqual(await sync_to_async(get_unread_counts)(self.user2.id, [self.room.id]), {self.room.id: 0})
+        self.assertEqual(await redis_client.hget(read_cursors_key(self.user2.id), self.room.id), '2')
+
+        await sender.disconnect()
+        await reader.disconnect()
+
+    async def test_history_replay_is_paginated(self):
+        redis_client = await redis.from_url('redis://redis:6379', decode_responses=True)
+        redis_key = history_key(self.room.id)
+        try:
+            await redis_client.delete(redis_key)
+            for i in range(5):
+                await redis_client.rpush(redis_key, json.dumps({
+                    'user_id': self.user2.id,
+                    'user_first_name': self.user2.first_name,
+                    'user_last_name': self.user2.last_name,
+                    'content': f"Message {i}",
+                    'timestamp': '2024-05-27T09:19:00',
+                }))
+
+            with override_settings(CHAT_HISTORY_PAGE_SIZE=2):
+                communicator = await self.get_authenticated_communicator(self.user1)
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+
+                history = await communicator.receive_json_from()
+                self.assertEqual(history['type'], 'history')
+                self.assertEqual([m['message'] for m in history['messages']], ["Message 3", "Message 4"])
+                self.assertEqual(history['cursor'], 3)
+
+                await communicator.send_json_to({'type': 'history', 'before': history['cursor']})
+                history = await communicator.receive_json_from()
+                self.assertEqual([m['message'] for m in history['messages']], ["Message 1", "Message 2"])
+                self.assertEqual(history['cursor'], 1)
+
+                await communicator.send_json_to({'type': 'history', 'before': history['cursor']})
+                history = await communicator.receive_json_from()
+                self.assertEqual([m['message'] for m in history['messages']], ["Message 0"])
+                self.assertIsNone(history['cursor'])
+
+                await communicator.disconnect()
+        finally:
+            await redis_client.delete(redis_key)
+            await redis_client.close()
+
+    async def test_history_overflow_is_archived_and_read_across_tiers(self):
+        redis_client = await redis.from_url('redis://redis:6379', decode_responses=True)
+        redis_keys = [history_key(self.room.id), history_offset_key(self.room.id), archive_rooms_key()]
+        try:
+            await redis_client.delete(*redis_keys)
+            with override_settings(CHAT_HISTORY_HOT_SIZE=2, CHAT_HISTORY_PAGE_SIZE=3):
+                for i in range(5):
+                    await append_message(redis_client, self.room.id, {
+                        'user_id': self.user2.id,
+                        'user_first_name': self.user2.first_name,
+                        'user_last_name': self.user2.last_name,
+                        'content': f"Message {i}",
+                        'timestamp': '2024-05-27T09:19:00',
+                    })
+
+                archived = await archive_pending_rooms(redis_client)
+                self.assertEqual(archived, 3)
+                self.assertEqual(await redis_client.llen(history_key(self.room.id)), 2)
+                self.assertEqual(await sync_to_async(Message.objects.filter(room=self.room).count)(), 3)
+
+                messages, cursor = await get_history_page(redis_client, self.room.id)
+                self.assertEqual([m['id'] for m in messages], [2, 3, 4])
+                self.assertEqual([m['message'] for m in messages], ["Message 2", "Message 3", "Message 4"])
+                self.assertEqual(cursor, 2)
+
+                messages, cursor = await get_history_page(redis_client, self.room.id, before=cursor)
+                self.assertEqual([m['message'] for m in messages], ["Message 0", "Message 1"])
+                self.assertIsNone(cursor)
+        finally:
+            await redis_client.delete(*redis_keys)
+            await redis_client.close()
+
+    async def test_messages_of_deleted_senders_are_not_archived(self):
+        redis_client = await redis.from_url('redis://redis:6379', decode_responses=True)
+        redis_keys = [history_key(self.room.id), history_offset_key(self.room.id), archive_rooms_key()]
+        deleted = await sync_to_async(User.objects.create_user)(username='deleted', password='password')
+        try:
+            await redis_client.delete(*redis_keys)
+            with override_settings(CHAT_HISTORY_HOT_SIZE=1, CHAT_RATE_LIMITS={}):
+                for i, sender in enumerate((self.user2, deleted, self.user2)):
+                    await append_message(redis_client, self.room.id, {
+                        'user_id': sender.id,
+                        'user_first_name': sender.first_name,
+                        'user_last_name': sender.last_name,
+                        'content': f"Message {i}",
+                        'timestamp': '2024-05-27T09:19:00+00:00',
+                    })
+                await sync_to_async(deleted.delete)()
+
+                # the room is still trimmed, its archiving doesn't fail on the missing sender
+                self.assertEqual(await archive_pending_rooms(redis_client), 2)
+                self.assertEqual(await redis_client.llen(history_key(self.room.id)), 1)
+                self.assertFalse(await redis_client.sismember(archive_rooms_key(), self.room.id))
+                archived = Message.objects.filter(room=self.room).values_list('seq', 'sender_id')
+                self.assertEqual(await sync_to_async(list)(archived), [(0, self.user2.id)])
+        finally:
+            await redis_client.delete(*redis_keys)
+            await redis_client.close()
+
+    async def test_reconnect_since_replays_only_missed_messages(self):
+        redis_client = await redis.from_url('redis://redis:6379', decode_responses=True)
+        redis_keys = [history_key(self.room.id), history_offset_key(self.room.id), archive_rooms_key()]
+        try:
+            await redis_client.delete(*redis_keys)
+            with override_settings(CHAT_HISTORY_HOT_SIZE=2, CHAT_RATE_LIMITS={}):
+                for i in range(5):
+                    await append_message(redis_client, self.room.id, {
+                        'user_id': self.user2.id,
+                        'user_first_name': self.user2.first_name,
+                        'user_last_name': self.user2.last_name,
+                        'content': f"Message {i}",
+                        'timestamp': '2024-05-27T09:19:00+00:00',
+                    })
+                # ids 0 to 2 move to the database, the replay reads across both tiers
+                await archive_pending_rooms(redis_client)
+
+                communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/?since=1")
+                communicator.scope['user'] = self.user1
+                communicator.scope['url_route'] = {'kwargs': {'room_id': self.room.id}}
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                missed = [await communicator.receive_json_from() for _ in range(3)]
+                self.assertEqual([(m['id'], m['message']) for m in missed],
+                                 [(2, "Message 2"), (3, "Message 3"), (4, "Message 4")])
+
+                await communicator.send_json_to({'message': "Message 5"})
+                response = await communicator.receive_json_from()
+                self.assertEqual(response['id'], 5)
+                self.assertTrue(response['timestamp'].endswith('+00:00'))
+                self.assertTrue(await communicator.receive_nothing())
+                await communicator.disconnect()
+
+                # a client that missed more than the limit starts over from the latest page
+                with override_settings(CHAT_HISTORY_RESUME_LIMIT=2):
+                    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/?since=1")
+                    communicator.scope['user'] = self.user1
+                    communicator.scope['url_route'] = {'kwargs': {'room_id': self.room.id}}
+                    await communicator.connect()
+                    history = await communicator.receive_json_from()
+                    self.assertEqual(history['type'], 'history')
+                    self.assertEqual(history['messages'][-1]['id'], 5)
+                    await communicator.disconnect()
+        finally:
+            await redis_client.delete(*redis_keys)
+            await redis_client.close()
+
+    async def test_consumers_share_the_event_loop_redis_pool(self):
+        redis_client = get_redis()
+        self.assertIs(get_redis(), redis_client)
+        acquired = redis_client.connection_pool.stats()['acquired']
+
+        communicator = await self.get_authenticated_communicator(self.user1)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        history = await communicator.receive_json_from()
+        self.assertEqual(history['type'], 'history')
+        await communicator.disconnect()
+
+        stats = redis_client.connection_pool.stats()
+        self.assertGreater(stats['acquired'], acquired)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertLessEqual(stats['connections'], stats['max_connections'])
+
+    async def test_rate_limited_message_is_not_stored(self):
+        redis_client = get_redis()
+        message_data = {
+            'user_id': self.user1.id,
+            'user_first_name': self.user1.first_name,
+            'user_last_name': self.user1.last_name,
+            'content': "Hello",
+            'timestamp': '2024-05-27T09:19:00',
+        }
+        with override_settings(CHAT_RATE_LIMITS={'message': {'user': {'capacity': 1, 'rate': 1}}}):
+            # two sockets of the same user share the user bucket
+            first_socket = RateLimiter('message', self.user1.id, self.room.id)
+            second_socket = RateLimiter('message', self.user1.id, self.room.id)
+            redis_keys = [history_key(self.room.id), history_offset_key(self.room.id), *first_socket.redis_keys()]
+            try:
+                await redis_client.delete(*redis_keys)
+                first = await append_message(redis_client, self.room.id, message_data, first_socket)
+                second = await append_message(redis_client, self.room.id, message_data, second_socket)
+                self.assertEqual(first, 0)
+                self.assertIsNone(second)
+                self.assertEqual(await redis_client.llen(history_key(self.room.id)), 1)
+            finally:
+                await redis_client.delete(*redis_keys)
+
+    async def test_rate_limiter_spends_leased_tokens_in_process(self):
+        redis_client = get_redis()
+        with override_settings(CHAT_RATE_LIMITS={'typing': {'room': {'capacity': 4, 'rate': 1, 'lease': 2}}}):
+            rate_limiter = RateLimiter('typing', self.user1.id, self.room.id)
+            try:
+                await redis_client.delete(*rate_limiter.redis_keys())
+                self.assertTrue(await rate_limiter.hit(redis_client))
+                # the spare token is spent in process, then the bucket has to be checked in redis again
+                self.assertEqual(rate_limiter.take_leased_tokens(), [])
+                self.assertEqual(rate_limiter.take_leased_tokens(), rate_limiter.buckets)
+                self.assertTrue(await rate_limiter.hit(redis_client))
+                self.assertTrue(await rate_limiter.hit(redis_client))
+                self.assertFalse(await rate_limiter.hit(redis_client))
+            finally:
+                await redis_client.delete(*rate_limiter.redis_keys())
+
+    async def test_room_quota_is_not_wasted_by_leases(self):
+        redis_client = get_room_redis(self.room.id)
+        message_data = {
+            'user_id': self.user1.id,
+            'user_first_name': self.user1.first_name,
+            'user_last_name': self.user1.last_name,
+            'content': "Hello",
+            'timestamp': '2024-05-27T09:19:00',
+        }
+        # the default limits: the user bucket holds no lease, the room bucket does
+        capacity = settings.CHAT_RATE_LIMITS['message']['room']['capacity']
+        rate_limiters = [RateLimiter('message', user_id, self.room.id) for user_id in range(1, capacity + 1)]
+        redis_keys = [history_key(self.room.id), history_offset_key(self.room.id)]
+        for rate_limiter in rate_limiters:
+            redis_keys += rate_limiter.redis_keys()
+        try:
+            await redis_client.delete(*redis_keys)
+            ratelimit._leases.clear()
+            for rate_limiter in rate_limiters:
+                self.assertIsNotNone(await append_message(redis_client, self.room.id, message_data, rate_limiter))
+        finally:
+            await redis_client.delete(*redis_keys)
+            ratelimit._leases.clear()
+
+
+class DirectRoomTest(TestCase):
+
+    def setUp(self):
+        reset_room_caches()
+        self.user1 = User.objects.create_user(username='testuser1', password='password')
+        self.user2 = User.objects.create_user(username='testuser2', password='password')
+        self.client.force_login(self.user1)
+
+    def test_get_or_create_room_reuses_the_pair_room(self):
+        url = reverse('chat:get_or_create_room', args=[self.user2.id])
+        response = self.client.get(url)
+        room = Room.objects.get(pair_key=Room.make_pair_key(self.user1.id, self.user2.id))
+        self.assertRedirects(response, reverse('chat:chat_room', args=[room.id]))
+        self.assertEqual(set(room.participants.all()), {self.user1, self.user2})
+
+        # the other user resolves the same room
+        self.client.force_login(self.user2)
+        response = self.client.get(reverse('chat:get_or_create_room', args=[self.user1.id]))
+        self.assertRedirects(response, reverse('chat:chat_room', args=[room.id]))
+        self.assertEqual(Room.objects.count(), 1)
+
+    def test_pair_key_is_order_independent(self):
+        self.assertEqual(Room.make_pair_key(3, 12), Room.make_pair_key(12, 3))
+        self.assertEqual(Room.make_pair_key(12, 3), "3:12")
+
+    def test_get_or_create_room_unknown_user(self):
+        response = self.client.get(reverse('chat:get_or_create_room', args=[999]))
+        self.assertEqual(response.status_code, 404)
+
+
+class ContactsTest(TestCase):
+
+    def setUp(self):
+        get_sync_redis().delete(room_activity_key(), presence_key())
+        self.user = User.objects.create_user(username='me@exampletest.com', email='me@exampletest.com',
+                                             first_name='me', last_name='myself', password='password')
+        names = [('alice', 'zed', 'a1@exampletest.com'), ('bob', 'alison', 'b@exampletest.com'),
+                 ('carol', 'young', 'alix@exampletest.com'), ('dave', 'xu', 'd@exampletest.com'),
+                 ('Alice', 'adams', 'a2@exampletest.com')]
+        self.contacts = [
+            User.objects.create_user(username=email, email=email, first_name=first_name, last_name=last_name,
+                                     password='password')
+            for first_name, last_name, email in names
+        ]
+        self.client.force_login(self.user)
+
+    @override_settings(CHAT_CONTACTS_PAGE_SIZE=2)
+    def test_contacts_are_paginated_by_name(self):
+        names = []
+        cursor = ''
+        while True:
+            response = self.client.get(reverse('chat:contacts'), {'cursor': cursor})
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data['contacts']), 2)
+            names += [f"{c['first_name']} {c['last_name']}" for c in data['contacts']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(names, ['Alice adams', 'alice zed', 'bob alison', 'carol young', 'dave xu'])
+
+    def test_contacts_prefix_search(self):
+        response = self.client.get(reverse('chat:contacts'), {'q': 'ALI'})
+        ids = {c['id'] for c in response.json()['contacts']}
+        self.assertEqual(ids, {self.contacts[0].id, self.contacts[1].id, self.contacts[2].id, self.contacts[4].id})
+
+    def test_contacts_invalid_cursor(self):
+        response = self.client.get(reverse('chat:contacts'), {'cursor': 'forged'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_index_lists_recent_rooms_first(self):
+        redis_client = get_sync_redis()
+        older_room = Room.objects.get_or_create_direct(self.user, self.contacts[3])
+        newer_room = Room.objects.get_or_create_direct(self.user, self.contacts[1])
+        Room.objects.get_or_create_direct(self.user, self.contacts[2])
+        redis_client.zadd(room_activity_key(), {older_room.id: 100, newer_room.id: 200})
+        response = self.client.get(reverse('chat:index'))
+        self.assertEqual(response.context['recent_users'], [self.contacts[1], self.contacts[3]])
+        self.assertEqual(len(response.context['users']), 5)
+
+    def test_unread_counts(self):
+        redis_client = get_sync_redis()
+        room = Room.objects.get_or_create_direct(self.user, self.contacts[0])
+        keys = [history_key(room.id), history_offset_key(room.id), read_cursors_key(self.user.id)]
+        redis_client.delete(*keys)
+        self.addCleanup(redis_client.delete, *keys)
+        message = json.dumps({'user_id': self.contacts[0].id, 'user_first_name': '', 'user_last_name': '', 'content': ''})
+        redis_client.rpush(history_key(room.id), *[message] * 3)
+        redis_client.set(history_offset_key(room.id), 2)
+        redis_client.hset(read_cursors_key(self.user.id), room.id, 1)
+        response = self.client.get(reverse('chat:index'))
+        unread = {user.id: user.unread for user in response.context['users']}
+        self.assertEqual(unread[self.contacts[0].id], 4)
+        self.assertEqual(unread[self.contacts[1].id], 0)
+        response = self.client.get(reverse('chat:contacts'))
+        self.assertEqual({c['id']: c['unread'] for c in response.json()['contacts']}[self.contacts[0].id], 4)
+
+    def test_online_contacts(self):
+        now = time.time()
+        get_sync_redis().zadd(presence_key(), {self.contacts[0].id: now + 60, self.contacts[1].id: now - 1})
+        response = self.client.get(reverse('chat:index'))
+        self.assertEqual(response.context['online_user_ids'], {self.contacts[0].id})
+        response = self.client.get(reverse('chat:contacts'))
+        online = {c['id'] for c in response.json()['contacts'] if c['online']}
+        self.assertEqual(online, {self.contacts[0].id})
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='searcher@exampletest.com', email='searcher@exampletest.com',
+                                             first_name='sea', last_name='rcher', password='password')
+        self.other = User.objects.create_user(username='other@exampletest.com', email='other@exampletest.com',
+                                              first_name='ot', last_name='her', password='password')
+        self.stranger = User.objects.create_user(username='stranger@exampletest.com',
+                                                 email='stranger@exampletest.com', password='password')
+        self.room = Room.objects.get_or_create_direct(self.user, self.other)
+        self.second_room = Room.objects.get_or_create_direct(self.user, self.stranger)
+        self.addCleanup(self.clean_redis)
+        self.clean_redis()
+        self.client.force_login(self.user)
+
+    def clean_redis(self):
+        redis_client = get_sync_redis()
+        for room in (self.room, self.second_room):
+            redis_client.delete(history_key(room.id), history_offset_key(room.id), indexed_position_key(room.id))
+            for key in redis_client.scan_iter(term_key(room.id, '*')):
+                redis_client.delete(key)
+            redis_client.srem(archive_rooms_key(), room.id)
+            redis_client.srem(index_rooms_key(), room.id)
+            redis_client.zrem(room_activity_key(), room.id)
+
+    def store(self, messages, archive=False):
+        """Append the messages, archive the overflow if asked, then index them. Returns how many were indexed."""
+        async def store_all():
+            redis_client = await redis.from_url('redis://redis:6379', decode_responses=True)
+            try:
+                for minute, (room, sender, content) in enumerate(messages):
+                    await append_message(redis_client, room.id, {
+                        'user_id': sender.id,
+                        'user_first_name': sender.first_name,
+                        'user_last_name': sender.last_name,
+                        'content': content,
+                        'timestamp': f'2024-05-27T09:{minute:02d}:00+00:00',
+                    })
+                if archive:
+                    await archive_pending_rooms(redis_client)
+                return await index_pending_rooms(redis_client)
+            finally:
+                await redis_client.close()
+
+        return async_to_sync(store_all)()
+
+    def search_all(self, **params):
+        messages = []
+        cursor = ''
+        while True:
+            response = self.client.get(reverse('chat:search'), dict(params, cursor=cursor))
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            messages += [(m['room_id'], m['id'], m['message']) for m in data['messages']]
+            cursor = data['next_cursor']
+            if not cursor:
+                return messages
+
+    @override_settings(CHAT_HISTORY_HOT_SIZE=3, CHAT_SEARCH_PAGE_SIZE=2, CHAT_RATE_LIMITS={})
+    def test_search_is_paginated_across_rooms_and_tiers(self):
+        # the first messages of the room are archived before they are indexed, they are searched in the database
+        indexed = self.store([
+            (self.room, self.other, "Hello there"),
+            (self.room, self.user, "hello, how are you?"),
+            (self.second_room, self.user, "HELLO stranger"),
+            (self.room, self.other, "fine, and you"),
+            (self.room, self.other, "goodbye"),
+            (self.second_room, self.stranger, "hello again, how is it going"),
+            (self.room, self.user, "you again"),
+        ], archive=True)
+        self.assertEqual(indexed, 5)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 2)
+        self.assertFalse(get_sync_redis().sismember(index_rooms_key(), self.room.id))
+
+        self.assertEqual(self.search_all(q='hello'), [
+            (self.second_room.id, 1, "hello again, how is it going"),
+            (self.second_room.id, 0, "HELLO stranger"),
+            (self.room.id, 1, "hello, how are you?"),
+            (self.room.id, 0, "Hello there"),
+        ])
+        self.assertEqual(self.search_all(q='how hello', room=self.room.id), [(self.room.id, 1, "hello, how are you?")])
+        self.assertEqual([m[1] for m in self.search_all(q='you', room=self.room.id)], [4, 2, 1])
+        self.assertEqual(self.search_all(q='hello missing'), [])
+
+        # a search walking one entry per room and page still finds every match
+        with override_settings(CHAT_SEARCH_SCAN_LIMIT=1):
+            self.assertEqual([m[:2] for m in self.search_all(q='again')], [(self.room.id, 4), (self.second_room.id, 1)])
+
+    @override_settings(CHAT_HISTORY_HOT_SIZE=2, CHAT_SEARCH_PAGE_SIZE=2, CHAT_RATE_LIMITS={})
+    def test_archiving_trims_the_posting_lists(self):
+        self.store([
+            (self.room, self.other, "hello there"),
+            (self.room, self.user, "hello you"),
+            (self.room, self.other, "you again"),
+            (self.room, self.user, "hello again"),
+        ])
+        redis_client = get_sync_redis()
+        self.assertEqual(redis_client.zrange(term_key(self.room.id, 'hello'), 0, -1), ['0', '1', '3'])
+
+        self.store([], archive=True)
+        self.assertEqual(redis_client.zrange(term_key(self.room.id, 'hello'), 0, -1), ['3'])
+        self.assertEqual(redis_client.zrange(term_key(self.room.id, 'you'), 0, -1), ['2'])
+        self.assertFalse(redis_client.exists(term_key(self.room.id, 'there')))
+        # the archived messages are still found, in order
+        self.assertEqual([m[1] for m in self.search_all(q='hello')], [3, 1, 0])
+        self.assertEqual([m[1] for m in self.search_all(q='you')], [2, 1])
+
+    def test_search_is_restricted_to_the_user_rooms(self):
+        foreign_room = Room.objects.get_or_create_direct(self.other, self.stranger)
+        response = self.client.get(reverse('chat:search'), {'q': 'hello', 'room': foreign_room.id})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('chat:search'), {'q': 'hello', 'cursor': 'forged'})
+        self.assertEqual(response.status_code, 400)
+        cursor = signing.dumps([self.other.id, {foreign_room.id: None}], salt='chat.search')
+        response = self.client.get(reverse('chat:search'), {'q': 'hello', 'cursor': cursor})
+        self.assertEqual(response.status_code, 400)
+
+
+class InboxTest(TestCase):
+
+    def setUp(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+        self.me = User.objects.create_user(username='away@exampletest.com', email='away@exampletest.com',
+                                           first_name='away', last_name='user', password='password')
+        self.friend = User.objects.create_user(username='friend@exampletest.com', email='friend@exampletest.com',
+                                               first_name='my', last_name='friend', password='password')
+        self.direct_room = Room.objects.get_or_create_direct(self.me, self.friend)
+        self.group = Room.objects.create_group('Club', self.friend, [self.me.id])
+        self.quiet_room = Room.objects.create_group('Quiet', self.me)
+        self.addCleanup(self.clean_redis)
+
+    def clean_redis(self):
+        redis_client = get_sync_redis()
+        for room in (self.direct_room, self.group, self.quiet_room):
+            redis_client.delete(history_key(room.id), history_offset_key(room.id))
+            redis_client.srem(archive_rooms_key(), room.id)
+            redis_client.srem(index_rooms_key(), room.id)
+            redis_client.zrem(room_activity_key(), room.id)
+
+    async def connect(self, user, room, subprotocols=None):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{room.id}/", subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_id': room.id}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @override_settings(CHAT_RATE_LIMITS={})
+    async def test_messages_to_offline_members_are_sent_as_one_digest(self):
+        direct_sender = await self.connect(self.friend, self.direct_room)
+        await direct_sender.receive_json_from()
+        group_sender = await self.connect(self.friend, self.group)
+        await group_sender.receive_json_from()
+        for message in ("hi", "are you there?"):
+            await direct_sender.send_json_to({'message': message})
+            await direct_sender.receive_json_from()
+        await group_sender.send_json_to({'message': "club news"})
+        await group_sender.receive_json_from()
+        await get_read_cursor_batcher(None).flush()
+        await direct_sender.disconnect()
+        await group_sender.disconnect()
+
+        # the sender read their own messages
+        self.assertEqual(await pop_digest(self.friend.id), [])
+        communicator = await self.connect(self.me, self.quiet_room, subprotocols=['chat.v2.json'])
+        self.assertEqual((await communicator.receive_json_from())[0], 'h')
+        digest = await communicator.receive_json_from()
+        while digest[0] in ('o', 'u'):
+            digest = await communicator.receive_json_from()
+        self.assertEqual(digest[0], 'd')
+        self.assertEqual(sorted((room_id, unread, message[2]) for room_id, unread, message in digest[1]), [
+            (self.direct_room.id, 2, "are you there?"), (self.group.id, 1, "club news"),
+        ])
+        self.assertEqual(digest[2], [[self.friend.id, 'my', 'friend']])
+        await communicator.disconnect()
+
+        # the digest is only sent once
+        communicator = await self.connect(self.me, self.quiet_room)
+        await communicator.receive_json_from()
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    def test_home_page_lists_the_digest(self):
+        async def store(content):
+            await append_message(get_redis(), self.group.id, {
+                'user_id': self.friend.id,
+                'user_first_name': self.friend.first_name,
+                'user_last_name': self.friend.last_name,
+                'content': content,
+                'timestamp': '2024-05-27T09:19:00+00:00',
+            })
+            await close_redis()
+
+        async_to_sync(store)("see you tonight")
+        self.client.force_login(self.me)
+        response = self.client.get(reverse('chat:index'))
+        # the direct room has no unread messages, it is left out
+        self.assertEqual([(e['label'], e['unread'], e['message']['message']) for e in response.context['digest']],
+                         [('Club', 1, "see you tonight")])
+        self.assertContains(response, "While you were away")
+        self.assertEqual(self.client.get(reverse('chat:index')).context['digest'], [])
+
+        # until the room gets new messages
+        async_to_sync(store)("running late")
+        self.assertEqual([(e['unread'], e['message']['message'])
+                          for e in self.client.get(reverse('chat:index')).context['digest']], [(2, "running late")])
+
+    def test_digest_labels_are_read_in_two_queries(self):
+        nameless = User.objects.create_user(username='nameless@exampletest.com', password='password')
+        nameless_room = Room.objects.get_or_create_direct(self.me, nameless)
+        direct_rooms = get_direct_rooms(self.me)
+        entries = [{'room_id': room.id} for room in (self.direct_room, self.group, nameless_room)]
+        # the group names, then the contacts, without loading the username of each nameless one
+        with self.assertNumQueries(2):
+            add_digest_labels(self.me, entries, direct_rooms)
+        self.assertEqual([entry['label'] for entry in entries], ['my friend', 'Club', 'nameless@exampletest.com'])
+
+
+class GroupRoomTest(TestCase):
+
+    def setUp(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+        self.users = [
+            User.objects.create_user(username=f'member{i}@exampletest.com', email=f'member{i}@exampletest.com',
+                                     first_name=f'member{i}', last_name='group', password='password')
+            for i in range(4)
+        ]
+        self.client.force_login(self.users[0])
+
+    def create_group(self, **data):
+        return self.client.post(reverse('chat:create_group'), data)
+
+    def test_create_join_and_leave(self):
+        response = self.create_group(name='Team', members=[self.users[1].id, self.users[2].id], public='1')
+        self.assertEqual(response.status_code, 201)
+        room = Room.objects.get(id=response.json()['id'])
+        self.assertTrue(room.is_group)
+        self.assertEqual(set(room.participants.values_list('id', flat=True)), {u.id for u in self.users[:3]})
+        with self.assertNumQueries(0):
+            self.assertEqual(str(room), "Room: Team")
+        response = self.client.get(reverse('chat:index'))
+        self.assertEqual([(g.id, g.name) for g in response.context['groups']], [(room.id, 'Team')])
+
+        private = Room.objects.create_group('Private', self.users[1])
+        self.client.force_login(self.users[3])
+        self.assertEqual(self.client.post(reverse('chat:join_group', args=[private.id])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('chat:join_group', args=[room.id])).status_code, 405)
+        self.assertEqual(self.client.post(reverse('chat:join_group', args=[room.id])).status_code, 200)
+        self.assertTrue(room.participants.filter(id=self.users[3].id).exists())
+
+        self.assertEqual(self.client.post(reverse('chat:leave_group', args=[room.id])).status_code, 200)
+        self.assertFalse(room.participants.filter(id=self.users[3].id).exists())
+        self.assertEqual(self.client.post(reverse('chat:leave_group', args=[room.id])).status_code, 404)
+
+    def test_invalid_groups(self):
+        self.assertEqual(self.create_group(name='').status_code, 400)
+        self.assertEqual(self.create_group(name='x' * 101).status_code, 400)
+        self.assertEqual(self.create_group(name='Team', members=['me']).status_code, 400)
+        self.assertEqual(self.create_group(name='Team', members=[self.users[-1].id + 100]).status_code, 400)
+        with override_settings(CHAT_GROUP_MAX_MEMBERS=2):
+            self.assertEqual(self.create_group(name='Team', members=[u.id for u in self.users[1:3]]).status_code, 400)
+            room = Room.objects.create_group('Full', self.users[1], [self.users[2].id], is_public=True)
+            self.assertEqual(self.client.post(reverse('chat:join_group', args=[room.id])).status_code, 400)
+        self.assertFalse(Room.objects.filter(name='Team').exists())
+
+    def test_async_views_redirect_anonymous_users_to_login(self):
+        room = Room.objects.create_group('Team', self.users[0], is_public=True)
+        self.client.logout()
+        for url, method in ((reverse('chat:chat_room', args=[room.id]), self.client.get),
+                            (reverse('chat:join_group', args=[room.id]), self.client.post),
+                            (reverse('chat:download_attachment', args=[1]), self.client.get)):
+            self.assertRedirects(method(url), f"{reverse('accounts:login')}?next={url}", fetch_redirect_response=False)
+        self.assertEqual(room.participants.count(), 1)
+
+        self.client.force_login(self.users[1])
+        response = self.client.get(reverse('chat:chat_room', args=[room.id]))
+        self.assertEqual((response.status_code, response.context['group_name']), (200, 'Team'))
+        self.assertEqual(self.client.get(reverse('chat:redis_pool')).status_code, 302)
+
+    def test_membership_cache_is_updated_in_place(self):
+        room = Room.objects.create_group('Team', self.users[0], [self.users[1].id], is_public=True)
+        self.assertFalse(async_to_sync(membership.is_room_member)(room.id, self.users[3].id))
+        with self.captureOnCommitCallbacks(execute=True):
+            room.participants.add(self.users[3], self.users[2])
+        # the cached set was updated rather than dropped, nothing is read from the database
+        members = get_sync_redis().smembers(membership.members_key(room.id))
+        self.assertEqual(members, {membership.LOADED, *(str(u.id) for u in self.users)})
+        membership._rooms.clear()
+        with self.assertNumQueries(0):
+            self.assertTrue(async_to_sync(membership.is_room_member)(room.id, self.users[3].id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users[3].room_set.remove(room)
+        self.assertFalse(async_to_sync(membership.is_room_member)(room.id, self.users[3].id))
+        self.assertFalse(get_sync_redis().sismember(membership.members_key(room.id), self.users[3].id))
+
+    def test_missing_rooms_are_not_cached(self):
+        room_id = Room.objects.create_group('Team', self.users[0]).id + 1
+        self.assertFalse(async_to_sync(membership.is_room_member)(room_id, self.users[0].id))
+        self.assertFalse(get_sync_redis().exists(membership.members_key(room_id)))
+        self.assertNotIn(room_id, membership._rooms)
+
+    def test_membership_cache_is_not_filled_with_members_removed_while_loading(self):
+        room = Room.objects.create_group('Team', self.users[0], [self.users[1].id], is_public=True)
+        load_room_members = membership.load_room_members
+
+        def load_then_remove(room_id):
+            member_ids = load_room_members(room_id)
+            # the removal commits after the members were read, before they are cached
+            membership.update_room_members(room_id, removed=[self.users[1].id])
+            return member_ids
+
+        with mock.patch.object(membership, 'load_room_members', load_then_remove):
+            self.assertTrue(async_to_sync(membership.is_room_member)(room.id, self.users[1].id))
+        self.assertFalse(get_sync_redis().exists(membership.members_key(room.id)))
+
+        # without a removal in between the members are cached
+        self.assertTrue(async_to_sync(membership.is_room_member)(room.id, self.users[0].id))
+        members = get_sync_redis().smembers(membership.members_key(room.id))
+        self.assertEqual(members, {membership.LOADED, str(self.users[0].id), str(self.users[1].id)})
+
+    async def test_leaving_closes_the_member_connections(self):
+        room = await sync_to_async(Room.objects.create_group)('Team', self.users[0], [self.users[1].id])
+        communicators = []
+        for user in self.users[:2]:
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{room.id}/")
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_id': room.id}}
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()
+            communicators.append(communicator)
+
+        def leave():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.force_login(self.users[1])
+                self.client.post(reverse('chat:leave_group', args=[room.id]))
+
+        await sync_to_async(leave)()
+        self.assertEqual(await communicators[1].receive_output(), {'type': 'websocket.close', 'code': 4003})
+        self.assertFalse(await membership.is_room_member(room.id, self.users[1].id))
+        await communicators[0].send_json_to({'message': "still here"})
+        response = await communicators[0].receive_json_from()
+        self.assertEqual(response['message'], "still here")
+        for communicator in communicators:
+            await communicator.disconnect()
+        await get_room_redis(room.id).delete(history_key(room.id), history_offset_key(room.id))
+
+
+class AttachmentTest(TestCase):
+
+    def setUp(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media_root = override_settings(MEDIA_ROOT=directory.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.media_root = directory.name
+        self.sender = User.objects.create_user(username='sender@exampletest.com', email='sender@exampletest.com',
+                                               first_name='file', last_name='sender', password='password')
+        self.outsider = User.objects.create_user(username='outsider@exampletest.com',
+                                                 email='outsider@exampletest.com', password='password')
+        self.room = Room.objects.create_group('Files', self.sender)
+        self.client.force_login(self.sender)
+        self.addCleanup(self.clean_redis)
+
+    def clean_redis(self):
+        redis_client = get_sync_redis()
+        redis_client.delete(history_key(self.room.id), history_offset_key(self.room.id))
+        redis_client.srem(archive_rooms_key(), self.room.id)
+        redis_client.srem(index_rooms_key(), self.room.id)
+        redis_client.zrem(room_activity_key(), self.room.id)
+
+    def upload(self, name, data, content_type):
+        return self.client.post(reverse('chat:upload_attachment', args=[self.room.id]), {
+            'file': SimpleUploadedFile(name, data, content_type=content_type),
+        })
+
+    def test_images_are_stored_with_a_thumbnail_and_served_to_members(self):
+        image = BytesIO()
+        Image.new('RGB', (800, 400), 'red').save(image, 'PNG')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.upload('photo.png', image.getvalue(), 'image/png')
+        self.assertEqual(response.status_code, 201)
+        ref = response.json()
+        self.assertEqual((ref['name'], ref['content_type'], ref['size']),
+                         ('photo.png', 'image/png', len(image.getvalue())))
+        attachment = Attachment.objects.get(id=ref['id'])
+        self.assertTrue(attachment.file.path.startswith(self.media_root))
+        self.assertEqual((attachment.width, attachment.height), (800, 400))
+
+        response = self.client.get(reverse('chat:download_attachment', args=[ref['id']]))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(b''.join(response.streaming_content), image.getvalue())
+        response = self.client.get(reverse('chat:attachment_thumbnail', args=[ref['id']]))
+        with Image.open(BytesIO(b''.join(response.streaming_content))) as thumbnail:
+            self.assertEqual(thumbnail.size, (320, 160))
+
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(reverse('chat:download_attachment', args=[ref['id']])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('chat:attachment_thumbnail', args=[ref['id']])).status_code, 404)
+        self.assertEqual(self.upload('photo.png', image.getvalue(), 'image/png').status_code, 404)
+
+    def test_other_files_are_downloads_within_the_size_limit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.upload('page.html', b'<script>alert(1)</script>', 'text/html')
+        self.assertEqual(response.status_code, 201)
+        attachment_id = response.json()['id']
+        response = self.client.get(reverse('chat:download_attachment', args=[attachment_id]))
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="page.html"')
+        self.assertEqual(self.client.get(reverse('chat:attachment_thumbnail', args=[attachment_id])).status_code, 404)
+
+        with override_settings(CHAT_ATTACHMENTS={**settings.CHAT_ATTACHMENTS, 'MAX_SIZE': 1000}):
+            # stopped by the upload handler, then by the length of the body
+            self.assertEqual(self.upload('big.bin', b'x' * 2000, 'application/octet-stream').status_code, 413)
+            self.assertEqual(self.upload('big.bin', b'x' * 100000, 'application/octet-stream').status_code, 413)
+        self.assertEqual(Attachment.objects.count(), 1)
+        self.assertEqual(self.client.post(reverse('chat:upload_attachment', args=[self.room.id])).status_code, 400)
+
+    @override_settings(CHAT_RATE_LIMITS={}, CHAT_HISTORY_HOT_SIZE=0)
+    async def test_messages_carry_references_through_redis_and_the_archive(self):
+        attachment = await sync_to_async(Attachment.objects.create)(
+            room=self.room, uploader=self.sender, file='attachments/notes.txt', name='notes.txt',
+            content_type='text/plain', size=12,
+        )
+        other_room = await sync_to_async(Room.objects.create_group)('Other', self.sender)
+        misplaced = await sync_to_async(Attachment.objects.create)(
+            room=other_room, uploader=self.sender, file='attachments/other.txt', name='other.txt',
+            content_type='text/plain', size=3,
+        )
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/")
+        communicator.scope['user'] = self.sender
+        communicator.scope['url_route'] = {'kwargs': {'room_id': self.room.id}}
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()
+
+        ref = {'id': attachment.id, 'name': 'notes.txt', 'content_type': 'text/plain', 'size': 12}
+        await communicator.send_json_to({'message': "notes", 'attachments': [attachment.id]})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['attachments'], [ref])
+        self.assertEqual(CompactProtocol('chat.v2.json').message_frame(response)[5],
+                         [[attachment.id, 'notes.txt', 'text/plain', 12]])
+        for attachment_ids in ([misplaced.id], [attachment.id + misplaced.id], ['1'], 'x'):
+            await communicator.send_json_to({'message': "notes", 'attachments': attachment_ids})
+            self.assertEqual(await communicator.receive_json_from(), {'error': 'Invalid attachments.'})
+        await communicator.disconnect()
+
+        redis_client = get_room_redis(self.room.id)
+        [raw] = await redis_client.lrange(history_key(self.room.id), 0, -1)
+        self.assertEqual(json.loads(raw)['attachments'], [ref])
+        self.assertEqual(await archive_pending_rooms(redis_client), 1)
+        messages, _ = await get_history_page(redis_client, self.room.id)
+        self.assertEqual([(m['message'], m['attachments']) for m in messages], [("notes", [ref])])
+
+
+# two shards of the test redis server, the second one only used by ShardingTest
+SHARDS = ['redis://redis:6379/0', 'redis://redis:6379/1']
+
+
+def sharded(**kwargs):
+    return override_settings(
+        CHAT_REDIS={**settings.CHAT_REDIS, 'SHARDS': SHARDS},
+        CHANNEL_LAYERS={'default': {'BACKEND': 'chat.layers.ShardedRedisChannelLayer', 'CONFIG': {'hosts': SHARDS}}},
+        **kwargs,
+    )
+
+
+class ShardingTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='sharded', email='sharded@exampletest.com', password='password')
+        cls.rooms = [Room.objects.create() for _ in range(8)]
+        for room in cls.rooms:
+            room.participants.set([cls.user])
+
+    def setUp(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+        second_shard = SyncRedis.from_url(SHARDS[1])
+        second_shard.flushdb()
+        self.addCleanup(second_shard.flushdb)
+        self.addCleanup(self.clean_first_shard)
+
+    def clean_first_shard(self):
+        redis_client = get_sync_redis()
+        for room in self.rooms:
+            redis_client.delete(history_key(room.id), history_offset_key(room.id), read_cursors_key(self.user.id))
+            redis_client.srem(archive_rooms_key(), room.id)
+            redis_client.zrem(room_activity_key(), room.id)
+
+    def test_adding_a_shard_only_moves_rooms_to_it(self):
+        shards = ['redis://a:6379', 'redis://b:6379']
+        before = [shard_index(f'room:{room_id}', shards) for room_id in range(1000)]
+        after = [shard_index(f'room:{room_id}', shards + ['redis://c:6379']) for room_id in range(1000)]
+        moved = [room_id for room_id in range(1000) if before[room_id] != after[room_id]]
+        self.assertTrue(all(after[room_id] == 2 for room_id in moved))
+        self.assertLess(abs(len(moved) - 333), 60)
+        self.assertEqual({0, 1}, set(before))
+
+    async def test_room_group_lives_on_the_room_shard(self):
+        layer = ShardedRedisChannelLayer(hosts=SHARDS)
+        with sharded():
+            room_ids = [room.id for room in self.rooms]
+            self.assertEqual({0, 1}, {room_shard(room_id) for room_id in room_ids})
+            for room_id in room_ids:
+                channel = await layer.new_channel()
+                await layer.group_add(room_group_name(room_id), channel)
+                group_key = layer._group_key(room_group_name(room_id))
+                self.assertTrue(await layer.connection(room_shard(room_id)).exists(group_key))
+                await layer.group_send(room_group_name(room_id), {'type': 'chat.message', 'room': room_id})
+                self.assertEqual((await layer.receive(channel))['room'], room_id)
+                await layer.group_discard(room_group_name(room_id), channel)
+        await layer.flush()
+
+    async def test_consumer_writes_to_the_room_shard(self):
+        with sharded(CHAT_RATE_LIMITS={}):
+            communicators = []
+            for room in self.rooms[:4]:
+                communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{room.id}/")
+                communicator.scope['user'] = self.user
+                communicator.scope['url_route'] = {'kwargs': {'room_id': room.id}}
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                self.assertEqual((await communicator.receive_json_from())['type'], 'history')
+                communicators.append((room, communicator))
+            for room, communicator in communicators:
+                await communicator.send_json_to({'message': f'hello {room.id}'})
+                response = await communicator.receive_json_from()
+                self.assertEqual(response['message'], f'hello {room.id}')
+            for room, communicator in communicators:
+                await communicator.disconnect()
+                stored = await get_room_redis(room.id).lrange(history_key(room.id), 0, -1)
+                self.assertEqual(json.loads(stored[0])['content'], f'hello {room.id}')
+                other = get_redis(1 - room_shard(room.id))
+                self.assertFalse(await other.exists(history_key(room.id)))
+
+    def test_rebalance_moves_room_keys_to_the_new_shard(self):
+        redis_client = get_sync_redis()
+        for room in self.rooms:
+            redis_client.rpush(history_key(room.id), json.dumps({'content': str(room.id)}))
+            redis_client.set(history_offset_key(room.id), 5)
+            redis_client.zadd(room_activity_key(), {room.id: 1})
+            redis_client.hset(read_cursors_key(self.user.id), room.id, 3)
+        redis_client.sadd(archive_rooms_key(), self.rooms[0].id)
+
+        with sharded():
+            stdout = StringIO()
+            call_command('rebalance_shards', stdout=stdout, stderr=StringIO())
+            moved = [room for room in self.rooms if room_shard(room.id) == 1]
+            self.assertIn(f"moved the history of {len(moved)} rooms", stdout.getvalue())
+            for room in self.rooms:
+                shard = get_sync_redis(room_shard(room.id))
+                other = get_sync_redis(1 - room_shard(room.id))
+                self.assertEqual(shard.lrange(history_key(room.id), 0, -1), [json.dumps({'content': str(room.id)})])
+                self.assertEqual(shard.get(history_offset_key(room.id)), '5')
+                self.assertEqual(shard.zscore(room_activity_key(), room.id), 1)
+                self.assertEqual(shard.hget(read_cursors_key(self.user.id), room.id), '3')
+                self.assertFalse(other.exists(history_key(room.id), history_offset_key(room.id)))
+                self.assertIsNone(other.hget(read_cursors_key(self.user.id), room.id))
+            first_room = self.rooms[0].id
+            self.assertTrue(get_sync_redis(room_shard(first_room)).sismember(archive_rooms_key(), first_room))
+            self.assertEqual(get_unread_counts(self.user.id, [room.id for room in self.rooms]),
+                             {room.id: 3 for room in self.rooms})
+
+
+class BenchmarkCommandTest(TestCase):
+
+    def test_benchmark_in_memory(self):
+        stdout = StringIO()
+        call_command('benchmark_chat', connections=6, rooms=2, messages=2, protocol='chat.v2.msgpack',
+                     stdout=stdout, stderr=StringIO())
+        report = stdout.getvalue()
+        self.assertIn("Connections:       6/6 in 2 rooms", report)
+        self.assertIn("Deliveries:        12/12", report)
+        self.assertFalse(User.objects.filter(username__startswith='bench_').exists())
+
+    def test_benchmark_against_redis_deletes_its_keys(self):
+        redis_client = get_sync_redis()
+        # the channel layer's own keys expire on their own
+        before = {key for key in redis_client.scan_iter() if not key.startswith('asgi')}
+        stdout = StringIO()
+        call_command('benchmark_chat', connections=4, rooms=2, messages=2, backend='redis',
+                     stdout=stdout, stderr=StringIO())
+        self.assertIn("Deliveries:        8/8", stdout.getvalue())
+        after = {key for key in redis_client.scan_iter() if not key.startswith('asgi')}
+        self.assertEqual(after - before, set())
+
+
+class StalledTransport(abstract.FileDescriptor):
+    """Socket of a client that stopped reading: Twisted keeps every write in its buffer."""
+
+    connected = True
+
+    def __init__(self):
+        super().__init__(reactor=MemoryReactor())
+        self.stalled = True
+        self.written = 0
+
+    def writeSomeData(self, data):
+        if self.stalled:
+            return 0
+        self.written += len(data)
+        return len(data)
+
+    def buffered(self):
+        return len(self.dataBuffer) - self.offset + self._tempDataLen
+
+
+class OutboundQueueTest(TestCase):
+
+    async def make_queue(self, policy, max_frames=3):
+        self.sent = []
+        self.unblocked = asyncio.Event()
+
+        async def send(data):
+            self.sent.append(data)
+            await self.unblocked.wait()
+
+        outbound = OutboundQueue(send, max_frames, policy)
+        # the first frame is taken by the writer, which then blocks like a stalled socket
+        outbound.put('first')
+        await asyncio.sleep(0)
+        return outbound
+
+    async def drain(self, outbound):
+        self.unblocked.set()
+        while outbound.frames:
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        await outbound.close()
+
+    async def test_drop_oldest(self):
+        outbound = await self.make_queue('drop_oldest')
+        frames = [('message', None), ('online 1', 'presence'), ('typing 1', 'typing'), ('online 2', 'presence')]
+        for data, key in frames:
+            self.assertTrue(outbound.put(data, key=key))
+        await self.drain(outbound)
+        self.assertEqual(self.sent, ['first', 'message', 'typing 1', 'online 2'])
+
+    async def test_frames_without_key_are_not_dropped(self):
+        # they may introduce the profiles later frames refer to
+        for policy in ('drop_oldest', 'coalesce'):
+            outbound = await self.make_queue(policy)
+            for data in ('profile', 'message', 'history'):
+                self.assertTrue(outbound.put(data))
+            self.assertFalse(outbound.put('online', key='presence'))
+            await outbound.close()
+
+    async def test_coalesce(self):
+        outbound = await self.make_queue('coalesce')
+        outbound.put('online 1', key='presence')
+        outbound.put('message')
+        outbound.put('online 2', key='presence')
+        self.assertTrue(outbound.put('online 3', key='presence'))
+        await self.drain(outbound)
+        self.assertEqual(self.sent, ['first', 'message', 'online 2', 'online 3'])
+
+    async def test_disconnect(self):
+        outbound = await self.make_queue('disconnect')
+        for data in ('a', 'b', 'c'):
+            self.assertTrue(outbound.put(data))
+        self.assertFalse(outbound.put('d'))
+        await outbound.close()
+        self.assertEqual(self.sent, ['first'])
+
+    async def test_writer_waits_for_the_transport(self):
+        transport = StalledTransport()
+        producer = TransportProducer.register(transport)
+
+        async def send(data):
+            # as Daphne's send, which returns once the frame is in the transport's buffer
+            transport.write(data)
+
+        outbound = OutboundQueue(send, 3, 'disconnect', transport=producer)
+        frame = b'x' * 40000
+        for _ in range(5):
+            self.assertTrue(outbound.put(frame))
+            await asyncio.sleep(0)
+        # the transport took frames until its buffer was full, the rest wait in the queue
+        self.assertEqual(transport.buffered(), 2 * len(frame))
+        self.assertEqual(len(outbound.frames), 3)
+        self.assertFalse(outbound.put(frame))
+
+        # once the client reads again, the queue empties as fast as the socket takes it
+        transport.stalled = False
+        while outbound.frames:
+            transport.doWrite()
+            await asyncio.sleep(0)
+        await outbound.close()
+        self.assertEqual(transport.written + transport.buffered(), 5 * len(frame))
+
+    @override_settings(CHAT_OUTBOUND={'MAX_FRAMES': 1, 'POLICY': 'disconnect'}, CHAT_RATE_LIMITS={})
+    async def test_slow_client_is_disconnected(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+        user = await sync_to_async(User.objects.create_user)(username='slow', password='password')
+        room = await sync_to_async(Room.objects.create)()
+        await sync_to_async(room.participants.add)(user)
+        transport = StalledTransport()
+        producer = TransportProducer.register(transport)
+        transport.write(b'x' * (transport.bufferSize + 1))
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{room.id}/")
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_id': room.id}}
+        communicator.scope['extensions'] = {TRANSPORT_EXTENSION: producer}
+
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        for message in ("One", "Two", "Three"):
+            await communicator.send_json_to({'message': message})
+        output = await communicator.receive_output()
+        self.assertEqual(output, {'type': 'websocket.close', 'code': 4008})
+
+
+class MetricsViewTest(TestCase):
+
+    def test_metrics_disabled(self):
+        with mock.patch.object(metrics, 'ENABLED', False):
+            self.assertEqual(self.client.get(reverse('chat:metrics')).status_code, 404)
+
+    @override_settings(CHAT_METRICS={'ENABLED': True, 'TOKEN': 'scraper'})
+    def test_metrics_token(self):
+        with mock.patch.object(metrics, 'ENABLED', True):
+            self.assertEqual(self.client.get(reverse('chat:metrics')).status_code, 403)
+            response = self.client.get(reverse('chat:metrics'), headers={'Authorization': 'Bearer scrapes'})
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(reverse('chat:metrics'), headers={'Authorization': 'Bearer scraper'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chat_connects_total counter', response.content)
+        self.assertIn(b'chat_redis_pool_connections{state="max"}', response.content)
+
+
+class LoggingTest(TestCase):
+
+    def make_record(self, level=logging.INFO, **extra):
+        record = logging.makeLogRecord({'name': 'chat.consumers', 'levelno': level,
+                                        'levelname': logging.getLevelName(level),
+                                        'msg': "User %s sent a message.", 'args': (7,)})
+        record.__dict__.update(extra)
+        return record
+
+    def test_sampling_filter(self):
+        sampling = SamplingFilter({'message_sent': 0, 'connect': 1})
+        self.assertFalse(sampling.filter(self.make_record(event='message_sent')))
+        self.assertTrue(sampling.filter(self.make_record(event='connect')))
+        self.assertTrue(sampling.filter(self.make_record()))
+        self.assertTrue(sampling.filter(self.make_record(logging.ERROR, event='message_sent')))
+
+    def test_queued_json_records(self):
+        records = []
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                records.append(self.format(record))
+
+        target = ListHandler()
+        target.setFormatter(JsonFormatter())
+        handler = QueueListenerHandler([target])
+        try:
+            handler.handle(self.make_record(event='message_sent', room_id=3))
+        finally:
+            handler.stop()
+
+        entry = json.loads(records[0])
+        self.assertEqual(entry['message'], "User 7 sent a message.")
+        self.assertEqual((entry['level'], entry['event'], entry['room_id']), ('INFO', 'message_sent', 3))
+
+    def test_errors_carry_their_event(self):
+        with mock.patch.object(membership, 'get_sync_room_redis', side_effect=ConnectionError("down")), \
+                self.assertLogs('chat.membership', logging.ERROR) as logs:
+            membership.invalidate_room(5)
+        [record] = logs.records
+        self.assertEqual(record.getMessage(), "Error during membership cache invalidation: down")
+        self.assertEqual((record.event, record.room_id), ('membership_invalidation_failed', 5))
+
+
+class DatabaseExecutorTest(TestCase):
+
+    def setUp(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+
+    @override_settings(CHAT_DB_EXECUTOR={'MAX_WORKERS': 2})
+    async def test_calls_wait_for_the_bounded_pool(self):
+        def current_thread():
+            time.sleep(0.1)
+            return threading.current_thread().name
+
+        metrics.db_executor_wait.clear()
+        with mock.patch.object(executor, '_executor', None), mock.patch.object(metrics, 'ENABLED', True):
+            try:
+                names = await asyncio.gather(*(executor.database_sync_to_async(current_thread)() for _ in range(4)))
+            finally:
+                executor._executor.shutdown()
+        self.assertEqual(len(set(names)), 2)
+        self.assertTrue(all(name.startswith('chat-db') for name in names))
+        self.assertEqual(metrics.db_executor_calls.series, {})
+        # the last two calls waited for the first two
+        *buckets, total = metrics.db_executor_wait.series[()]
+        self.assertEqual(sum(buckets), 4)
+        self.assertGreater(total, 0.15)
+        metrics.db_executor_wait.clear()
+
+    async def test_handshake_user_is_loaded_from_the_session(self):
+        user = await sync_to_async(User.objects.create_user)(username='session@exampletest.com', password='password')
+        room = await sync_to_async(Room.objects.create_group)('Session', user)
+        await sync_to_async(self.client.force_login)(user)
+        session_id = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        application = AuthMiddlewareStack(URLRouter(routing.websocket_urlpatterns))
+        communicator = WebsocketCommunicator(application, f"/ws/chat/{room.id}/",
+                                             headers=[(b'cookie', f'sessionid={session_id}'.encode())])
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'message': "hello"})
+        self.assertEqual((await communicator.receive_json_from())['user_id'], user.id)
+        await communicator.disconnect()
+        await get_room_redis(room.id).delete(history_key(room.id), history_offset_key(room.id))
+
+
+class DatabaseExecutorTransactionTest(TransactionTestCase):
+    # the pool threads have connections of their own, they only see committed rows
+
+    def setUp(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+
+    @override_settings(CHAT_DB_EXECUTOR={'MAX_WORKERS': 2})
+    async def test_room_members_are_loaded_in_the_pool(self):
+        user = await sync_to_async(User.objects.create_user)(username='pooled', password='password')
+        room = await sync_to_async(Room.objects.create_group)('Pooled', user)
+        load_room_members = membership.load_room_members
+        threads = []
+
+        def load_in_thread(room_id):
+            threads.append(threading.current_thread().name)
+            return load_room_members(room_id)
+
+        # a handshake that misses the membership cache doesn't wait on the thread-sensitive one
+        with mock.patch.object(executor, '_executor', None), \
+                mock.patch.object(membership, 'load_room_members', load_in_thread):
+            try:
+                self.assertTrue(await membership.is_room_member(room.id, user.id))
+            finally:
+                executor._executor.shutdown()
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('chat-db'))
+
+
+class WorkerDrainTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='drained', password='password')
+        cls.room = Room.objects.create()
+        cls.room.participants.set([cls.user])
+
+    def setUp(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+        for name, value in (('draining', False), ('_consumers', set())):
+            patcher = mock.patch.object(workers, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get_communicator(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/")
+        communicator.scope['user'] = self.user
+        communicator.scope['url_route'] = {'kwargs': {'room_id': self.room.id}}
+        return communicator
+
+    async def test_drain_tells_clients_to_reconnect(self):
+        communicator = self.get_communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(workers.connection_count(), 1)
+
+        drain = asyncio.create_task(workers.drain(timeout=5))
+        while True:
+            output = await communicator.receive_output()
+            if output['type'] == 'websocket.close':
+                break
+        self.assertEqual(output['code'], workers.RESTART_CLOSE_CODE)
+        await communicator.disconnect()
+        self.assertTrue(await drain)
+        self.assertEqual(workers.connection_count(), 0)
+
+        # new connections are turned away until the worker exits
+        connected, code = await self.get_communicator().connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, workers.RESTART_CLOSE_CODE)
+
+    def test_health_view(self):
+        response = self.client.get(reverse('chat:health'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'ok')
+        self.assertEqual(response.json()['pid'], os.getpid())
+        with mock.patch.object(workers, 'draining', True):
+            response = self.client.get(reverse('chat:health'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'draining')
+
+
+class ServeCommandTest(TestCase):
+
+    def free_port(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def get_json(self, url):
+        try:
+            with urllib.request.urlopen(url, timeout=2) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+        except OSError:
+            return None, None
+
+    def wait_for(self, url, condition, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            status, body = self.get_json(url)
+            if status is not None and condition(status, body):
+                return body
+            time.sleep(0.2)
+        self.fail(f"{url} did not become ready")
+
+    def test_workers_reload_and_drain(self):
+        port, health_port = self.free_port(), self.free_port()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        log_file = os.path.join(directory.name, 'chat.log')
+        process = subprocess.Popen(
+            [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'serve', '--host', '127.0.0.1', '--port', str(port),
+             '--workers', '2', '--health-port', str(health_port), '--drain-timeout', '2'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, CHAT_METRICS_ENABLED='1', CHAT_METRICS_TOKEN='', LOG_FILE=log_file),
+        )
+        self.addCleanup(process.kill)
+        health_url = f'http://127.0.0.1:{health_port}/'
+
+        health = self.wait_for(health_url, lambda status, body: status == 200)
+        pids = {worker['pid'] for worker in health['workers']}
+        self.assertEqual(len(pids), 2)
+        status, worker = self.get_json(f'http://127.0.0.1:{port}{reverse("chat:health")}')
+        self.assertEqual(status, 200)
+        self.assertIn(worker['pid'], pids)
+
+        # the supervisor serves the metrics of every worker, each one labelled
+        deadline = time.monotonic() + 10
+        while True:
+            with urllib.request.urlopen(f'{health_url}metrics', timeout=2) as response:
+                exposition = response.read().decode()
+            if ('worker="0"' in exposition and 'worker="1"' in exposition) or time.monotonic() > deadline:
+                break
+            time.sleep(0.2)
+        self.assertIn('chat_redis_pool_connections{state="max",worker="0"}', exposition)
+        self.assertIn('chat_redis_pool_connections{state="max",worker="1"}', exposition)
+        self.assertEqual(exposition.count('# TYPE chat_redis_pool_connections gauge'), 1)
+
+        process.send_signal(signal.SIGHUP)
+        self.wait_for(health_url, lambda status, body: status == 200 and not pids & {
+            worker['pid'] for worker in body['workers']
+        })
+
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(process.wait(timeout=15), 0)
+        # the workers' records were written by the supervisor
+        with open(log_file) as file:
+            events = [json.loads(line).get('event') for line in file]
+        self.assertIn('serve_stop', events)
+        self.assertGreaterEqual(events.count('drain'), 2)
+
+
+class StaticFilesTest(TestCase):
+
+    async def get(self, path):
+        communicator = HttpCommunicator(StaticFilesHandler(get_asgi_application()), 'GET', path)
+        # the last body message of a streamed file has no body, which get_response doesn't expect
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        status = (await communicator.receive_output())['status']
+        body = b''
+        while True:
+            message = await communicator.receive_output()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                await communicator.wait()
+                return status, body
+
+    async def test_static_files_are_served_ahead_of_django(self):
+        with open(os.path.join(settings.BASE_DIR, 'static', 'css', 'styles.css'), 'rb') as file:
+            stylesheet = file.read()
+        with override_settings(DEBUG=True):
+            self.assertEqual(await self.get('/static/css/styles.css'), (200, stylesheet))
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with override_settings(DEBUG=False, STATIC_ROOT=directory.name):
+            status, _ = await self.get('/static/css/styles.css')
+            self.assertEqual(status, 404)
+            await sync_to_async(call_command)('collectstatic', interactive=False, verbosity=0)
+            self.assertEqual(await self.get('/static/css/styles.css'), (200, stylesheet))
+
+
+class ProfilingTest(TestCase):
+
+    def setUp(self):
+        channel_layers.backends = {}
+        reset_room_caches()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(profiling, 'ENABLED', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def profiling_settings(self, sample_rate=0):
+        return override_settings(CHAT_PROFILING={
+            'ENABLED': True, 'SAMPLE_RATE': sample_rate, 'HEADER': 'X-Profile', 'TOKEN': 'profile-me',
+            'DIRECTORY': self.directory,
+        })
+
+    def test_middleware_profiles_requests_with_the_header(self):
+        middleware = profiling.ProfilingMiddleware(lambda request: 'response')
+        with self.profiling_settings():
+            request = mock.Mock(method='GET', path='/contacts/', headers={})
+            self.assertEqual(middleware(request), 'response')
+            self.assertEqual(os.listdir(self.directory), [])
+
+            request.headers = {'X-Profile': 'profile-me'}
+            self.assertEqual(middleware(request), 'response')
+        [filename] = os.listdir(self.directory)
+        self.assertIn('-http-GET_contacts-', filename)
+
+    async def test_middleware_stays_async_for_async_views(self):
+        async def get_response(request):
+            return 'response'
+
+        middleware = profiling.ProfilingMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        with self.profiling_settings():
+            request = mock.Mock(method='POST', path='/groups/', headers={'X-Profile': 'profile-me'})
+            self.assertEqual(await middleware(request), 'response')
+        [filename] = os.listdir(self.directory)
+        self.assertIn('-http-POST_groups-', filename)
+        self.assertFalse(iscoroutinefunction(profiling.ProfilingMiddleware(lambda request: None)))
+
+    def test_middleware_is_removed_when_disabled(self):
+        with mock.patch.object(profiling, 'ENABLED', False):
+            with self.assertRaises(MiddlewareNotUsed):
+                profiling.ProfilingMiddleware(lambda request: None)
+
+    def test_sampled_consumer_handlers(self):
+        user = User.objects.create_user(username='profiled', password='password')
+        room = Room.objects.create()
+        room.participants.add(user)
+
+        async def connect():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{room.id}/")
+            communicator.scope['user'] = user
+            communicator.scope['url_route'] = {'kwargs': {'room_id': room.id}}
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.disconnect()
+
+        with self.profiling_settings(sample_rate=1):
+            async_to_sync(connect)()
+        self.assertTrue(any('-ws-ChatConsumer_connect-' in name for name in os.listdir(self.directory)))
+
 
 ################### Integration TESTS #############################
 
@@ -171,6 +1834,11 @@ class ChatAppIntegrationTest(TestCase):
             'password': 'password123'
         }
 
+    def setUp(self):
+        # every async test runs in its own event loop, the redis channel layer must not outlive it
+        channel_layers.backends = {}
+        reset_room_caches()
+
     async def create_room_with_participants(self, participants):
         room = await sync_to_async(Room.objects.create)()
         await sync_to_async(room.participants.set)(participants)
@@ -207,6 +1875,8 @@ class ChatAppIntegrationTest(TestCase):
         communicator = await self.get_authenticated_communicator(user1, room)
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
+        history = await communicator.receive_json_from()
+        self.assertEqual(history['type'], 'history')
 
         # send a message through ws
         message = "Hello world"
@@ -3,6 +3,17 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('contacts/', views.contacts, name='contacts'),
     path('room/<int:user_id>/', views.get_or_create_room, name='get_or_create_room'),
     path('chat/<int:room_id>/', views.chat_room, name='chat_room'),
+    path('chat/<int:room_id>/attachments/', views.upload_attachment, name='upload_attachment'),
+    path('attachments/<int:attachment_id>/', views.download_attachment, name='download_attachment'),
+    path('attachments/<int:attachment_id>/thumbnail/', views.attachment_thumbnail, name='attachment_thumbnail'),
+    path('groups/', views.create_group, name='create_group'),
+    path('groups/<int:room_id>/join/', views.join_group, name='join_group'),
+    path('groups/<int:room_id>/leave/', views.leave_group, name='leave_group'),
+    path('search/', views.search, name='search'),
+    path('stats/redis-pool/', views.redis_pool, name='redis_pool'),
+    path('metrics/', views.metrics_view, name='metrics'),
+    path('health/', views.health, name='health'),
 ]
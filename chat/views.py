@@ -1,31 +1,262 @@
+import hmac
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
-from django.shortcuts import render, redirect
-from .models import Room
+from django.contrib.auth.views import redirect_to_login
+from django.core import signing
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404, render, redirect
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_POST
+from . import metrics, workers
+from .attachments import (INLINE_CONTENT_TYPES, AttachmentResponse, AttachmentUploadHandler, attachment_to_ref,
+                          create_attachment)
+from .contacts import (add_digest_labels, add_unread_counts, contact_to_json, get_contacts_page, get_direct_rooms,
+                       get_groups, get_recent_contacts, group_to_json)
+from .inbox import pop_sync_digest
+from .models import Attachment, Room
+from .presence import get_online_user_ids
+from .redis_pool import record_pool_metrics, redis_pool_stats
+from .rooms import get_direct_room_id
+from .search import search_messages
 
 User = get_user_model()
 
 
+# stays sync: the page is built from the contacts, inbox and presence helpers, a
+# dozen querysets and sync redis calls that would each need a thread hop
 @login_required(login_url='accounts:login')
 def index(request):
-    users = User.objects.exclude(id=request.user.id)
-    return render(request, 'index.html', {'users': users})
+    query = request.GET.get('q', '').strip()
+    users, next_cursor = get_contacts_page(request.user, query)
+    direct_rooms = get_direct_rooms(request.user)
+    recent_users = [] if query else get_recent_contacts(request.user, direct_rooms=direct_rooms)
+    add_unread_counts(request.user, users + recent_users, direct_rooms)
+    digest = pop_sync_digest(request.user.id)
+    add_digest_labels(request.user, digest, direct_rooms)
+    return render(request, 'index.html', {
+        'digest': digest,
+        'users': users,
+        'recent_users': recent_users,
+        'online_user_ids': get_online_user_ids(user.id for user in users + recent_users),
+        'groups': get_groups(request.user),
+        'next_cursor': next_cursor,
+        'q': query,
+    })
 
 
+# stays sync: like index, it is built from the sync contacts and presence helpers
 @login_required(login_url='accounts:login')
-def chat_room(request, room_id):
+def contacts(request):
+    try:
+        users, next_cursor = get_contacts_page(request.user, request.GET.get('q', '').strip(), request.GET.get('cursor'))
+    except signing.BadSignature:
+        return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+    online_user_ids = get_online_user_ids(user.id for user in users)
+    add_unread_counts(request.user, users)
+    return JsonResponse({
+        'contacts': [
+            dict(contact_to_json(user), online=user.id in online_user_ids, unread=user.unread) for user in users
+        ],
+        'next_cursor': next_cursor,
+    })
+
+
+async def chat_room(request, room_id):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), 'accounts:login')
+    # the templates read request.user, which would load the user again, synchronously
+    request.user = user
+    # auser() loaded the session, reading it doesn't query the database again
     first_name = request.session.get('first_name')
     last_name = request.session.get('last_name')
-    return render(request, 'chat/chat_room.html', {'room_id': room_id, 'first_name': first_name, 'last_name': last_name})
+    group_name = await Room.objects.filter(id=room_id, is_group=True).values_list('name', flat=True).afirst()
+    return render(request, 'chat/chat_room.html', {
+        'room_id': room_id, 'first_name': first_name, 'last_name': last_name, 'group_name': group_name,
+    })
+
+
+@require_POST
+async def create_group(request):
+    """Create a group room of the user and the users in ``members``."""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), 'accounts:login')
+    name = request.POST.get('name', '').strip()
+    if not name or len(name) > Room._meta.get_field('name').max_length:
+        return JsonResponse({'error': 'Invalid group name.'}, status=400)
+    try:
+        member_ids = {int(member_id) for member_id in request.POST.getlist('members')}
+    except ValueError:
+        return JsonResponse({'error': 'Invalid members.'}, status=400)
+    member_ids.discard(user.id)
+    if len(member_ids) + 1 > settings.CHAT_GROUP_MAX_MEMBERS:
+        return JsonResponse({'error': 'Too many members.'}, status=400)
+    existing_ids = {user_id async for user_id in User.objects.filter(id__in=member_ids).values_list('id', flat=True)}
+    if existing_ids != member_ids:
+        return JsonResponse({'error': 'Unknown members.'}, status=400)
+    # the room and its participants are written in a transaction, which the async ORM can't run
+    room = await sync_to_async(Room.objects.create_group)(
+        name, user, member_ids, is_public=bool(request.POST.get('public')),
+    )
+    return JsonResponse(group_to_json(room), status=201)
+
+
+@require_POST
+async def join_group(request, room_id):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), 'accounts:login')
+    try:
+        # counted and added in one transaction, like create_group
+        room = await sync_to_async(Room.objects.join_group)(room_id, user, settings.CHAT_GROUP_MAX_MEMBERS)
+    except Room.DoesNotExist:
+        raise Http404
+    if room is None:
+        return JsonResponse({'error': 'This group is full.'}, status=400)
+    return JsonResponse(group_to_json(room))
+
+
+@require_POST
+async def leave_group(request, room_id):
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), 'accounts:login')
+    try:
+        room = await Room.objects.aget(id=room_id, is_group=True, participants=user)
+    except Room.DoesNotExist:
+        raise Http404
+    await room.participants.aremove(user)
+    return JsonResponse(group_to_json(room))
+
+
+# stays sync: the upload handler writes the body to a temporary file chunk by
+# chunk while request.FILES is parsed, blocking writes that belong in a thread
+@csrf_exempt
+@login_required(login_url='accounts:login')
+@require_POST
+def upload_attachment(request, room_id):
+    """
+    Store the multipart field ``file`` as an attachment of the room and return
+    its reference, for the next message to carry. The upload handler has to be
+    set before the CSRF check reads the body, hence the check of
+    ``store_upload``.
+    """
+    if not Room.objects.filter(id=room_id, participants=request.user).exists():
+        raise Http404
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    # a body this large can't hold a file within the limit, it isn't parsed at all
+    if content_length > settings.CHAT_ATTACHMENTS['MAX_SIZE'] + 64 * 1024:
+        return JsonResponse({'error': 'File too large.'}, status=413)
+    request.upload_handlers = [AttachmentUploadHandler(request)]
+    return store_upload(request, room_id)
+
+
+@csrf_protect
+def store_upload(request, room_id):
+    uploaded_file = request.FILES.get('file')
+    if request.upload_handlers[0].too_large:
+        return JsonResponse({'error': 'File too large.'}, status=413)
+    if uploaded_file is None:
+        return JsonResponse({'error': 'No file.'}, status=400)
+    attachment = create_attachment(room_id, request.user, uploaded_file)
+    return JsonResponse(attachment_to_ref(attachment), status=201)
 
 
+async def download_attachment(request, attachment_id):
+    """Stream an attachment to a member of its room. Only plain images are displayed inline."""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), 'accounts:login')
+    try:
+        attachment = await Attachment.objects.aget(id=attachment_id, room__participants=user)
+    except Attachment.DoesNotExist:
+        raise Http404
+    inline = attachment.content_type in INLINE_CONTENT_TYPES
+    return AttachmentResponse(
+        attachment.file.open('rb'),
+        as_attachment=not inline,
+        filename=attachment.name,
+        content_type=attachment.content_type if inline else 'application/octet-stream',
+    )
+
+
+async def attachment_thumbnail(request, attachment_id):
+    """The thumbnail of an image attachment, 404 until the workers made it."""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), 'accounts:login')
+    try:
+        attachment = await Attachment.objects.aget(id=attachment_id, room__participants=user)
+    except Attachment.DoesNotExist:
+        raise Http404
+    if not attachment.thumbnail:
+        raise Http404
+    return AttachmentResponse(attachment.thumbnail.open('rb'))
+
+
+# stays sync: get_direct_room_id may create the room in a transaction and
+# caches its id with the sync redis client
 @login_required(login_url='accounts:login')
 def get_or_create_room(request, user_id):
-    other_user = User.objects.get(id=user_id)
-    room = Room.objects.filter(participants=request.user).filter(participants=other_user).distinct().first()
-    if not room:
-        room = Room.objects.create()
-        room.participants.add(request.user, other_user)
+    other_user = get_object_or_404(User, id=user_id)
+    room_id = get_direct_room_id(request.user, other_user)
     request.session['first_name'] = other_user.first_name
     request.session['last_name'] = other_user.last_name
-    return redirect('chat:chat_room', room_id=room.id)
+    return redirect('chat:chat_room', room_id=room_id)
+
+
+# stays sync: search_messages reads the room histories with the sync redis
+# client and the message archive with querysets built per room
+@login_required(login_url='accounts:login')
+def search(request):
+    """Messages of the user's rooms, or of the room in ``room``, holding every word of ``q``."""
+    room_id = request.GET.get('room')
+    if room_id is not None:
+        if not room_id.isdigit() or not Room.objects.filter(id=room_id, participants=request.user).exists():
+            raise Http404
+        room_id = int(room_id)
+    try:
+        messages, next_cursor = search_messages(
+            request.user, request.GET.get('q', ''), room_id=room_id, cursor=request.GET.get('cursor'),
+        )
+    except signing.BadSignature:
+        return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+    return JsonResponse({'messages': messages, 'next_cursor': next_cursor})
+
+
+async def redis_pool(request):
+    user = await request.auser()
+    if not (user.is_active and user.is_staff):
+        return redirect_to_login(request.get_full_path(), 'admin:login')
+    return JsonResponse(redis_pool_stats())
+
+
+async def health(request):
+    """Health of the worker process that serves the request, 503 while it drains."""
+    state = workers.health()
+    return JsonResponse(state, status=503 if workers.draining else 200)
+
+
+async def metrics_view(request):
+    """Prometheus scrape endpoint, for the bearer token in CHAT_METRICS['TOKEN'] or staff users."""
+    if not metrics.ENABLED:
+        raise Http404
+    token = settings.CHAT_METRICS['TOKEN']
+    if token:
+        # constant time, so the token can't be guessed from response times
+        authorized = hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+    else:
+        user = await request.auser()
+        authorized = user.is_active and user.is_staff
+    if not authorized:
+        return HttpResponse(status=403)
+
+    record_pool_metrics()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import time
+
+from chat import metrics
+from chat.redis_pool import record_pool_metrics
+
+logger = logging.getLogger(__name__)
+
+# close code telling clients the server is restarting and to reconnect, to
+# whichever worker accepts them next. Daphne only lets applications close
+# with 1000 or 3000-4999, so this is RFC 6455's "Service Restart" (1012) in
+# the private range
+RESTART_CLOSE_CODE = 4012
+
+# live chat connections of this process, they register once accepted
+_consumers = set()
+_started = time.time()
+# set once this process stops taking connections
+draining = False
+# slot of this process under `manage.py serve`, None under any other server
+worker_id = None
+# shared memory the supervisor reads this process' health from:
+# heartbeat unix time, connections, draining
+_shared_state = None
+# queue the supervisor collects the metrics of its workers from
+_metrics_queue = None
+
+
+def register(consumer):
+    _consumers.add(consumer)
+
+
+def unregister(consumer):
+    _consumers.discard(consumer)
+
+
+def connection_count():
+    return len(_consumers)
+
+
+def health():
+    return {
+        'status': 'draining' if draining else 'ok',
+        'worker': worker_id,
+        'pid': os.getpid(),
+        'connections': len(_consumers),
+        'uptime': round(time.time() - _started, 3),
+    }
+
+
+def attach(slot, shared_state, metrics_queue=None):
+    """Called by the serving worker, before the event loop starts. It reports once its heartbeat runs."""
+    global worker_id, _shared_state, _metrics_queue
+    worker_id = slot
+    _shared_state = shared_state
+    _metrics_queue = metrics_queue
+
+
+def report():
+    """Publish this process' health, and its metrics when they are enabled, to the supervisor."""
+    if _shared_state is not None:
+        _shared_state[:] = [time.time(), len(_consumers), float(draining)]
+    if _metrics_queue is not None and metrics.ENABLED:
+        record_pool_metrics()
+        _metrics_queue.put((worker_id, os.getpid(), metrics.snapshot()))
+
+
+async def heartbeat(interval):
+    while True:
+        report()
+        await asyncio.sleep(interval)
+
+
+async def drain(timeout):
+    """
+    Stop taking connections and close the open ones with
+    ``RESTART_CLOSE_CODE``, so that their clients reconnect to another
+    worker. Returns once they are all gone, or after ``timeout`` seconds.
+    """
+    global draining
+    draining = True
+    report()
+    consumers = list(_consumers)
+    logger.info("Draining %s connections.", len(consumers), extra={'event': 'drain', 'connections': len(consumers)})
+    for consumer in consumers:
+        try:
+            await consumer.close(code=RESTART_CLOSE_CODE)
+        except Exception as e:
+            logger.error("Error during connection drain: %s", e)
+    deadline = time.monotonic() + timeout
+    while _consumers and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    report()
+    return not _consumers